@@ -1,11 +1,10 @@
 from __future__ import division, print_function
 
-from pvtrace import PhotonDatabase, Trajectory
+from pvtrace import PhotonDatabase, PhotonStore, PhotonTally, Trajectory
 
 import logging
 import os
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 import six
@@ -13,15 +12,27 @@ import sys
 import math
 import csv
 
-if sys.version_info > (2, 7):
-    plt.switch_backend('Qt5Agg')
-"""
-Changing the backend is important on Windows, since the default one results in the following error:
-PyEval_RestoreThread: NULL tstate
+# matplotlib.pyplot, imported by pyplot() at the first graph
+_plt = None
 
-That error could be circumvented calling .quit() and .destroy() on the graph element.
-Using Qt5 as backend requires PyQt5 but keeps the code platform independent
-"""
+
+def pyplot():
+    """
+    Returns matplotlib.pyplot, imported at the first graph (tracing and statistics do not need matplotlib).
+
+    Changing the backend is important on Windows, since the default one results in the following error:
+    PyEval_RestoreThread: NULL tstate
+
+    That error could be circumvented calling .quit() and .destroy() on the graph element.
+    Using Qt5 as backend requires PyQt5 but keeps the code platform independent
+    """
+    global _plt
+    if _plt is None:
+        import matplotlib.pyplot as plt
+        if sys.version_info > (2, 7):
+            plt.switch_backend('Qt5Agg')
+        _plt = plt
+    return _plt
 
 
 class Analysis(object):
@@ -43,11 +54,25 @@ class Analysis(object):
             try_db_location = os.path.join(self.working_dir, "db.sqlite")
             if database is None and os.access(try_db_location, os.R_OK):
                 self.db = PhotonDatabase.PhotonDatabase(dbfile=try_db_location, readonly=True)
+            elif database is None:
+                # Simulations traced with the columnar backend (see Tracer db_backend)
+                for store_filename in ('db.h5', 'db.npz'):
+                    try_db_location = os.path.join(self.working_dir, store_filename)
+                    if os.access(try_db_location, os.R_OK):
+                        self.db = PhotonStore.PhotonStore(dbfile=try_db_location, readonly=True)
+                        break
+                # Simulations traced with tallies only (db_backend='tally')
+                try_db_location = os.path.join(self.working_dir, 'tally.json')
+                if not hasattr(self, 'db') and os.access(try_db_location, os.R_OK):
+                    self.db = PhotonTally.PhotonTally(dbfile=try_db_location, readonly=True)
             
         self.log = logging.getLogger('pvtrace.analysis')
         # Cached data
         self.uids = None
+        self.tally = None
         self.count = None
+        self.histograms = None
+        self.histogram_range = (350, 700)
 
         self.edges = ['left', 'near', 'far', 'right']
         self.apertures = ['top', 'bottom']
@@ -57,43 +82,11 @@ class Analysis(object):
         self.db = database
 
     def db_stats(self):
-        if self.uids is not None:
+        if self.count is not None:
             return
 
-        self.uids = {}
-        self.count = {}
-
-        # PHOTON GENERATED
-        self.uids['generated'] = self.db.uids_generated_photons(max=True)
-        # PHOTON KILLED
-        self.uids['killed'] = self.db.killed()
-        # TOTAL PHOTON SIMULATED
-        self.uids['tot'] = diff(self.uids['generated'], self.uids['killed'])
-        # PHOTON LOST
-        self.uids['losses'] = self.db.uids_nonradiative_losses()
-        # LUMINESCENT PHOTONS EDGES
-        self.uids['luminescent_edges'] = []
-        for surface in self.edges:
-            self.uids['luminescent_'+surface] = self.db.uids_out_bound_on_surface(surface, luminescent=True)
-            self.uids['luminescent_edges'] += self.uids['luminescent_'+surface]
-        # LUMINESCENT PHOTONS APERTURES
-        self.uids['luminescent_apertures'] = []
-        for surface in self.apertures:
-            self.uids['luminescent_' + surface] = self.db.uids_out_bound_on_surface(surface, luminescent=True)
-            self.uids['luminescent_apertures'] += self.uids['luminescent_' + surface]
-        # SOLAR PHOTONS (top/bottom)
-        self.uids['solar_apertures'] = []
-        for surface in self.apertures:
-            self.uids['solar_' + surface] = self.db.uids_out_bound_on_surface(surface, solar=True)
-            self.uids['solar_apertures'] += self.uids['solar_' + surface]
-        # CHANNELS
-        self.uids['luminescent_channel'] = self.db.uids_in_reactor_and_luminescent()
-        self.uids['channels_tot'] = self.db.uids_in_reactor()
-        self.uids['channels_direct'] = diff(self.uids['channels_tot'], self.uids['luminescent_channel'])
-
-        # Calculate sum (for loop iterates only the keys of the dictionary)
-        for key in self.uids:
-            self.count[key] = len(self.uids[key])
+        self.classify_photons()
+
         self.count['luminescent_faces'] = self.count['luminescent_edges'] + self.count['luminescent_apertures']
 
         # Controls
@@ -112,6 +105,24 @@ class Analysis(object):
                 raise ArithmeticError('Sum of photons per fate and generate do not match!'
                                       '(Delta: '+delta+'/'+str(self.count['tot'])+' [Error > 0.1%!]')
 
+    def classify_photons(self):
+        """
+        Bins every photon in its fate categories (self.uids) reading its endpoint once (single pass on
+        db.endpoint_records()). The histograms of the original wavelength of each category (self.histograms, 1 nm bins
+        in self.histogram_range) are built along the way. Simulations traced with db_backend='tally' have only the
+        tallies (self.count and self.histograms), without uids.
+        """
+        if isinstance(self.db, PhotonTally.PhotonTally):
+            tally = self.db
+        else:
+            tally = PhotonTally.PhotonTally(keep_uids=True, edges=self.edges, apertures=self.apertures,
+                                            wavelength_range=self.histogram_range)
+            tally.add_records(self.db.endpoint_records())
+            self.uids = tally.uids
+        self.tally = tally
+        self.count = dict(tally.count)
+        self.histograms = tally.histograms()
+
     def percent(self, num_photons):
         """
         Return the percentage of num_photons with respect to thrown photons as 2 decimal digit string
@@ -161,15 +172,16 @@ class Analysis(object):
         """
         self.log.debug("Print_wavelength_channels called")
         self.db_stats()
+        assert self.uids is not None, "Photon wavelengths are not available for simulations traced with tallies only"
 
         if only_luminescent:
             ret_str = " Photons in reactor (luminescent only). Wavelengths in nm"
-            for photon in self.uids['luminescent_channel']:
-                ret_str += " ".join(map(str, self.db.wavelength_for_uid(photon)))  # Clean output (for elaborations)
+            photons = self.uids['luminescent_channel']
         else:
             ret_str = " Photons in reactor (all). Wavelengths in nm"
-            for photon in self.uids['channels_tot']:
-                ret_str += " ".join(map(str, self.db.wavelength_for_uid(photon)))  # Clean output (for elaborations)
+            photons = self.uids['channels_tot']
+        # Clean output (for elaborations)
+        ret_str += "".join(map(str, self.db.wavelengths_for_uids(photons).tolist()))
 
         return ret_str
 
@@ -234,9 +246,7 @@ class Analysis(object):
         :param photon_list: array with uids of photons of interest (they are assumed to be fluorescent)
         :return:
         """
-        bounces = []
-        for photon in photon_list:
-            bounces.append(self.db.bounces_for_uid(photon)[0])
+        bounces = self.db.bounces_for_uids(photon_list)
 
         y = np.bincount(bounces)
         x = np.linspace(0, max(bounces), num=max(bounces) + 1)
@@ -279,36 +289,55 @@ class Analysis(object):
             self.log.info("describe_trajectory() uids provided: "+str(sorted(uid_list)))
             return self.describe_photon_path(uid_list)
         else:
+            # Steps of all the trajectories are fetched together
+            steps = self.photon_steps([uid for trajectory in uid_list for uid in trajectory])
             return_values = []
+            first = 0
             for trajectory in uid_list:
-                return_values.append(self.describe_photon_path(trajectory))
+                return_values.append(self.describe_photon_path(trajectory, steps=steps[first:first + len(trajectory)]))
+                first += len(trajectory)
             return return_values
     
-    def describe_photon_path(self, path, full_description=False):
+    def describe_photon_path(self, path, full_description=False, steps=None):
         """
         Describe a photon trajectory
         
         :param path: uid-based photon trajectory
+        :param steps: steps of the path as returned by photon_steps() (fetched from the DB if None)
         :return:
         """
         trajectory = Trajectory.Trajectory()
-        for step in path:
-            position = self.db.value_for_table_column_uid(table='position', column=('x', 'y', 'z'), uid=step)
-            direction = self.db.value_for_table_column_uid(table='direction', column=('x', 'y', 'z'), uid=step)
-            polarization = self.db.value_for_table_column_uid(table='polarisation', column=('x', 'y', 'z'), uid=step)
-            wavelength = self.db.value_for_table_column_uid(table='photon', column='wavelength', uid=step)
-            state = self.db.value_for_table_column_uid(table='state',
-                                                       column=('absorption_counter', 'intersection_counter', 'active',
-                                                               'killed', 'source', 'emitter_material',
-                                                               'absorber_material', 'container_obj', 'on_surface_obj',
-                                                               'surface_id', 'ray_direction_bound', 'reaction'),
-                                                       uid=step)
+        if steps is None:
+            steps = self.photon_steps(path)
+        for position, direction, polarization, wavelength, state in steps:
             self.log.debug("state is "+str(state))
-
             trajectory.add_step(position=position, direction=direction, polarization=polarization,
-                                wavelength=wavelength, active=state[2], container=state[7], on_surface_object=state[8])
+                                wavelength=wavelength, active=state[2], container=state[7],
+                                on_surface_object=state[8])
         return trajectory
 
+    def photon_steps(self, path):
+        """
+        Returns position, direction, polarization, wavelength and state of the steps (uids) in path, with one query per
+        DB table
+
+        :param path: list of uids
+        :return: list of (position, direction, polarization, wavelength, state) tuples, one per uid
+        """
+        positions = self.db.values_for_uids(table='position', columns=('x', 'y', 'z'), uids=path).tolist()
+        directions = self.db.values_for_uids(table='direction', columns=('x', 'y', 'z'), uids=path).tolist()
+        polarizations = self.db.values_for_uids(table='polarisation', columns=('x', 'y', 'z'), uids=path,
+                                                dtype=object, missing=None).tolist()
+        wavelengths = self.db.values_for_uids(table='photon', columns='wavelength', uids=path).tolist()
+        states = self.db.values_for_uids(table='state',
+                                         columns=('absorption_counter', 'intersection_counter', 'active', 'killed',
+                                                  'source', 'emitter_material', 'absorber_material', 'container_obj',
+                                                  'on_surface_obj', 'surface_id', 'ray_direction_bound', 'reaction'),
+                                         uids=path, dtype=object, missing=None).tolist()
+        # Same values of value_for_table_column_uid() (empty polarization if missing, wavelength as list)
+        polarizations = [[] if polarization[0] is None else polarization for polarization in polarizations]
+        return list(zip(positions, directions, polarizations, [[wavelength] for wavelength in wavelengths], states))
+
     def create_graphs(self, prefix=''):
         """
         Generate a series of graphs on photons stored in self.db
@@ -328,22 +357,21 @@ class Analysis(object):
         else:
             prefix = os.path.join(os.path.expanduser('~'), 'pvtrace_data')
 
-        graphs = {
-            'reactor-total': self.uids['channels_tot'],
-            'reactor-luminescent': self.uids['luminescent_channel'],
-            'lsc-edges': self.uids['luminescent_edges'],
-            'lsc-apertures': self.uids['luminescent_apertures'],
-            'lsc-reflected': self.uids['solar_top'],
-            'lsc-transmitted': self.uids['solar_bottom']}
+        graphs_fraction = {
+            'reactor-total': 'channels_tot',
+            'reactor-luminescent': 'luminescent_channel',
+            'lsc-edges': 'luminescent_edges',
+            'lsc-apertures': 'luminescent_apertures',
+            'lsc-reflected': 'solar_top',
+            'lsc-transmitted': 'solar_bottom'}
 
         # noinspection PyCompatibility
-        for plot, uid in six.iteritems(graphs):
-            if len(uid) < 10:
+        for plot, fraction in six.iteritems(graphs_fraction):
+            if self.count[fraction] < 10:
                 self.log.info('[' + plot + "] The database doesn't have enough photons to generate this graph!")
             else:
-                wavelengths = self.db.original_wavelength_for_uid(uid)
                 file_path = os.path.join(prefix, plot)
-                self.save_histogram(data=wavelengths, filename=file_path)
+                self.save_histogram(data=None, filename=file_path, histogram=self.histograms[fraction])
 
         return True
         self.log.info("Plotting bounces luminescent to channels")
@@ -383,8 +411,7 @@ class Analysis(object):
         counter = 0
         for photon_fraction in fractions:
             self.log.info("Calculating "+photon_fraction)
-            wavelength, photons = self.histogram_raw_data(
-                data=self.db.original_wavelength_for_uid(self.uids[photon_fraction]), wavelength_range=(350, 700))
+            wavelength, photons = self.histograms[photon_fraction]
             if counter == 0:
                 wl = ['{:.0f}'.format(x) for x in wavelength]
                 # print(wl)
@@ -420,13 +447,14 @@ class Analysis(object):
             for key, value in photon_balance.items():
                 writer.writerow(value)
 
-    def save_histogram(self, data, filename, wavelength_range=(350, 700)):
+    def save_histogram(self, data, filename, wavelength_range=(350, 700), histogram=None):
         """
         Save the cumulative distribution of photons in the wavelength range specified to filename as csv file
 
         :param data: List with photons' wavelengths
         :param filename: Filename for the exported file. Will be saved in home/pvtrace_export/filename (+.csv appended)
         :param wavelength_range : range of wavelength to be plotted (X axis)
+        :param histogram: (wavelength, count) already binned (e.g. from self.histograms), used instead of data
         """
         self.log.debug("Saving histograpm data for " + filename)
 
@@ -435,8 +463,10 @@ class Analysis(object):
             os.makedirs(export_dir)
         export_location = os.path.join(export_dir, filename + '.csv')
 
-        a, b = self.histogram_raw_data(data=data, wavelength_range=wavelength_range)
-        data_array = zip(a, b)
+        if histogram is None:
+            histogram = self.histogram_raw_data(data=data, wavelength_range=wavelength_range)
+        a, b = histogram
+        data_array = list(zip(a, b))
         np.savetxt(fname=export_location, X=data_array, delimiter=', ', newline="\n", fmt='%9.0f',
                    header="wavelength, count")
 
@@ -480,6 +510,7 @@ def histogram(data, filename, wavelength_range=(350, 700)):
     # hist = np.histogram(data, bins=100, range=range)
     # hist = np.histogram(data, bins=np.linspace(400, 800, num=101))
     # print "hist is ",hist
+    plt = pyplot()
     if wavelength_range is None:
         plt.hist(data, histtype='stepfilled')
     else:
@@ -508,6 +539,7 @@ def xyplot(x, y, filename):
         saving_location = os.path.join(home, "pvtrace_export", filename)
     suffixes = ('png', 'pdf')
 
+    plt = pyplot()
     plt.scatter(x, y, linewidths=1)
     plt.plot(x, y, '-')
     for extension in suffixes:
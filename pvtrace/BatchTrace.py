@@ -0,0 +1,582 @@
+# pvtrace is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# pvtrace is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Vectorised photon tracing.
+
+BatchTracer follows a whole batch of photons at once, keeping position, direction, wavelength and counters in NumPy
+arrays, so that intersection, absorption, re-emission and Fresnel events are evaluated for all the photons of a step
+with a few array operations instead of one Python call per photon. The tracing rules are the same of Photon.trace()
+and the DB written is the same used by Analysis, therefore the statistics of the two engines match (not the single
+trajectories, as the random numbers are drawn in a different order).
+
+Supported scenes are made of Box, Cylinder and Sphere shapes (LSC, Channel, RayBin, Rod and generic Register objects)
+with Material or CompositeMaterial. Polarisation is not tracked (unpolarised Fresnel equations are used).
+Scenes containing CSG shapes, Coating, PlanarReflector, PlanarMirror, Face or SimpleCell objects raise a ValueError
+and must be traced with Tracer.
+"""
+
+from __future__ import division, print_function
+
+import sys
+
+import numpy as np
+
+from pvtrace.Trace import Tracer
+from pvtrace.Devices import *
+from pvtrace.Geometry import box_intervals, cylinder_intervals, sphere_intervals
+
+
+# Tolerance on the ray parameter t (same order of magnitude of Geometry.cmp_floats)
+TOLERANCE = 1e-12
+# Looser tolerance for the surfaces the photon is currently on (rounding errors grow at grazing incidence)
+SURFACE_TOLERANCE = 1e-9
+
+BOX_FACES = Box.face_names
+CYLINDER_FACES = Cylinder.face_names
+SPHERE_FACES = Sphere.face_names
+
+
+def _fresnel_reflection(cos_incidence, n1, n2):
+    """
+    Vectorised version of Materials.fresnel_reflection (unpolarised light, total internal reflection included).
+
+    :param cos_incidence: cosine of the angles of incidence
+    :param n1: refractive index of the incident media
+    :param n2: refractive index of the transmitting media
+    :return: array of reflectivities
+    """
+    sin_transmission = n1 / n2 * np.sqrt(np.maximum(0., 1. - cos_incidence ** 2))
+    tir = sin_transmission >= 1.
+    cos_transmission = np.sqrt(np.maximum(0., 1. - sin_transmission ** 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = ((n1 * cos_incidence - n2 * cos_transmission) / (n1 * cos_incidence + n2 * cos_transmission)) ** 2
+        rp = ((n1 * cos_transmission - n2 * cos_incidence) / (n1 * cos_transmission + n2 * cos_incidence)) ** 2
+    reflectivity = np.nan_to_num(0.5 * (rs + rp))
+    return np.where(tir, 1., reflectivity)
+
+
+def _fresnel_refraction(normal, direction, n1, n2):
+    """
+    Vectorised version of Materials.fresnel_refraction (direction of the transmitted rays).
+
+    :param normal: (n, 3) array of surface normals
+    :param direction: (n, 3) array of incident directions
+    :param n1: refractive index of the incident media
+    :param n2: refractive index of the transmitting media
+    :return: (n, 3) array of normalised refracted directions
+    """
+    ratio = (n1 / n2)[:, None]
+    dot = np.einsum('ij,ij->i', normal, direction)[:, None]
+    c = np.sqrt(np.maximum(0., 1. - ratio ** 2 * (1. - dot ** 2)))
+    sign = np.where(dot < 0, -1., 1.)
+    refracted = ratio * direction + sign * (c - sign * ratio * dot) * normal
+    return refracted / np.linalg.norm(refracted, axis=1)[:, None]
+
+
+def _isotropic_directions(n):
+    """Returns n isotropically distributed unit vectors."""
+    z = np.random.uniform(-1., 1., n)
+    phi = np.random.uniform(0., 2. * np.pi, n)
+    r = np.sqrt(1. - z ** 2)
+    return np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+
+
+class _SceneArrays(object):
+    """
+    Flat, array-friendly description of the objects of a Scene, as needed by BatchTracer.
+    """
+
+    def __init__(self, scene):
+        self.objects = list(scene.objects)
+        self.count = len(self.objects)
+        self.names = [str(obj.name) for obj in self.objects]
+        self.bounds = self.objects.index(scene.bounds)
+        self.refractive_index = np.zeros(self.count)
+        self.is_channel = np.zeros(self.count, dtype=bool)
+        self.is_sink = np.zeros(self.count, dtype=bool)
+        self.kinds = []
+        self.faces = []
+        self.inverse = []
+        self.components = []
+
+        for i, obj in enumerate(self.objects):
+            if isinstance(obj, (Coating, PlanarReflector, PlanarMirror, Face, SimpleCell)):
+                raise ValueError("BatchTracer does not support %s objects (%s), please use Tracer."
+                                 % (type(obj).__name__, obj.name))
+            shape = obj.shape
+            if isinstance(shape, Box):
+                self.kinds.append('box')
+                self.faces.append(BOX_FACES)
+                self.inverse.append(shape.inverse_transform())
+            elif isinstance(shape, Cylinder):
+                self.kinds.append('cylinder')
+                self.faces.append(CYLINDER_FACES)
+                self.inverse.append(shape.inverse_transform())
+            elif isinstance(shape, Sphere):
+                self.kinds.append('sphere')
+                self.faces.append(SPHERE_FACES)
+                self.inverse.append(tf.identity_matrix())
+            else:
+                raise ValueError("BatchTracer does not support %s shapes (%s), please use Tracer."
+                                 % (type(shape).__name__, obj.name))
+
+            self.is_channel[i] = isinstance(obj, Channel)
+            self.is_sink[i] = isinstance(obj, RayBin)
+            material = obj.material
+            self.refractive_index[i] = material.refractive_index
+            if isinstance(material, CompositeMaterial):
+                self.components.append(list(material.materials))
+            elif isinstance(material, Material):
+                self.components.append([material] if material.absorption_data else [])
+            else:
+                raise ValueError("BatchTracer does not support %s materials (%s), please use Tracer."
+                                 % (type(material).__name__, obj.name))
+
+    def local(self, index, position, direction):
+        """Returns position and direction in the local frame of the index-th object."""
+        inverse = self.inverse[index]
+        return np.dot(position, inverse[:3, :3].T) + inverse[:3, 3], np.dot(direction, inverse[:3, :3].T)
+
+    def intervals(self, position, direction):
+        """
+        Intersection intervals of every ray with every object.
+
+        :return: t_near, t_far, face_near, face_far arrays of shape (n, objects)
+        """
+        n = len(position)
+        t_near = np.empty((n, self.count))
+        t_far = np.empty((n, self.count))
+        face_near = np.empty((n, self.count), dtype=int)
+        face_far = np.empty((n, self.count), dtype=int)
+        for i, obj in enumerate(self.objects):
+            origin, local_direction = self.local(i, position, direction)
+            if self.kinds[i] == 'box':
+                result = box_intervals(origin, local_direction, obj.shape.origin, obj.shape.extent)
+            elif self.kinds[i] == 'cylinder':
+                result = cylinder_intervals(origin, local_direction, obj.shape.radius, obj.shape.length)
+            else:
+                result = sphere_intervals(origin, local_direction, obj.shape.centre, obj.shape.radius)
+            t_near[:, i], t_far[:, i], face_near[:, i], face_far[:, i] = result
+        return t_near, t_far, face_near, face_far
+
+    def normals(self, index, position, face):
+        """
+        Outward surface normals (world frame) of the index-th object at the given surface points.
+
+        :param index: object index
+        :param position: (n, 3) array of points on the object surface
+        :param face: (n,) array of face indexes
+        :return: (n, 3) array of unit normals
+        """
+        obj = self.objects[index]
+        n = len(position)
+        if self.kinds[index] == 'box':
+            local = np.zeros((n, 3))
+            local[np.arange(n), face % 3] = np.where(face < 3, -1., 1.)
+        elif self.kinds[index] == 'cylinder':
+            point, _ = self.local(index, position, np.zeros((n, 3)))
+            local = np.zeros((n, 3))
+            local[:, :2] = point[:, :2]
+            local[face == 1] = (0., 0., -1.)
+            local[face == 2] = (0., 0., 1.)
+        else:
+            local = position - obj.shape.centre
+        # Normals transform with the inverse transpose
+        normals = np.dot(local, self.inverse[index][:3, :3])
+        return normals / np.linalg.norm(normals, axis=1)[:, None]
+
+    def absorption_table(self, index, wavelength):
+        """
+        Cumulative absorption coefficients of the component materials of the index-th object: the table of
+        CompositeMaterial.absorption_table(), so that absorption and absorber are the same of the scalar tracer. The
+        last column is the total absorption coefficient.
+
+        :return: (n, components) array
+        """
+        material = self.objects[index].material
+        if isinstance(material, CompositeMaterial):
+            return material.absorption_table()(wavelength)
+        components = self.components[index]
+        coefficients = np.zeros((len(wavelength), len(components)))
+        for k, component in enumerate(components):
+            coefficients[:, k] = component.absorption_data.value(wavelength)
+        if len(components) > 0:
+            coefficients[coefficients <= 0] = 10e-30
+        return np.cumsum(coefficients, axis=1)
+
+
+class BatchTracer(Tracer):
+    """
+    A Tracer that fires photons through the scene in batches, tracing every photon of a batch at once with NumPy.
+
+    Same options and output (DB, statistics) of Tracer, without visualiser. Aimed at large simulations, where it is
+    more than an order of magnitude faster than the photon-by-photon loop of Tracer.start().
+    """
+
+    def __init__(self, scene=None, source=None, throws=1, steps=50, seed=None, batch_size=10000,
+                 show_counter=False, db_name=None, db_split=None, preserve_db_tables=False, workers=None,
+                 block_size=None, db_backend='sqlite', checkpoint_interval=None, resume=False, target_error=None,
+                 target_fractions=('channels_tot',), confidence=0.95, profile=False):
+        """
+        :param scene: Scene to be traced
+        :param source: light source
+        :param throws: number of photons to be traced
+        :param steps: maximum number of steps per photon (then the photon is killed)
+        :param seed: seed of the random number generator
+        :param batch_size: number of photons traced together (memory usage grows linearly with it)
+        :param show_counter: print the number of photons traced after every batch
+        :param db_name: filename of the DB (None for in-memory DB)
+        :param db_split: dump the DB to file every split_size photons (defaults to True for large simulations)
+        :param preserve_db_tables: keep all the DB tables when merging split DBs
+        :param workers: number of processes (see Tracer), None for single process
+        :param block_size: photons per worker block (see Tracer), defaults to batch_size
+        :param db_backend: 'sqlite' (PhotonDatabase), 'columnar' (PhotonStore) or 'tally' (PhotonTally, counters only)
+        :param checkpoint_interval: save a checkpoint every checkpoint_interval photons (see Tracer), None to disable
+        :param resume: continue the run from the last checkpoint in the scene working_dir
+        :param target_error: stop when the relative errors of target_fractions are below it (see Tracer), throws is
+        then the photon budget
+        :param target_fractions: photon categories of the convergence check (e.g. 'channels_tot', 'luminescent_edges')
+        :param confidence: confidence level of the binomial intervals of the convergence check
+        :param profile: save calls and wall time of the tracing stages as profile.json in the scene working_dir (see
+        Tracer and profile_stages())
+        """
+        assert batch_size > 0, "batch_size must be positive"
+        if block_size is None:
+            block_size = batch_size
+        super(BatchTracer, self).__init__(scene=scene, source=source, throws=throws, steps=steps, seed=seed,
+                                          use_visualiser=False, show_counter=show_counter, db_name=db_name,
+                                          db_split=db_split, preserve_db_tables=preserve_db_tables,
+                                          workers=workers, block_size=block_size, db_backend=db_backend,
+                                          checkpoint_interval=checkpoint_interval, resume=resume,
+                                          target_error=target_error, target_fractions=target_fractions,
+                                          confidence=confidence, profile=profile)
+        self.batch_size = int(batch_size)
+        self.arrays = _SceneArrays(scene)
+        self.source_id = None
+
+    def start(self):
+        if self.profile and self.profiler is None:
+            return self.start_profiled()
+        if self.workers is not None:
+            return self.start_parallel()
+
+        throw = self.load_checkpoint() if self.resume else 0
+        if self.profiler is not None:
+            self.profiler.begin(throw, self.total_steps)
+        dumped_throws = throw
+        checkpointed = throw
+        while throw < self.throws:
+            size = min(self.batch_size, self.throws - throw)
+            self.trace_block(throw, size)
+            throw += size
+
+            if self.show_counter:
+                sys.stdout.write('\r Photon number: ' + str(throw))
+                sys.stdout.flush()
+
+            # DB SPLIT (only between batches, so that photons are never split among dumps)
+            if self.db_split and throw - dumped_throws >= self.split_num and throw < self.throws:
+                dumped_throws = throw
+                self.split_database()
+
+            # CONVERGENCE (checked at the first batch end after each multiple of block_size photons)
+            if self.target_error is not None and throw // self.block_size > (throw - size) // self.block_size and \
+                    self.check_convergence():
+                break
+
+            # CHECKPOINT (between batches as well)
+            if self.checkpoint_interval and throw - checkpointed >= self.checkpoint_interval and throw < self.throws:
+                dumped_throws = checkpointed = throw
+                self.save_checkpoint(throw)
+
+        self.save_database()
+        if self.profiler is not None:
+            self.profiler.end(throw, self.total_steps)
+
+    def profile_stages(self):
+        """
+        Returns the stages timed by profile=True as (owner, attribute, stage name) tuples (see StageProfiler)
+        """
+        name = type(self).__name__
+        database = type(self.database).__name__
+        # Sources without photons() are traced one photon at a time (see trace_block)
+        emit = 'photons' if hasattr(self.source, 'photons') else 'photon'
+        return [(self, 'trace_arrays', name + '.trace_arrays'),
+                (self, 'surface_events', name + '.surface_events'),
+                (self, 'log_steps', name + '.log_steps'),
+                (self, 'save_database', name + '.save_database'),
+                (self.source, emit, type(self.source).__name__ + '.' + emit),
+                (self.arrays, 'intervals', '_SceneArrays.intervals'),
+                (self.arrays, 'absorption_table', '_SceneArrays.absorption_table'),
+                (self.database, 'log_batch', database + '.log_batch'),
+                (self.database, 'end_photons', database + '.end_photons')]
+
+    def trace_block(self, first, count):
+        """
+        Traces count photons, numbered from first, in batches of batch_size
+
+        :param first: number of the first photon
+        :param count: number of photons to be traced
+        """
+        for offset in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - offset)
+            self.scene.log.debug("Emitting photons " + str(first + offset) + " to " + str(first + offset + size - 1))
+            if hasattr(self.source, 'photons'):
+                pid, position, direction, wavelength, _ = self.source.photons(size)
+                self.trace_arrays(pid, position, direction, wavelength, self.source.source_id)
+            else:
+                self.trace_batch([self.source.photon() for _ in range(size)])
+
+    def trace_batch(self, photons):
+        """
+        Traces a list of photons (as created by the light source) until they are lost, exit the scene or are killed.
+
+        :param photons: list of Photon objects
+        """
+        if len(photons) == 0:
+            return
+        self.trace_arrays(np.array([photon.id for photon in photons], dtype=int),
+                          np.array([photon.position for photon in photons], dtype=float),
+                          np.array([photon.direction for photon in photons], dtype=float),
+                          np.array([photon.wavelength for photon in photons], dtype=float), photons[0].source)
+
+    def trace_arrays(self, pid, position, direction, wavelength, source_id=None):
+        """
+        Traces a batch of photons given as arrays (as returned by the photons() method of the light sources).
+
+        :param pid: photon ids (n)
+        :param position: positions of emission (n, 3)
+        :param direction: directions of emission (n, 3), normalised here
+        :param wavelength: wavelengths (n)
+        :param source_id: id of the light source, logged with the photons
+        """
+        arrays = self.arrays
+        n = len(pid)
+        if n == 0:
+            return
+        self.source_id = source_id
+
+        pid = np.array(pid, dtype=int)
+        position = np.array(position, dtype=float)
+        direction = np.array(direction, dtype=float)
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+        wavelength = np.array(wavelength, dtype=float)
+        absorption_counter = np.zeros(n, dtype=int)
+        intersection_counter = np.zeros(n, dtype=int)
+        container = -np.ones(n, dtype=int)
+        on_surface = -np.ones(n, dtype=int)
+        exit_device = -np.ones(n, dtype=int)
+        exit_face = -np.ones(n, dtype=int)
+        exit_normal = np.zeros((n, 3))
+        # Objects whose surface holds the photon (used to skip the self-intersection at t=0)
+        surface_mask = np.zeros((n, arrays.count), dtype=bool)
+
+        step = 0
+        while n > 0 and step < self.steps:
+            self.log_steps(pid, wavelength, position, direction, absorption_counter, intersection_counter,
+                           container, on_surface, exit_device, exit_face, exit_normal)
+
+            t_near, t_far, face_near, face_far = arrays.intervals(position, direction)
+            endpoints = np.hstack((t_near, t_far))
+            threshold = np.where(np.hstack((surface_mask, surface_mask)), SURFACE_TOLERANCE, TOLERANCE)
+            candidates = np.where(endpoints > threshold, endpoints, np.inf)
+            t_hit = candidates.min(axis=1)
+
+            # Container: innermost object (the one whose surface is closest) containing the path midpoint
+            middle = (0.5 * t_hit)[:, None]
+            inside = (t_near < middle) & (middle < t_far)
+            current = np.where(inside, t_far, np.inf).argmin(axis=1)
+            current[~inside.any(axis=1)] = arrays.bounds
+            container = current
+
+            # Absorption along the path in the container
+            sampled = np.full(n, np.inf)
+            cumulatives = {}
+            for index in np.unique(container):
+                if not arrays.components[index]:
+                    continue
+                selected = container == index
+                cumulative = arrays.absorption_table(index, wavelength[selected])
+                cumulatives[index] = cumulative
+                with np.errstate(divide='ignore'):
+                    sampled[selected] = -np.log(1. - np.random.uniform(size=selected.sum())) / cumulative[:, -1]
+            absorbed = sampled < t_hit
+
+            active = np.ones(n, dtype=bool)
+            lost = np.zeros(n, dtype=bool)
+            sunk = np.zeros(n, dtype=bool)
+            reaction = np.zeros(n, dtype=bool)
+
+            # Absorption (and possibly re-emission) in the volume
+            for index in cumulatives:
+                selected = np.flatnonzero(absorbed & (container == index))
+                if len(selected) == 0:
+                    continue
+                cumulative = cumulatives[index][absorbed[container == index]]
+                position[selected] += sampled[selected, None] * direction[selected]
+                absorption_counter[selected] += 1
+                on_surface[selected] = -1
+                exit_device[selected] = index
+                exit_face[selected] = -1
+                surface_mask[selected] = False
+
+                # Absorber chosen with probability proportional to its absorption coefficient
+                absorber = CompositeMaterial.select_absorbers(cumulative, np.random.uniform(size=len(selected)))
+                for k, material in enumerate(arrays.components[index]):
+                    emitting = selected[absorber == k]
+                    if len(emitting) == 0:
+                        continue
+                    emitted = np.random.uniform(size=len(emitting)) < material.quantum_efficiency
+                    active[emitting[~emitted]] = False
+                    lost[emitting[~emitted]] = True
+                    emitting = emitting[emitted]
+                    if len(emitting) == 0:
+                        continue
+                    # Red-shifted emission (see Material.emission_wavelength)
+                    wavelength[emitting] = material.emission_data.sample(above=wavelength[emitting])
+                    direction[emitting] = _isotropic_directions(len(emitting))
+            reaction[lost] = arrays.is_channel[container[lost]]
+
+            # Photons reaching a surface
+            moving = np.flatnonzero(~absorbed)
+            hit_object = np.full(n, -1)
+            hit_object[moving] = candidates[moving].argmin(axis=1) % arrays.count
+            escaped = moving[(hit_object[moving] == arrays.bounds) | np.isinf(t_hit[moving])]
+            active[escaped] = False
+            moving = moving[active[moving]]
+            position[moving] += t_hit[moving, None] * direction[moving]
+
+            # RayBin erases the photon
+            sinking = moving[arrays.is_sink[hit_object[moving]]]
+            active[sinking] = False
+            sunk[sinking] = True
+            container[sinking] = hit_object[sinking]
+
+            interface = moving[active[moving]]
+            if len(interface):
+                self.surface_events(interface, t_hit, hit_object, t_near, t_far, face_near, face_far, position,
+                                    direction, container, on_surface, exit_device, exit_face, exit_normal,
+                                    surface_mask, intersection_counter)
+
+            # Terminal rows (photons lost in the volume or absorbed by a RayBin)
+            terminal = np.flatnonzero(lost | sunk)
+            if len(terminal):
+                exit_device[terminal] = container[terminal]
+                self.log_steps(pid[terminal], wavelength[terminal], position[terminal], direction[terminal],
+                               absorption_counter[terminal], intersection_counter[terminal], container[terminal],
+                               on_surface[terminal], exit_device[terminal], -np.ones(len(terminal), dtype=int),
+                               exit_normal[terminal], active=False, reaction=reaction[terminal])
+
+            step += 1
+            self.total_steps += n
+            if step >= self.steps:
+                # Photons bouncing around in a locked path are killed
+                self.killed += n
+                self.log_steps(pid, wavelength, position, direction, absorption_counter, intersection_counter,
+                               container, on_surface, exit_device, exit_face, exit_normal, active=active,
+                               killed=True, reaction=reaction)
+                self.scene.log.debug("   * Reached Max Steps * (" + str(n) + " photons)")
+
+            # The last logged steps are the endpoints of the photons leaving the batch
+            self.database.end_photons(pid[~active].tolist())
+            keep = np.flatnonzero(active)
+            pid, wavelength, position, direction = pid[keep], wavelength[keep], position[keep], direction[keep]
+            absorption_counter, intersection_counter = absorption_counter[keep], intersection_counter[keep]
+            container, on_surface = container[keep], on_surface[keep]
+            exit_device, exit_face, exit_normal = exit_device[keep], exit_face[keep], exit_normal[keep]
+            surface_mask = surface_mask[keep]
+            n = len(keep)
+
+        # Killed photons
+        self.database.end_photons(pid.tolist())
+
+    def surface_events(self, interface, t_hit, hit_object, t_near, t_far, face_near, face_far, position, direction,
+                       container, on_surface, exit_device, exit_face, exit_normal, surface_mask,
+                       intersection_counter):
+        """
+        Applies Fresnel reflection/refraction to the photons that reached an interface (arrays updated in place).
+
+        Like in Photon.trace() the surface normal is the one of the container, if the photon is leaving it, or the
+        one of the object entered otherwise. The exit_device is the container unless the photon has refracted into
+        an object through a surface the container does not share.
+        """
+        arrays = self.arrays
+        rows = np.arange(len(interface))
+        t = t_hit[interface, None]
+        near = t_near[interface]
+        far = t_far[interface]
+        on_near = np.abs(near - t) <= TOLERANCE
+        on_far = np.abs(far - t) <= TOLERANCE
+        touched = on_near | on_far
+        face = np.where(on_near, face_near[interface], face_far[interface])
+
+        # Medium after the interface (innermost object containing the midpoint of the next segment)
+        ahead = np.where(np.hstack((near, far)) > t + TOLERANCE, np.hstack((near, far)), np.inf).min(axis=1)
+        middle = np.where(np.isinf(ahead), t[:, 0] + 1., 0.5 * (t[:, 0] + ahead))[:, None]
+        inside = (near < middle) & (middle < far)
+        following = np.where(inside, far, np.inf).argmin(axis=1)
+        following[~inside.any(axis=1)] = arrays.bounds
+
+        current = container[interface]
+        leaving = touched[rows, current]
+        surface = np.where(leaving, current, np.where(touched[rows, following], following, hit_object[interface]))
+
+        normal = np.zeros((len(interface), 3))
+        for index in np.unique(surface):
+            selected = surface == index
+            normal[selected] = arrays.normals(index, position[interface[selected]], face[selected, index])
+
+        incident = direction[interface]
+        n1 = arrays.refractive_index[current]
+        n2 = arrays.refractive_index[following]
+        dot = np.einsum('ij,ij->i', incident, normal)
+        reflected = np.random.uniform(size=len(interface)) < _fresnel_reflection(np.abs(dot), n1, n2)
+
+        new_direction = np.where(reflected[:, None], incident - 2. * dot[:, None] * normal,
+                                 _fresnel_refraction(normal, incident, n1, n2))
+        direction[interface] = new_direction
+        exit_index = np.where(reflected, np.where(current == arrays.bounds, surface, current),
+                              np.where(leaving, current, surface))
+        container[interface] = np.where(reflected, current, following)
+        on_surface[interface] = surface
+        intersection_counter[interface] += 1
+        surface_mask[interface] = touched
+
+        exit_on = touched[rows, exit_index]
+        exit_device[interface] = exit_index
+        exit_face[interface] = np.where(exit_on, face[rows, exit_index], -1)
+        for index in np.unique(exit_index[exit_on]):
+            selected = exit_on & (exit_index == index)
+            exit_normal[interface[selected]] = arrays.normals(index, position[interface[selected]],
+                                                              face[selected, index])
+
+    def log_steps(self, pid, wavelength, position, direction, absorption_counter, intersection_counter, container,
+                  on_surface, exit_device, exit_face, exit_normal, active=True, killed=False, reaction=False):
+        """
+        Saves the current state of the photons in the DB, with the same information logged by Tracer.start().
+        """
+        arrays = self.arrays
+        names = arrays.names + [None]
+        on_exit_surface = exit_face >= 0
+        outward = np.einsum('ij,ij->i', direction, exit_normal) > 0
+        surface_id = [arrays.faces[device][face] if on_exit else None
+                      for device, face, on_exit in zip(exit_device, exit_face, on_exit_surface)]
+        bound = np.where(on_exit_surface, np.where(outward, 'Out', 'In'), None)
+        # Surface normal at acute angle with the photon direction (see Box.surface_normal)
+        normal = np.where(outward[:, None], exit_normal, -exit_normal)
+        self.database.log_batch(pid, wavelength, position, direction, absorption_counter, intersection_counter,
+                                active, killed, reaction, source=self.source_id,
+                                container_obj=[names[i] for i in container],
+                                on_surface_obj=[names[i] for i in on_surface], surface_id=surface_id,
+                                ray_direction_bound=bound, surface_normal=normal)
@@ -11,25 +11,190 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from pvtrace.Geometry import Box, Cylinder, Ray, cmp_points, separation
+from pvtrace.Geometry import Box, Cylinder, Hit, Ray, Transformable, cmp_floats, cmp_floats_array, cmp_points, \
+    first_interval, forward_hits, hit_points, transform_bounds, transform_version
 from pvtrace.external.transformations import translation_matrix, rotation_matrix
 import pvtrace.external.transformations as tf
 import numpy as np
 
 
-def transform_point(point, transform):
-    return np.array(np.dot(transform,
-                           np.matrix(np.concatenate((point, [1.]))).transpose()).transpose()[0, 0:3]).squeeze()
+def merge_hit_intervals(intervals_one, intervals_two, operation):
+    """
+    Boolean combination of the hit intervals of two shapes along a ray (scalar version of merge_intervals()).
+
+    The entry and exit events of the two shapes, each already sorted along the ray, are merged and swept once
+    (linear time in the number of hits) keeping the shapes the ray is in. Faces in common are treated as in
+    merge_intervals().
+
+    :param intervals_one: hit_intervals() of the first shape
+    :param intervals_two: hit_intervals() of the second shape
+    :param operation: 'union', 'difference' (first shape minus the second) or 'intersection'
+    :return: list of ((entry Hit, shape), (exit Hit, shape)) sorted along the ray, shape is 0 for the first shape and
+    1 for the second
+    """
+    if operation not in ('union', 'difference', 'intersection'):
+        raise ValueError("Unknown CSG operation " + str(operation))
+    # Events (t, 0 for entries and 1 for exits, Hit) of each shape
+    events = ([], [])
+    for shape, intervals in enumerate((intervals_one, intervals_two)):
+        for entry, exit in intervals:
+            # Intervals with a non-finite end (NaN or inf) are skipped, as the missed shapes of merge_intervals()
+            if not (-np.inf < entry.t < np.inf and -np.inf < exit.t < np.inf):
+                continue
+            events[shape].append((entry.t, 0, entry))
+            events[shape].append((exit.t, 1, exit))
+
+    inside = [False, False]
+    intervals = []
+    entry = None
+    i = [0, 0]
+    while i[0] < len(events[0]) or i[1] < len(events[1]):
+        # Next event along the ray, at the same t entries come before exits
+        if i[1] == len(events[1]):
+            shape = 0
+        elif i[0] == len(events[0]):
+            shape = 1
+        else:
+            first, second = events[0][i[0]], events[1][i[1]]
+            shape = 0 if first[0] < second[0] or (first[0] == second[0] and first[1] <= second[1]) else 1
+        t, kind, hit = events[shape][i[shape]]
+        i[shape] += 1
+
+        inside[shape] = kind == 0
+        if operation == 'union':
+            state = inside[0] or inside[1]
+        elif operation == 'difference':
+            state = inside[0] and not inside[1]
+        else:
+            state = inside[0] and inside[1]
+
+        if state and entry is None:
+            if operation == 'union' and len(intervals) > 0 and cmp_floats(intervals[-1][1][0].t, t):
+                # Touching the previous interval (face in common): joined
+                entry = intervals.pop()[0]
+            else:
+                entry = (hit, shape)
+        elif not state and entry is not None:
+            # Zero-length intervals between faces of the two shapes are dropped, tangent rays are kept
+            if operation == 'union' or entry[1] == shape or not cmp_floats(entry[0].t, t):
+                intervals.append((entry, (hit, shape)))
+            entry = None
+    return intervals
 
 
-def transform_direction(direction, transform):
-    angle, axis, point = tf.rotation_from_matrix(transform)
-    rotation_transform = tf.rotation_matrix(angle, axis)
-    return np.array(np.dot(rotation_transform,
-                           np.matrix(np.concatenate((direction, [1.]))).transpose()).transpose()[0, 0:3]).squeeze()
+def csg_intervals(csg, intervals, names, signs):
+    """
+    Returns the hit intervals of a CSG object from the merged intervals of its shapes (see merge_hit_intervals())
+
+    :param csg: CSG object (CSGadd, CSGsub or CSGint)
+    :param intervals: merge_hit_intervals() of the two shapes, hits in the local frame of the CSG object
+    :param names: names of the two shapes in the surface identifiers (e.g. ('ADDone', 'ADDtwo'))
+    :param signs: sign of the normals of the two shapes (-1 where the outward normal of the CSG object is the inward
+    one of the shape)
+    :return: list of (entry Hit, exit Hit) in global frame
+    """
+    converted = []
+    for (entry, entry_shape), (exit, exit_shape) in intervals:
+        csg_entry = Hit(entry.t, csg.to_global(entry.point), csg.reference + "_" + names[entry_shape] + "_" +
+                        entry.face, signs[entry_shape] * csg.to_global_direction(entry.normal))
+        if exit is entry:
+            csg_exit = csg_entry
+        else:
+            csg_exit = Hit(exit.t, csg.to_global(exit.point), csg.reference + "_" + names[exit_shape] + "_" +
+                           exit.face, signs[exit_shape] * csg.to_global_direction(exit.normal))
+        converted.append((csg_entry, csg_exit))
+    return converted
 
-   
-class CSGadd(object):
+
+def pack_events(mask, arrays, fills):
+    """
+    Moves the masked items of each row of the arrays to the left (in order), the other items are replaced by fill
+
+    :param mask: (n, m) bool array
+    :param arrays: sequence of (n, m) arrays
+    :param fills: fill value of each array
+    :return: list of (n, k) arrays, k is the largest number of masked items in a row (at least 1)
+    """
+    n = len(mask)
+    width = max(int(mask.sum(axis=1).max()), 1) if n > 0 else 1
+    rows, columns = np.nonzero(mask)
+    positions = (np.cumsum(mask, axis=1) - 1)[rows, columns]
+    packed = []
+    for array, fill in zip(arrays, fills):
+        result = np.full((n, width), fill, dtype=array.dtype)
+        result[rows, positions] = array[rows, columns]
+        packed.append(result)
+    return packed
+
+
+def merge_intervals(intervals_one, intervals_two, operation, offset):
+    """
+    Boolean combination of the ray intervals of two shapes (see ray_intervals() in Geometry), the rays are swept
+    along their entry and exit events counting the shapes they are in.
+
+    Faces in common (e.g. two boxes touching) are not surfaces of the combination: intervals of a union touching
+    within the tolerance of cmp_floats are joined, zero-length intervals of an intersection or difference between
+    faces of the two shapes are dropped.
+
+    :param intervals_one: ray_intervals() of the first shape
+    :param intervals_two: ray_intervals() of the second shape
+    :param operation: 'union', 'difference' (first shape minus the second) or 'intersection'
+    :param offset: added to the faces of the second shape (number of faces of the first shape)
+    :return: ray_intervals() of the combination, faces of the first shape followed by the ones of the second
+    """
+    t_in_one, t_out_one, face_in_one, face_out_one = intervals_one
+    t_in_two, t_out_two, face_in_two, face_out_two = intervals_two
+    n, k_one = t_in_one.shape
+    k_two = t_in_two.shape[1]
+
+    # Events sorted along the rays, at the same t entries come before exits
+    times = np.concatenate((t_in_one, t_in_two, t_out_one, t_out_two), axis=1)
+    faces = np.concatenate((face_in_one, face_in_two + offset, face_out_one, face_out_two + offset), axis=1)
+    source = np.concatenate((np.zeros(k_one, dtype=int), np.ones(k_two, dtype=int), np.zeros(k_one, dtype=int),
+                             np.ones(k_two, dtype=int)))
+    step = np.concatenate((np.ones(k_one + k_two, dtype=int), -np.ones(k_one + k_two, dtype=int)))
+    order = np.argsort(times, axis=1, kind='mergesort')
+    rows = np.arange(n)[:, None]
+    times = times[rows, order]
+    faces = faces[rows, order]
+    source = source[order]
+    # Missed shapes (t is inf) have no events
+    step = np.where(np.isfinite(times), step[order], 0)
+
+    inside_one = np.cumsum(np.where(source == 0, step, 0), axis=1) > 0
+    inside_two = np.cumsum(np.where(source == 1, step, 0), axis=1) > 0
+    if operation == 'union':
+        inside = inside_one | inside_two
+    elif operation == 'difference':
+        inside = inside_one & ~inside_two
+    elif operation == 'intersection':
+        inside = inside_one & inside_two
+    else:
+        raise ValueError("Unknown CSG operation " + str(operation))
+    before = np.zeros_like(inside)
+    before[:, 1:] = inside[:, :-1]
+
+    t_entry, face_entry, source_entry = pack_events(inside & ~before, (times, faces, source), (np.inf, -1, -1))
+    t_exit, face_exit, source_exit = pack_events(~inside & before, (times, faces, source), (np.inf, -1, -1))
+
+    if operation == 'union':
+        # Intervals touching (face in common) are joined
+        joined = cmp_floats_array(t_entry[:, 1:], t_exit[:, :-1])
+        keep_entry = np.isfinite(t_entry)
+        keep_entry[:, 1:] &= ~joined
+        keep_exit = np.isfinite(t_exit)
+        keep_exit[:, :-1] &= ~joined
+        t_entry, face_entry = pack_events(keep_entry, (t_entry, face_entry), (np.inf, -1))
+        t_exit, face_exit = pack_events(keep_exit, (t_exit, face_exit), (np.inf, -1))
+    else:
+        # Zero-length intervals between faces of the two shapes (face in common), tangent rays are kept
+        keep = np.isfinite(t_entry) & ~(cmp_floats_array(t_entry, t_exit) & (source_entry != source_exit))
+        t_entry, t_exit, face_entry, face_exit = pack_events(keep, (t_entry, t_exit, face_entry, face_exit),
+                                                             (np.inf, np.inf, -1, -1))
+    return t_entry, t_exit, face_entry, face_exit
+
+
+class CSGadd(Transformable):
 
     """
     Constructive Solid Geometry Boolean Addition
@@ -54,12 +219,25 @@ class CSGadd(object):
         self.ADDone.transform = tr.concatenate_matrices(new_transform, self.ADDone.transform)
         self.ADDtwo.transform = tr.concatenate_matrices(new_transform, self.ADDtwo.transform)
         
+    def transform_version(self):
+        """Returns a value that changes every time the transform of the CSG object or of its shapes is set"""
+        return (Transformable.transform_version(self), transform_version(self.ADDone), transform_version(self.ADDtwo))
+
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box (global frame) enclosing the shape"""
+        # Union of the bounding boxes of the two shapes, moved by the CSG transform
+        bounds_one = self.ADDone.bounding_box()
+        bounds_two = self.ADDtwo.bounding_box()
+        if bounds_one is None or bounds_two is None:
+            return None
+        return transform_bounds(np.minimum(bounds_one[0], bounds_two[0]), np.maximum(bounds_one[1], bounds_two[1]),
+                                self.transform)
+
     def contains(self, point):
         """
         Returns True if ray contained by CSGadd, False otherwise
         """
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(point, inv_transform)
+        local_point = self.to_local(point)
         
         bool1 = self.ADDone.contains(local_point)
         bool2 = self.ADDtwo.contains(local_point)
@@ -78,102 +256,35 @@ class CSGadd(object):
         """
         Returns the intersection points of ray with CSGadd in global frame
         """
+        return hit_points(self.hits(ray))
 
-        # We will need the inv_transform later when we return the results..."
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_ray = Ray()
-
-        local_ray.position = transform_point(ray.position, inv_transform)
-        local_ray.direction = transform_direction(ray.direction, inv_transform)
-
-        ADDone__intersections = self.ADDone.intersection(local_ray)
-        ADDtwo__intersections = self.ADDtwo.intersection(local_ray)
-
-        """
-        Cover the simpler cases
-        """
-        if ADDone__intersections is None and ADDtwo__intersections is None:
-            return None  
-
+    def hits(self, ray):
         """
-        Change ..._intersections into tuples
+        Returns the hit records of ray with CSGadd in global frame (sorted along the ray)
         """
-        if ADDone__intersections is not None:
-            for i in range(0, len(ADDone__intersections)):
-                point = ADDone__intersections[i]
-                new_point = (point[0], point[1], point[2])
-                ADDone__intersections[i] = new_point
-                
-        if ADDtwo__intersections is not None:
-            for i in range(0, len(ADDtwo__intersections)):
-                point = ADDtwo__intersections[i]
-                new_point = (point[0], point[1], point[2])
-                ADDtwo__intersections[i] = new_point
-
-        """
-        Only intersection points NOT contained in resp. other structure relevant
-        """
-        ADDone_intersections = []
-        ADDtwo_intersections = []
-
-        if ADDone__intersections is not None:
-            for i in range(0, len(ADDone__intersections)):
-                if not self.ADDtwo.contains(ADDone__intersections[i]):
-                    ADDone_intersections.append(ADDone__intersections[i])
-
-        if ADDtwo__intersections is not None:
-            for j in range(0, len(ADDtwo__intersections)):
-                if not self.ADDone.contains(ADDtwo__intersections[j]):
-                    ADDtwo_intersections.append(ADDtwo__intersections[j])
-
-        """
-        => Convert to list
-        """
-        ADDone_set = set(ADDone_intersections[:])
-        ADDtwo_set = set(ADDtwo_intersections[:])
-        combined_set = ADDone_set | ADDtwo_set
-        combined_intersections = list(combined_set)
+        return forward_hits(self.hit_intervals(ray))
 
+    def hit_intervals(self, ray):
         """
-        Just in case...
-        """
-        if len(combined_intersections) == 0:
-            return None
+        Returns the intervals of the ray line inside CSGadd in global frame: union of the intervals of the two shapes
+        (a face in common, e.g. two boxes joined at one face, is not a surface)
 
-        """
-        Sort by separation from ray origin
-        """
-        intersection_separations = []
-        for point in combined_intersections:
-            intersection_separations.append(separation(ray.position, point))
+        Rays running along a face of the shapes:
 
+        >>> csg = CSGadd(Box((1, 1, 0), (2, 2, 7)), Box((0, 0, 0), (3, 3, 5)))
+        >>> [(float(entry.t), float(exit.t), exit.face) for entry, exit in
+        ...  csg.hit_intervals(Ray((2, 2.5, 1), (0, -1, 0)))]
+        [(-0.5, 2.5, 'CSGadd_ADDtwo_near')]
+        >>> csg = CSGadd(Box((0, 0, 0), (1, 1, 1)), Box((1, 0, 0), (2, 1, 1)))
+        >>> csg.hit_intervals(Ray((1, 1.5, -1.5), (0, -1, 0))), csg.hits(Ray((1, 1.5, -1.5), (0, -1, 0)))
+        ([], None)
         """
-        Convert into Numpy arrays in order to sort
-        """
-                                            
-        intersection_separations = np.array(intersection_separations)
-        sorted_indices = intersection_separations.argsort()
-        sorted_combined_intersections = []
-        for index in sorted_indices:
-            sorted_combined_intersections.append(np.array(combined_intersections[index]))
-
-        global_frame_intersections = []
-        for point in sorted_combined_intersections:
-            global_frame_intersections.append(transform_point(point, self.transform))
-
-        global_frame_intersections_cleared = []
-        for point in global_frame_intersections:
-            if self.on_surface(point):
-                """
-                This is only necessary if the two objects have an entire surface region in common,
-                for example consider two boxes joined at one face.
-                """
-                global_frame_intersections_cleared.append(point)
-
-        if len(global_frame_intersections_cleared) == 0:
-            return None
-                
-        return global_frame_intersections_cleared
+        local_ray = Ray()
+        local_ray.position = self.to_local(ray.position)
+        local_ray.direction = self.to_local_direction(ray.direction)
+        intervals = merge_hit_intervals(self.ADDone.hit_intervals(local_ray), self.ADDtwo.hit_intervals(local_ray),
+                                        'union')
+        return csg_intervals(self, intervals, ('ADDone', 'ADDtwo'), (1., 1.))
 
     def on_surface(self, point):
         """
@@ -183,8 +294,7 @@ class CSGadd(object):
         if self.contains(point):
             return False
 
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(point, inv_transform)
+        local_point = self.to_local(point)
         
         bool1 = self.ADDone.on_surface(local_point)
         bool2 = self.ADDtwo.on_surface(local_point)
@@ -201,6 +311,43 @@ class CSGadd(object):
         else:
             return False
 
+    def getFaceNames(self):
+        """Returns the surface identifiers of the faces of the array methods (faces of ADDone then of ADDtwo)"""
+        return tuple(self.reference + "_ADDone_" + face for face in self.ADDone.face_names) + \
+            tuple(self.reference + "_ADDtwo_" + face for face in self.ADDtwo.face_names)
+
+    face_names = property(getFaceNames)
+
+    def contains_points(self, points):
+        """Array version of contains()"""
+        local_points = self.to_local(points)
+        one_inside = self.ADDone.contains_points(local_points)
+        two_inside = self.ADDtwo.contains_points(local_points)
+        return one_inside | two_inside | (self.ADDone.on_surface_points(local_points) &
+                                          self.ADDtwo.on_surface_points(local_points))
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        local_points = self.to_local(points)
+        one_on = self.ADDone.on_surface_points(local_points)
+        two_on = self.ADDtwo.on_surface_points(local_points)
+        one_inside = self.ADDone.contains_points(local_points)
+        two_inside = self.ADDtwo.contains_points(local_points)
+        contained = one_inside | two_inside | (one_on & two_on)
+        return ~contained & ((one_on & ~two_inside) | (two_on & ~one_inside))
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits(): union of the intervals of the two shapes (see merge_intervals())"""
+        local_origins = self.to_local(origins)
+        local_directions = self.to_local_direction(directions)
+        return merge_intervals(self.ADDone.ray_intervals(local_origins, local_directions),
+                               self.ADDtwo.ray_intervals(local_origins, local_directions), 'union',
+                               len(self.ADDone.face_names))
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
+
     def surface_identifier(self, surface_point, assert_on_surface=True):
         """
         Returns surface-ID name if surface_point located on CSGadd surface
@@ -210,8 +357,7 @@ class CSGadd(object):
         Ensure surface_point on CSGadd surface
         """
 
-        invtransform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(surface_point, invtransform)
+        local_point = self.to_local(surface_point)
 
         bool1 = self.ADDone.on_surface(local_point)
         bool2 = self.ADDtwo.on_surface(local_point)
@@ -242,10 +388,9 @@ class CSGadd(object):
         Ensure surface_point on CSGint surface
         """
 
-        inv_transform = tf.inverse_matrix(self.transform)
         local_ray = Ray()
-        local_ray.position = transform_point(ray.position, inv_transform)
-        local_ray.direction = transform_direction(ray.direction, inv_transform)
+        local_ray.position = self.to_local(ray.position)
+        local_ray.direction = self.to_local_direction(ray.direction)
 
         bool1 = self.ADDone.on_surface(local_ray.position)
         bool2 = self.ADDtwo.on_surface(local_ray.position)
@@ -261,14 +406,14 @@ class CSGadd(object):
 
         if bool1 is True and self.ADDtwo.contains(local_ray.position) == False:
             local_normal = self.ADDone.surface_normal(local_ray, acute)
-            return transform_direction(local_normal, self.transform)
+            return self.to_global_direction(local_normal)
 
         if bool2 is True and self.ADDone.contains(local_ray.position) == False:
             local_normal = self.ADDtwo.surface_normal(local_ray, acute)
-            return transform_direction(local_normal, self.transform)
+            return self.to_global_direction(local_normal)
                                              
 
-class CSGsub(object):
+class CSGsub(Transformable):
     """
     Constructive Solid Geometry Boolean Subtraction
     """
@@ -293,13 +438,25 @@ class CSGsub(object):
     def append_transform(self, new_transform):
         self.transform = tf.concatenate_matrices(new_transform, self.transform)
     
+    def transform_version(self):
+        """Returns a value that changes every time the transform of the CSG object or of its shapes is set"""
+        return (Transformable.transform_version(self), transform_version(self.SUBplus),
+                transform_version(self.SUBminus))
+
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box (global frame) enclosing the shape"""
+        # The subtraction is enclosed by the positive shape
+        bounds = self.SUBplus.bounding_box()
+        if bounds is None:
+            return None
+        return transform_bounds(bounds[0], bounds[1], self.transform)
+
     def contains(self, point):
         """
         Returns True if ray contained by CSGsub, False otherwise
         """
 
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(point, inv_transform)
+        local_point = self.to_local(point)
         
         bool1 = self.SUBplus.contains(local_point)
         bool2 = self.SUBminus.contains(local_point)
@@ -317,111 +474,32 @@ class CSGsub(object):
         """
         Returns the intersection points of ray with CSGsub in global frame
         """
+        return hit_points(self.hits(ray))
 
-        # We will need the invtransform later when we return the results..."
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_ray = Ray()
-
-        local_ray.position = transform_point(ray.position, inv_transform)
-        local_ray.direction = transform_direction(ray.direction, inv_transform)
-        
-        SUBplus__intersections = self.SUBplus.intersection(local_ray)
-        SUBminus__intersections = self.SUBminus.intersection(local_ray)
-                  
-        """
-        Cover the simpler cases
-        """
-        if SUBplus__intersections is None and SUBminus__intersections is None:
-            return None  
-         
-        """
-        Change ..._intersections into tuples
-        """
-        if SUBplus__intersections is not None:
-            for i in range(0, len(SUBplus__intersections)):
-                point = SUBplus__intersections[i]
-                new_point = (point[0], point[1], point[2])
-                SUBplus__intersections[i] = new_point
-
-        if SUBminus__intersections is not None:
-            for i in range(0, len(SUBminus__intersections)):
-                point = SUBminus__intersections[i]
-                new_point = (point[0], point[1], point[2])
-                SUBminus__intersections[i] = new_point
-        
-        """
-        Valid intersection points:
-        SUBplus intersections must lie outside SUBminus
-        SUBminus intersections must lie inside SUBplus
-        """
-        
-        SUBplus_intersections = []
-        SUBminus_intersections = []
-
-        if SUBplus__intersections is not None:
-            for intersection in SUBplus__intersections:
-                if not self.SUBminus.contains(intersection):
-                    SUBplus_intersections.append(intersection)
-
-        if SUBminus__intersections is not None:
-            for intersection in SUBminus__intersections:
-                if self.SUBplus.contains(intersection):
-                    SUBminus_intersections.append(intersection)
-            
-        # SUBplus_set = set(SUBplus_intersections[:])
-        # SUBminus_set = set(SUBminus_intersections[:])
-        # combined_set = SUBplus_set ^ SUBminus_set
-        # combined_intersections = list(combined_set)
-        
-        combined_intersections = np.array(list(set(SUBplus_intersections+SUBminus_intersections)))
-        
-        # intersection_separations = combined_intersections[0]**2+combined_intersections[1]**2+combined_intersections[2]**2
+    def hits(self, ray):
         """
-        Just in case...
+        Returns the hit records of ray with CSGsub in global frame (sorted along the ray)
         """
-        if len(combined_intersections) == 0:
-            return None
-        
-        transposed_intersections = combined_intersections.transpose()
-        
-        intersection_vectors = transposed_intersections[0]-ray.position[0],\
-                               transposed_intersections[1]-ray.position[1], transposed_intersections[2]-ray.position[2]
-        
-        # intersection_separations= []
-        # print combined_intersections, point, intersection_vectors
-              
-        intersection_separations = intersection_vectors[0]**2+intersection_vectors[1]**2+intersection_vectors[2]**2
-        
-        # for point in combined_intersections:
-        #     intersection_separations.append(separation(ray.position, point))
-
-        # for i in range(len(intersection_separations)):
-        #     print intersection_separations[i], intersection_separations2[i]
+        return forward_hits(self.hit_intervals(ray))
 
+    def hit_intervals(self, ray):
         """
-        Sort by distance from ray origin => Use Numpy arrays
+        Returns the intervals of the ray line inside CSGsub in global frame: intervals of SUBplus minus the ones of
+        SUBminus (the outward normal of CSGsub on SUBminus is the inward one of SUBminus)
         """
-        # intersection_separations = np.array(intersection_separations)
-        sorted_combined_intersections = combined_intersections[intersection_separations.argsort()]
-        # sorted_combined_intersections = []
-        #         for index in sorted_indices:
-        #             sorted_combined_intersections.append(np.array(combined_intersections[index]))
-        
-        # global_frame_intersections = []
-        # for point in sorted_combined_intersections:
-        #     global_frame_intersections.append(transform_point(point, self.transform))
+        local_ray = Ray()
+        local_ray.position = self.to_local(ray.position)
+        local_ray.direction = self.to_local_direction(ray.direction)
+        intervals = merge_hit_intervals(self.SUBplus.hit_intervals(local_ray), self.SUBminus.hit_intervals(local_ray),
+                                        'difference')
+        return csg_intervals(self, intervals, ('SUBplus', 'SUBminus'), (1., -1.))
 
-        global_frame_intersections = [transform_point(point, self.transform) for point in sorted_combined_intersections]
-        
-        return global_frame_intersections
-            
     def on_surface(self, point):
         """
         Returns True if the point is on the outer or inner surface of the CSGsub, and False othewise.
         """
 
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(point, inv_transform)
+        local_point = self.to_local(point)
         
         bool1 = self.SUBplus.on_surface(local_point)
         bool2 = self.SUBminus.on_surface(local_point)
@@ -444,12 +522,41 @@ class CSGsub(object):
             return True   
         """
         
+    def getFaceNames(self):
+        """Returns the surface identifiers of the faces of the array methods (faces of SUBplus then of SUBminus)"""
+        return tuple(self.reference + "_SUBplus_" + face for face in self.SUBplus.face_names) + \
+            tuple(self.reference + "_SUBminus_" + face for face in self.SUBminus.face_names)
+
+    face_names = property(getFaceNames)
+
+    def contains_points(self, points):
+        """Array version of contains()"""
+        local_points = self.to_local(points)
+        return self.SUBplus.contains_points(local_points) & ~self.SUBminus.contains_points(local_points)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        local_points = self.to_local(points)
+        return (self.SUBplus.on_surface_points(local_points) & ~self.SUBminus.contains_points(local_points)) | \
+            (self.SUBminus.on_surface_points(local_points) & self.SUBplus.contains_points(local_points))
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits(): difference of the intervals of the two shapes (see merge_intervals())"""
+        local_origins = self.to_local(origins)
+        local_directions = self.to_local_direction(directions)
+        return merge_intervals(self.SUBplus.ray_intervals(local_origins, local_directions),
+                               self.SUBminus.ray_intervals(local_origins, local_directions), 'difference',
+                               len(self.SUBplus.face_names))
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
+
     def surface_identifier(self, surface_point, assert_on_surface=True):
         """
         Returns a unique identifier for the surface location on the CSGsub.
         """
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(surface_point, inv_transform)
+        local_point = self.to_local(surface_point)
         
         bool1 = self.SUBplus.on_surface(local_point)
         bool2 = self.SUBminus.on_surface(local_point)
@@ -473,10 +580,9 @@ class CSGsub(object):
         Return the surface normal for a ray arriving on the CSGsub surface.
         """
 
-        inv_transform = tf.inverse_matrix(self.transform)
         local_ray = Ray()
-        local_ray.position = transform_point(ray.position, inv_transform)
-        local_ray.direction = transform_direction(ray.direction, inv_transform)
+        local_ray.position = self.to_local(ray.position)
+        local_ray.direction = self.to_local_direction(ray.direction)
         
         bool1 = self.SUBplus.on_surface(local_ray.position)
         bool2 = self.SUBminus.on_surface(local_ray.position)
@@ -503,7 +609,7 @@ class CSGsub(object):
                 return normal
 
 
-class CSGint(object):
+class CSGint(Transformable):
     """
     Constructive Solid Geometry Boolean Intersection
     """
@@ -525,13 +631,26 @@ class CSGint(object):
     def append_transform(self, new_transform):
         self.transform = tf.concatenate_matrices(new_transform, self.transform)
 
+    def transform_version(self):
+        """Returns a value that changes every time the transform of the CSG object or of its shapes is set"""
+        return (Transformable.transform_version(self), transform_version(self.INTone), transform_version(self.INTtwo))
+
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box (global frame) enclosing the shape"""
+        # Overlap of the bounding boxes of the two shapes, moved by the CSG transform
+        bounds_one = self.INTone.bounding_box()
+        bounds_two = self.INTtwo.bounding_box()
+        if bounds_one is None or bounds_two is None:
+            return None
+        return transform_bounds(np.maximum(bounds_one[0], bounds_two[0]), np.minimum(bounds_one[1], bounds_two[1]),
+                                self.transform)
+
     def contains(self, point):
         """
         Returns True if ray contained by CSGint, False otherwise
         """
 
-        invtransform = tf.inverse_matrix(self.transform)
-        point = transform_point(point, invtransform)
+        point = self.to_local(point)
         
         bool1 = self.INTone.contains(point)
         bool2 = self.INTtwo.contains(point)
@@ -546,98 +665,31 @@ class CSGint(object):
         """
         Returns the intersection points of ray with CSGint in global frame
         """
+        return hit_points(self.hits(ray))
 
-        # We will need the inv_transform later when we return the results..."
-        inv_transform = tf.inverse_matrix(self.transform)
-
-        local_ray = Ray()
-
-        local_ray.position = transform_point(ray.position, inv_transform)
-        local_ray.direction = transform_direction(ray.direction, inv_transform)
-
-        INTone__intersections = self.INTone.intersection(local_ray)
-        INTtwo__intersections = self.INTtwo.intersection(local_ray)
-
-        """
-        Cover the simpler cases
-        """
-        if INTone__intersections is None and INTtwo__intersections is None:
-            return None  
-                                    
+    def hits(self, ray):
         """
-        Change ..._intersections into tuples
+        Returns the hit records of ray with CSGint in global frame (sorted along the ray)
         """
-        if INTone__intersections is not None:
-            for i in range(0, len(INTone__intersections)):
-                point = INTone__intersections[i]
-                new_point = (point[0], point[1], point[2])
-                INTone__intersections[i] = new_point
-
-        if INTtwo__intersections is not None:
-            for i in range(0, len(INTtwo__intersections)):
-                point = INTtwo__intersections[i]
-                new_point = (point[0], point[1], point[2])
-                INTtwo__intersections[i] = new_point
+        return forward_hits(self.hit_intervals(ray))
 
+    def hit_intervals(self, ray):
         """
-        Only intersection points contained in resp. other structure relevant
+        Returns the intervals of the ray line inside CSGint in global frame: overlap of the intervals of the two shapes
         """
-        INTone_intersections = []
-        INTtwo_intersections = []
-
-        if INTone__intersections is not None:
-            for i in range(0, len(INTone__intersections)):
-                if self.INTtwo.contains(INTone__intersections[i]):
-                    INTone_intersections.append(INTone__intersections[i])
-
-        if INTtwo__intersections is not None:
-            for j in range(0, len(INTtwo__intersections)):
-                if self.INTone.contains(INTtwo__intersections[j]):
-                    INTtwo_intersections.append(INTtwo__intersections[j])
-
-        """
-        => Convert to list
-        """
-        INTone_set = set(INTone_intersections[:])
-        INTtwo_set = set(INTtwo_intersections[:])
-        combined_set = INTone_set | INTtwo_set
-        combined_intersections = list(combined_set)
-
-        """
-        Just in case...
-        """
-        if len(combined_intersections) == 0:
-            return None
-
-        """
-        Sort by separation from ray origin
-        """
-        intersection_separations = []
-        for point in combined_intersections:
-            intersection_separations.append(separation(ray.position, point))
-
-        """
-        Convert into Numpy arrays in order to sort
-        """
-        intersection_separations = np.array(intersection_separations)
-        sorted_indices = intersection_separations.argsort()
-        sorted_combined_intersections = []
-        for index in sorted_indices:
-            sorted_combined_intersections.append(np.array(combined_intersections[index]))
-
-        global_frame_intersections = []
-        for point in sorted_combined_intersections:
-            global_frame_intersections.append(transform_point(point, self.transform))
-
-        return global_frame_intersections
+        local_ray = Ray()
+        local_ray.position = self.to_local(ray.position)
+        local_ray.direction = self.to_local_direction(ray.direction)
+        intervals = merge_hit_intervals(self.INTone.hit_intervals(local_ray), self.INTtwo.hit_intervals(local_ray),
+                                        'intersection')
+        return csg_intervals(self, intervals, ('INTone', 'INTtwo'), (1., 1.))
 
     def on_surface(self, point):
         """
         Returns True or False dependent on whether point on CSGint surface or not
         """
 
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(point, inv_transform)
+        local_point = self.to_local(point)
         
         bool1 = self.INTone.on_surface(local_point)
         bool2 = self.INTtwo.on_surface(local_point)
@@ -654,6 +706,38 @@ class CSGint(object):
         else:
             return False
 
+    def getFaceNames(self):
+        """Returns the surface identifiers of the faces of the array methods (faces of INTone then of INTtwo)"""
+        return tuple(self.reference + "_INTone_" + face for face in self.INTone.face_names) + \
+            tuple(self.reference + "_INTtwo_" + face for face in self.INTtwo.face_names)
+
+    face_names = property(getFaceNames)
+
+    def contains_points(self, points):
+        """Array version of contains()"""
+        local_points = self.to_local(points)
+        return self.INTone.contains_points(local_points) & self.INTtwo.contains_points(local_points)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        local_points = self.to_local(points)
+        one_on = self.INTone.on_surface_points(local_points)
+        two_on = self.INTtwo.on_surface_points(local_points)
+        return (one_on & two_on) | (one_on & self.INTtwo.contains_points(local_points)) | \
+            (two_on & self.INTone.contains_points(local_points))
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits(): intersection of the intervals of the two shapes (see merge_intervals())"""
+        local_origins = self.to_local(origins)
+        local_directions = self.to_local_direction(directions)
+        return merge_intervals(self.INTone.ray_intervals(local_origins, local_directions),
+                               self.INTtwo.ray_intervals(local_origins, local_directions), 'intersection',
+                               len(self.INTone.face_names))
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
+
     def surface_identifier(self, surface_point, assert_on_surface=True):
         """
         Returns surface-ID name if surface_point located on CSGint surface
@@ -663,8 +747,7 @@ class CSGint(object):
         Ensure surface_point on CSGint surface
         """
         
-        inv_transform = tf.inverse_matrix(self.transform)
-        local_point = transform_point(surface_point, inv_transform)
+        local_point = self.to_local(surface_point)
         
         bool1 = self.INTone.on_surface(local_point)
         bool2 = self.INTtwo.on_surface(local_point)
@@ -693,10 +776,9 @@ class CSGint(object):
         Ensure surface_point on CSGint surface
         """
 
-        inv_transform = tf.inverse_matrix(self.transform)
         local_ray = Ray()
-        local_ray.position = transform_point(ray.position, inv_transform)
-        local_ray.direction = transform_direction(ray.direction, inv_transform)
+        local_ray.position = self.to_local(ray.position)
+        local_ray.direction = self.to_local_direction(ray.direction)
         
         bool1 = self.INTone.on_surface(local_ray.position)
         bool2 = self.INTtwo.on_surface(local_ray.position)
@@ -22,6 +22,208 @@ import pvtrace.external.transformations as tf
 from pvtrace.Materials import *
 
 
+# Surface side codes of the bound column of SurfaceLog (None: photon lost or logged in the volume)
+SURFACE_SIDES = (None, "outbound", "inbound")
+
+
+class SurfaceLog(object):
+    """
+    Photons logged by a Register on one of its surfaces (or lost in its volume), see Register.log().
+
+    The entries are kept as growable typed columns (position, wavelength, surface side and re-absorptions), doubled in
+    size when full, instead of a list of tuples. With entries=False only the histograms needed by Register.count(),
+    spectrum() and reabs() are kept (wavelength counts per 1 nm bin and re-absorption counts, per surface side), so
+    the memory does not grow with the number of photons.
+    Indexing and iterating yield the (position, wavelength, bound, re-absorptions) tuples of the former list store.
+    """
+
+    def __init__(self, entries=True, capacity=64):
+        """
+        :param entries: keep every entry (True) or only the histograms (False)
+        :param capacity: initial size of the columns
+        """
+        super(SurfaceLog, self).__init__()
+        self.entries = entries
+        self.size = 0
+        if entries:
+            self.position = np.empty((capacity, 3))
+            self.wavelength = np.empty(capacity)
+            self.bound = np.empty(capacity, dtype=np.int8)
+            self.absorptions = np.empty(capacity, dtype=np.int32)
+        else:
+            # Per bound code: {wavelength bin (nm): counts}, {re-absorptions: counts} and [min, max] wavelength
+            self.wavelength_counts = [{} for _ in SURFACE_SIDES]
+            self.absorption_counts = [{} for _ in SURFACE_SIDES]
+            self.limits = [[np.inf, -np.inf] for _ in SURFACE_SIDES]
+
+    def grow(self, size):
+        """ Enlarges the columns to hold at least size entries """
+        capacity = len(self.wavelength)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for column in ('position', 'wavelength', 'bound', 'absorptions'):
+            old = getattr(self, column)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def append(self, position, wavelength, bound, absorption_counter):
+        """
+        Logs a photon
+
+        :param position: photon position
+        :param wavelength: photon wavelength (nm)
+        :param bound: "outbound", "inbound" or None
+        :param absorption_counter: photon re-absorptions
+        """
+        code = SURFACE_SIDES.index(bound)
+        if self.entries:
+            if self.size == len(self.wavelength):
+                self.grow(self.size + 1)
+            self.position[self.size] = position
+            self.wavelength[self.size] = wavelength
+            self.bound[self.size] = code
+            self.absorptions[self.size] = absorption_counter
+        else:
+            nm = int(math.floor(wavelength))
+            self.wavelength_counts[code][nm] = self.wavelength_counts[code].get(nm, 0) + 1
+            self.absorption_counts[code][absorption_counter] = \
+                self.absorption_counts[code].get(absorption_counter, 0) + 1
+            limits = self.limits[code]
+            limits[0] = min(limits[0], wavelength)
+            limits[1] = max(limits[1], wavelength)
+        self.size += 1
+
+    def extend(self, log):
+        """
+        Adds the photons of another log (e.g. of a worker process)
+
+        :param log: SurfaceLog or sequence of (position, wavelength, bound, re-absorptions) tuples (former store)
+        """
+        if not isinstance(log, SurfaceLog):
+            for entry in log:
+                self.append(*entry)
+            return
+        if not log.entries:
+            if self.entries:
+                raise ValueError("A log with histograms only cannot be added to a log of entries")
+            for code in range(len(SURFACE_SIDES)):
+                for counts, other in ((self.wavelength_counts[code], log.wavelength_counts[code]),
+                                      (self.absorption_counts[code], log.absorption_counts[code])):
+                    for key, value in other.items():
+                        counts[key] = counts.get(key, 0) + value
+                self.limits[code] = [min(self.limits[code][0], log.limits[code][0]),
+                                     max(self.limits[code][1], log.limits[code][1])]
+            self.size += log.size
+        elif not self.entries:
+            for entry in log:
+                self.append(*entry)
+        else:
+            self.grow(self.size + log.size)
+            for column in ('position', 'wavelength', 'bound', 'absorptions'):
+                getattr(self, column)[self.size:self.size + log.size] = getattr(log, column)[:log.size]
+            self.size += log.size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not self.entries:
+            raise ValueError("Only the histograms of the photons are kept in this log")
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("SurfaceLog index out of range")
+        return (list(self.position[index]), float(self.wavelength[index]), SURFACE_SIDES[self.bound[index]],
+                int(self.absorptions[index]))
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def __repr__(self):
+        if self.entries:
+            return repr(list(self))
+        return "SurfaceLog(" + str(self.size) + " photons, histograms only)"
+
+    def __getstate__(self):
+        # The unused part of the columns is not pickled
+        state = dict(self.__dict__)
+        if self.entries:
+            for column in ('position', 'wavelength', 'bound', 'absorptions'):
+                state[column] = state[column][:self.size].copy()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.entries and len(self.wavelength) == 0:
+            self.grow(1)
+
+    def codes(self, bound='all'):
+        """ Returns the bound codes selected by bound ('all': any surface side) """
+        return range(len(SURFACE_SIDES)) if bound == 'all' else (SURFACE_SIDES.index(bound),)
+
+    def count(self, bound='all'):
+        """
+        Returns the number of photons logged
+
+        :param bound: "outbound", "inbound" or None (lost), 'all' (default) for any surface side
+        """
+        if bound == 'all':
+            return self.size
+        code = SURFACE_SIDES.index(bound)
+        if self.entries:
+            return int(np.count_nonzero(self.bound[:self.size] == code))
+        return sum(self.absorption_counts[code].values())
+
+    def wavelength_histogram(self, bound='all'):
+        """
+        Returns the wavelength counts per 1 nm bin as (minimum, maximum, first bin, counts), None if no photons
+
+        :param bound: "outbound", "inbound" or None (lost), 'all' (default) for any surface side
+        """
+        if self.entries:
+            wavelengths = self.wavelength[:self.size]
+            if bound != 'all':
+                wavelengths = wavelengths[self.bound[:self.size] == SURFACE_SIDES.index(bound)]
+            if len(wavelengths) == 0:
+                return None
+            bins = np.floor(wavelengths).astype(int)
+            first = bins.min()
+            return wavelengths.min(), wavelengths.max(), first, np.bincount(bins - first)
+        codes = [code for code in self.codes(bound) if self.wavelength_counts[code]]
+        if len(codes) == 0:
+            return None
+        first = min(min(self.wavelength_counts[code]) for code in codes)
+        counts = np.zeros(max(max(self.wavelength_counts[code]) for code in codes) - first + 1, dtype=int)
+        for code in codes:
+            for nm, value in self.wavelength_counts[code].items():
+                counts[nm - first] += value
+        return (min(self.limits[code][0] for code in codes), max(self.limits[code][1] for code in codes), first,
+                counts)
+
+    def absorption_histogram(self, bound='all'):
+        """
+        Returns the photon counts per number of re-absorptions (array, index is the number of re-absorptions)
+
+        :param bound: "outbound", "inbound" or None (lost), 'all' (default) for any surface side
+        """
+        if self.entries:
+            absorptions = self.absorptions[:self.size]
+            if bound != 'all':
+                absorptions = absorptions[self.bound[:self.size] == SURFACE_SIDES.index(bound)]
+            return np.bincount(absorptions)
+        counts = np.zeros(0, dtype=int)
+        for code in self.codes(bound):
+            for absorptions, value in self.absorption_counts[code].items():
+                if absorptions >= len(counts):
+                    counts = np.concatenate((counts, np.zeros(absorptions + 1 - len(counts), dtype=int)))
+                counts[absorptions] += value
+        return counts
+
+
 class Register(object):
     """
     A class that will register photon position and wavelength. Device objects are subclasses of register.
@@ -30,23 +232,38 @@ class Register(object):
     def __init__(self):
         super(Register, self).__init__()
         self.store = dict()
-        # Dictionary whose keys are surface_identifiers. The items are
-        # arrays where each index is a tuple containing ray statistics
-        # as indicated in self.log()
+        # Dictionary whose keys are surface_identifiers (or 'loss', 'volume_source'). The items are SurfaceLog of
+        # the photons logged there, see self.log()
+        # If True only the histograms of the logged photons are kept (count, spectrum and reabs), not every entry
+        self.histograms_only = False
         self.logger = logging.getLogger('pvtrace.devices')
 
+    def surface_log(self, key):
+        """
+        Returns the SurfaceLog of key in the store, created if needed
+        """
+        log = self.store.get(key)
+        if log is None:
+            log = self.store[key] = SurfaceLog(entries=not self.histograms_only)
+        return log
+
+    def merge_store(self, store):
+        """
+        Adds the photons logged in another store (e.g. by a worker process, or a checkpoint) to the store
+
+        :param store: dict of SurfaceLog (or of lists of entry tuples) by key
+        """
+        for key, log in store.items():
+            self.surface_log(key).extend(log)
+
     def log(self, photon):
-        # Need to check that the photon is on the surface
-        if not self.shape.on_surface(photon.position):
+        # Need to check that the photon is on the surface (hit records set by photon.trace())
+        if photon.surface_hit(self) is None:
 
             if not photon.active:
                 # The photon has been non-radiatively lost inside a material
-                key = 'loss'
-                if key not in self.store:
-                    self.store[key] = []
-
-                log_entry = (list(photon.position), float(photon.wavelength), None, photon.absorption_counter)
-                self.store[key].append(log_entry)
+                self.surface_log('loss').append(photon.position, float(photon.wavelength), None,
+                                                photon.absorption_counter)
                 self.logger.debug('Photon lost')
                 return
             else:
@@ -57,34 +274,24 @@ class Register(object):
                 self.logger.warn("Active photon logged within material. Likely to be an error caused by a lightsource"
                                  "placed within the material")
 
-                key = 'volume_source'
-                if key not in self.store:
-                    self.store[key] = []
-                log_entry = (list(photon.position), float(photon.wavelength), None, photon.absorption_counter)
-                self.store['volume_source'].append(log_entry)
+                self.surface_log('volume_source').append(photon.position, float(photon.wavelength), None,
+                                                         photon.absorption_counter)
                 self.logger.debug("Logged as photon from a volume source")
                 return
 
-        # Can do this because all surface_normal with the acute flag False returns outwards facing normals.
-        normal = photon.exit_device.shape.surface_normal(photon.ray, acute=False)
-        rads = angle(normal, photon.ray.direction)
+        # Hit records have outwards facing normals.
+        hit = photon.surface_hit(photon.exit_device)
+        assert hit is not None, "The photon is not on the surface of its exit device"
 
         # If the angle between ray direction and normal is less than pi/2 than outbond, inbound otherwise
-        bound = "outbound" if rads < (np.pi / 2) else "inbound"
+        bound = "outbound" if hit.outbound(photon.direction) else "inbound"
         self.logger.debug("Photon logged as" + bound)
 
-        key = photon.exit_device.shape.surface_identifier(photon.position)
-        if key not in self.store:
-            self.store[key] = []
-
         # [0] --> position
         # [1] --> wavelength
         # [2] --> surface side (inbound or outbound)
         # [3] --> re-absorptions
-        # [4] --> total jumps
-        # [5] --> object_number
-        log_entry = (list(photon.position), float(photon.wavelength), bound, photon.absorption_counter)
-        self.store[key].append(log_entry)
+        self.surface_log(hit.face).append(photon.position, float(photon.wavelength), bound, photon.absorption_counter)
 
     def print_store(self):
         print(self.store)
@@ -98,31 +305,16 @@ class Register(object):
         key = shape.surface_identifier(surface_point)
         if key not in self.store:
             return 0.0
-        entries = self.store[key]
-        counts = 0
-        for entry in entries:
-            if entry[2] == bound:
-                counts += 1
-
-        if counts is None:
-            return 0
-        return counts
+        return self.store[key].count(bound)
 
     def count_face(self, face_name):
         """
         Returns the number of photon counts that are on the
         same surface as the surface_point for the given shape.
         """
-        entries = []
-        if face_name in self.store:
-            entries += self.store[face_name]
-        else:
-            return 0.0
-
-        counts = len(entries)
-        if counts == 0:
+        if face_name not in self.store or len(self.store[face_name]) == 0:
             return 0.0
-        return counts
+        return len(self.store[face_name])
 
     def loss(self):
         """
@@ -133,119 +325,66 @@ class Register(object):
             return 0
         return len(self.store['loss'])
 
-    def spectrum_face(self, surface_names=()):
+    @staticmethod
+    def histogram_spectrum(histograms):
         """
-        Returns the counts histogram (bins,counts) for object
-        """
-        wavelengths = []
-
-        entries = []
-        for surface in surface_names:
-            if surface in self.store:
-                entries += self.store[surface]
+        Returns the counts histogram (1 nm bins from the minimum - 1 to the maximum + 2 wavelength) as Spectrum
 
-        if len(entries) == 0:
-            return None
-
-        for entry in entries:
-            wavelengths.append(float(entry[1]))
-
-        if len(wavelengths) is 0:
+        :param histograms: SurfaceLog.wavelength_histogram() of the logs (None items are skipped)
+        """
+        histograms = [histogram for histogram in histograms if histogram is not None]
+        if len(histograms) == 0:
             return None
+        bins = np.arange(np.floor(min(histogram[0] for histogram in histograms) - 1),
+                         np.ceil(max(histogram[1] for histogram in histograms) + 2))
+        freq = np.zeros(len(bins) - 1, dtype=int)
+        for _, _, first, counts in histograms:
+            start = int(first - bins[0])
+            freq[start:start + len(counts)] += counts
+        return Spectrum(bins[0:-1], freq)
 
-        wavelengths = np.array(wavelengths)
+    @staticmethod
+    def absorption_list(histograms):
+        """
+        Returns the sum of SurfaceLog.absorption_histogram() arrays as list, with at least 10 items
+        """
+        reabs_list = np.zeros(max([10] + [len(histogram) for histogram in histograms]), dtype=int)
+        for histogram in histograms:
+            reabs_list[:len(histogram)] += histogram
+        return reabs_list.tolist()
 
-        if len(wavelengths) is 1:
-            bins = np.arange(np.floor(wavelengths[0] - 1), np.ceil(wavelengths[0] + 2))
-            freq, bins = np.histogram(wavelengths, bins=bins)
-        else:
-            bins = np.arange(np.floor(wavelengths.min() - 1), np.ceil(wavelengths.max() + 2))
-            freq, bins = np.histogram(wavelengths, bins=bins)
-        return Spectrum(bins[0:-1], freq)
+    def spectrum_face(self, surface_names=()):
+        """
+        Returns the counts histogram (bins,counts) for object
+        """
+        return self.histogram_spectrum([self.store[surface].wavelength_histogram() for surface in surface_names
+                                        if surface in self.store])
 
     def spectrum(self, shape, surface_point, bound):
         """
         Returns the counts histogram (bins,counts) for object
         """
-        wavelengths = []
         key = shape.surface_identifier(surface_point)
         if key not in self.store:
             return None
+        return self.histogram_spectrum([self.store[key].wavelength_histogram(bound)])
 
-        entries = self.store[key]
-        if len(entries) == 0:
-            return None
-
-        for entry in entries:
-            if entry[2] == bound:
-                wavelengths.append(float(entry[1]))
-
-        if len(wavelengths) is 0:
-            return None
-
-        wavelengths = np.array(wavelengths)
-
-        if len(wavelengths) is 1:
-            bins = np.arange(np.floor(wavelengths[0] - 1), np.ceil(wavelengths[0] + 2))
-            freq, bins = np.histogram(wavelengths, bins=bins)
-        else:
-            bins = np.arange(np.floor(wavelengths.min() - 1), np.ceil(wavelengths.max() + 2))
-            freq, bins = np.histogram(wavelengths, bins=bins)
-        return Spectrum(bins[0:-1], freq)
-
-    def reabs(self,surface_names=()):
+    def reabs(self, surface_names=()):
         """
         16/03/10: Returns list where list[i+1] contains number of surface photons that experienced i re-absorptions;
         Length of list is ten by default (=> photons with up to 9 re-absorptions recorded), but is extended if necessary
         """
-
-        entries = []
-        for surface in surface_names:
-            if surface in self.store:
-                entries += self.store[surface]
-
-        if len(entries) == 0:
-            return [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-
-        reabs_list = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-
-        for entry in entries:
-
-            number_reabs = entry[3]
-
-            # In case reabs_list is not sufficiently long...
-            if number_reabs + 1 > len(reabs_list):
-                while len(reabs_list) < number_reabs + 1:
-                    reabs_list.append(0)
-
-            reabs_list[number_reabs] += 1
-
-        return reabs_list
+        return self.absorption_list([self.store[surface].absorption_histogram() for surface in surface_names
+                                     if surface in self.store])
 
     def loss_reabs(self):
         """
         16/03/10: Returns list where list[i+1] contains number of LOST photons that experienced i re-absorptions;
         Length of list is ten by default (=> photons with up to 9 re-absorptions recorded), but is extended if necessary
         """
-
         if 'loss' not in self.store:
             return [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-
-        reabs_list = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-
-        loss_entries = self.store['loss']
-
-        for entry in loss_entries:
-
-            number_reabs = entry[3]
-
-            if number_reabs + 1 > len(reabs_list):
-                while len(reabs_list) < number_reabs + 1:
-                    reabs_list.append(0)
-
-            reabs_list[number_reabs] += 1
-
-        return reabs_list
+        return self.absorption_list([self.store['loss'].absorption_histogram()])
 
 
 class Detector(Register):
@@ -173,26 +173,42 @@ def closest_point(reference, point_list):
 
 
 def transform_point(point, transform):
-    # return equals
-    # np.array(np.dot(transform, np.matrix(np.concatenate((point, [1.]))).transpose()).transpose()[0,0:3]).squeeze()
-    # assert isinstance( transform, np.matrix )
-    transform = np.asmatrix(transform)
-    homogeneous_point = np.matrix([point[0], point[1], point[2], 1.]).transpose()
-    homogeneous_point = transform * homogeneous_point
-    transformed_point = np.asarray(homogeneous_point)
-    return transformed_point[0:3, 0]
+    """
+    Applies a 4x4 transformation matrix to a point (plain matrix product, no homogeneous 4-vectors)
+
+    :param point: 3D coordinates of the point
+    :param transform: 4x4 transformation matrix
+    :return: np.array with the transformed point
+    """
+    transform = np.asarray(transform)
+    return np.dot(transform[:3, :3], point) + transform[:3, 3]
 
 
 def transform_direction(direction, transform):
-    try:
-        rotation_angle, rotation_axis, point = tf.rotation_from_matrix(transform)
-    except ValueError:
-        if tf.is_same_transform(tf.identity_matrix() * -1, transform):
-            # The ray direction needs to be reversed
-            return np.array(direction) * -1.
-    rotation_transform = tf.rotation_matrix(rotation_angle, rotation_axis)
-    return np.array(np.dot(rotation_transform,
-                           np.matrix(np.concatenate((direction, [1.]))).transpose()).transpose()[0,0:3]).squeeze()
+    """
+    Applies the rotation of a 4x4 transformation matrix to a direction (the translation is ignored)
+
+    :param direction: 3D direction vector
+    :param transform: 4x4 transformation matrix (rotations and translations only)
+    :return: np.array with the rotated direction
+    """
+    return np.dot(np.asarray(transform)[:3, :3], direction)
+
+
+def transform_bounds(lower, upper, transform):
+    """
+    Returns the axis-aligned bounds (in the global frame) of a local axis-aligned box moved by transform.
+
+    :param lower: minimum corner of the box in the local frame
+    :param upper: maximum corner of the box in the local frame
+    :param transform: 4x4 transformation matrix
+    :return: tuple with minimum and maximum corners of the transformed box
+    """
+    corners = np.array([[x, y, z] for x in (lower[0], upper[0]) for y in (lower[1], upper[1])
+                        for z in (lower[2], upper[2])], dtype=float)
+    transform = np.asarray(transform)
+    corners = np.dot(corners, transform[:3, :3].T) + transform[:3, 3]
+    return corners.min(axis=0), corners.max(axis=0)
 
 
 def rotation_matrix_from_vector_alignment(before, after):
@@ -245,16 +261,34 @@ class Ray(object):
     """
     A ray in the global cartesian frame.
 
-    It has two "private" attributes, __position and __direction as np.array of 3D coordinates
+    It has two "private" attributes, __position and __direction as np.array of 3D coordinates. The arrays are replaced
+    by the setters and never modified in place, so that copies of the ray (and of photons) can share them.
     """
 
+    __slots__ = ('__position', '__direction')
+
     def __init__(self, position=None, direction=None):
         if position is None:
             position = [0., 0., 0.]
         if direction is None:
             direction = [0., 0., 1.]
         self.__position = np.array(position)
-        self.__direction = np.array(direction) / np.sqrt(np.dot(direction, np.array(direction).conj()))
+        direction = np.array(direction)
+        self.__direction = direction / np.sqrt(np.dot(direction, direction.conj()))
+
+    def __copy__(self):
+        return Ray.__new__(Ray).copy_from(self)
+
+    def copy_from(self, ray):
+        """
+        Sets position and direction of this ray to the ones of ray (the arrays are shared, not copied)
+
+        :param ray: ray to be copied
+        :return: this ray
+        """
+        self.__position = ray.__position
+        self.__direction = ray.__direction
+        return self
 
     def getPosition(self):
         return self.__position
@@ -275,8 +309,6 @@ class Ray(object):
         """
         Returns True is if 'point' is behind the ray location.
 
-        Used in Scene.sort()
-
         :param point: A cartesian point
         :return: boolean
 
@@ -313,11 +345,83 @@ class Ray(object):
     direction = property(getDirection, setDirection)
     position = property(getPosition, setPosition)
 
+
+class Hit(object):
+    """
+    Hit record of a ray with the surface of a shape, as returned by shape.hits(ray).
+
+    It carries what shape.on_surface(), shape.surface_identifier() and shape.surface_normal() would compute again
+    on the intersection point, so that the tracing can use it directly.
+    """
+
+    def __init__(self, t, point, face, normal):
+        """
+        :param t: parametric distance along the ray (point = ray.position + t * ray.direction)
+        :param point: intersection point (global frame)
+        :param face: surface identifier of the face hit (as shape.surface_identifier(point), None for planes)
+        :param normal: outward surface normal in point (global frame, as shape.surface_normal(ray, acute=False))
+        """
+        super(Hit, self).__init__()
+        self.t = t
+        self.point = point
+        self.face = face
+        self.normal = normal
+
+    def __repr__(self):
+        return "Hit(" + str(self.t) + ", " + str(self.point) + ", " + str(self.face) + ", " + str(self.normal) + ")"
+
+    def surface_normal(self, direction, acute=True):
+        """
+        Returns (a copy of) the surface normal, as shape.surface_normal(ray, acute) for a ray in the hit point
+
+        :param direction: direction of the ray
+        :param acute: if True the normal is flipped, if needed, to make an acute angle with direction
+        """
+        if acute and np.dot(self.normal, direction) < 0:
+            return -self.normal
+        return np.array(self.normal, dtype=float)
+
+    def outbound(self, direction):
+        """ Returns True if direction is heading out of the surface (acute angle with the outward normal) """
+        return np.dot(self.normal, direction) > 0
+
+
+def hit_points(hits):
+    """
+    Returns the intersection points of a list of hit records (or None), see intersection() of the shapes
+
+    :param hits: list of Hit or None
+    """
+    if hits is None:
+        return None
+    return [hit.point for hit in hits]
+
+
+def forward_hits(intervals):
+    """
+    Returns the hit records ahead of the ray (t >= 0) of a list of hit intervals (see hit_intervals() of the shapes),
+    None if there are none. Zero-length intervals (the same Hit as entry and exit, e.g. planes) give one hit.
+
+    :param intervals: list of (entry Hit, exit Hit) sorted along the ray
+    """
+    hits = []
+    for entry, exit in intervals:
+        if entry.t >= 0.:
+            hits.append(entry)
+        if exit is not entry and exit.t >= 0.:
+            hits.append(exit)
+    if len(hits) == 0:
+        return None
+    return hits
+
 """
 Objects need to implement:
 
 ALL:
-intersection(self, ray)         Used in Scene.intersection()
+hits(self, ray)                 Used in Scene.hits() (list of Hit records, or None)
+intersection(self, ray)         Used in Scene.intersection() (hit_points(self.hits(ray)))
+hit_intervals(self, ray)        Used by the CSG shapes: [(entry Hit, exit Hit)] of the ray line inside the shape, sorted
+                                along the ray (t can be negative), see forward_hits()
 
 3D-shapes:
 
@@ -327,10 +431,276 @@ contains(point)
 on_surface(self, point)
 surface_identifier(self, surface_point, assert_on_surface)
 surface_normal
+
+Array versions, for n points or rays at once (e.g. BatchTracer, voxelisation), with the tolerances of the scalar ones:
+
+face_names                              surface identifiers of the faces, indexed by the face arrays below
+contains_points(points)                 contains() of (n, 3) points, bool (n,) array
+on_surface_points(points)               on_surface() of (n, 3) points, bool (n,) array
+ray_intervals(origins, directions)      (t_entry, t_exit, face_entry, face_exit) (n, k) arrays of the intervals of the
+                                        ray lines inside the shape, sorted along the rays (t is inf and face -1 for
+                                        rays with less than k intervals)
+intersect(origins, directions)          t_near, t_far, face_near, face_far (n,) arrays, first interval not behind the
+                                        origins (see first_interval())
 """
 
 
-class Plane(object):
+def cmp_floats_array(a, b):
+    """ Element-wise cmp_floats() """
+    return np.abs(np.subtract(a, b)) < 1e-12
+
+
+def smaller_array(a, b):
+    """ Element-wise cmp_floats_range(a, b) == -1 """
+    return (np.less(a, b)) & ~cmp_floats_array(a, b)
+
+
+def interval_check_array(a, b, c, strict=False):
+    """ Element-wise interval_check() """
+    check = cmp_floats_array(b, c) | ((a < b) & (b < c))
+    if not strict:
+        check |= cmp_floats_array(a, b)
+    return check
+
+
+def box_intervals(origin, direction, lower, upper):
+    """
+    Slab intersection of n rays with an axis-aligned box (local coordinates).
+
+    :param origin: (n, 3) array of ray positions
+    :param direction: (n, 3) array of ray directions
+    :param lower: box origin
+    :param upper: box extent
+    :return: t_near, t_far, face_near, face_far (t is inf where the ray misses the box, faces index Box.face_names)
+    """
+    n = len(origin)
+    rows = np.arange(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1. / direction
+        t1 = (lower - origin) * inverse
+        t2 = (upper - origin) * inverse
+    t_low = np.minimum(t1, t2)
+    t_high = np.maximum(t1, t2)
+    parallel = direction == 0
+    if parallel.any():
+        inside = (origin >= lower) & (origin <= upper)
+        t_low = np.where(parallel, np.where(inside, -np.inf, np.inf), t_low)
+        t_high = np.where(parallel, np.where(inside, np.inf, -np.inf), t_high)
+    axis_near = np.argmax(t_low, axis=1)
+    axis_far = np.argmin(t_high, axis=1)
+    t_near = t_low[rows, axis_near]
+    t_far = t_high[rows, axis_far]
+    # Face index is axis + 3 for the faces on the extent side (see Box.surface_identifier)
+    face_near = axis_near + 3 * (direction[rows, axis_near] < 0)
+    face_far = axis_far + 3 * (direction[rows, axis_far] > 0)
+    miss = ~(t_near <= t_far)
+    t_near[miss] = np.inf
+    t_far[miss] = np.inf
+    return t_near, t_far, face_near, face_far
+
+
+def box_interval(position, direction, lower, upper):
+    """
+    Scalar version of box_intervals() for a single ray, with the same arithmetic and the same handling of the
+    directions parallel to the faces (the ray line is inside the slab if its position is, faces included).
+
+    :param position: ray position (local coordinates)
+    :param direction: ray direction (local coordinates)
+    :param lower: box origin
+    :param upper: box extent
+    :return: t_near, t_far, face_near, face_far (faces index Box.face_names), None where the ray misses the box
+    """
+    t_near = -np.inf
+    t_far = np.inf
+    face_near = face_far = 0
+    for axis in range(3):
+        step = direction[axis]
+        if step == 0:
+            if not lower[axis] <= position[axis] <= upper[axis]:
+                return None
+            continue
+        inverse = 1. / step
+        t_low = (lower[axis] - position[axis]) * inverse
+        t_high = (upper[axis] - position[axis]) * inverse
+        if t_low > t_high:
+            t_low, t_high = t_high, t_low
+        # Ties go to the first axis, as argmax/argmin in box_intervals()
+        if t_low > t_near:
+            t_near = t_low
+            face_near = axis + 3 * (step < 0)
+        if t_high < t_far:
+            t_far = t_high
+            face_far = axis + 3 * (step > 0)
+    if not t_near <= t_far:
+        return None
+    return t_near, t_far, face_near, face_far
+
+
+def cylinder_intervals(origin, direction, radius, length):
+    """
+    Intersection of n rays with a z-aligned cylinder of given radius and length (local coordinates).
+
+    :return: t_near, t_far, face_near, face_far (faces index Cylinder.face_names, t is inf where the ray misses)
+    """
+    a = direction[:, 0] ** 2 + direction[:, 1] ** 2
+    b = 2. * (origin[:, 0] * direction[:, 0] + origin[:, 1] * direction[:, 1])
+    c = origin[:, 0] ** 2 + origin[:, 1] ** 2 - radius ** 2
+    discriminant = b ** 2 - 4. * a * c
+    # Parallel to the axis as in Cylinder.hits() (cross product of the directions shorter than 1e-12)
+    parallel = cmp_floats_array(np.sqrt(a), 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(np.maximum(discriminant, 0.))
+        t_hull_1 = (-b - root) / (2. * a)
+        t_hull_2 = (-b + root) / (2. * a)
+    missed = (discriminant < 0) & ~parallel
+    t_hull_1 = np.where(missed, np.inf, t_hull_1)
+    t_hull_2 = np.where(missed, -np.inf, t_hull_2)
+    t_hull_1 = np.where(parallel, np.where(c <= 0, -np.inf, np.inf), t_hull_1)
+    t_hull_2 = np.where(parallel, np.where(c <= 0, np.inf, -np.inf), t_hull_2)
+
+    dz = direction[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = -origin[:, 2] / dz
+        t2 = (length - origin[:, 2]) / dz
+    t_z_1 = np.minimum(t1, t2)
+    t_z_2 = np.maximum(t1, t2)
+    flat = dz == 0
+    inside_z = (origin[:, 2] >= 0) & (origin[:, 2] <= length)
+    t_z_1 = np.where(flat, np.where(inside_z, -np.inf, np.inf), t_z_1)
+    t_z_2 = np.where(flat, np.where(inside_z, np.inf, -np.inf), t_z_2)
+
+    hull_near = t_hull_1 >= t_z_1
+    hull_far = t_hull_2 <= t_z_2
+    t_near = np.where(hull_near, t_hull_1, t_z_1)
+    t_far = np.where(hull_far, t_hull_2, t_z_2)
+    face_near = np.where(hull_near, 0, np.where(dz > 0, 1, 2))
+    face_far = np.where(hull_far, 0, np.where(dz > 0, 2, 1))
+    miss = ~(t_near <= t_far)
+    t_near[miss] = np.inf
+    t_far[miss] = np.inf
+    return t_near, t_far, face_near, face_far
+
+
+def sphere_intervals(origin, direction, centre, radius):
+    """
+    Intersection of n rays with a sphere.
+
+    :return: t_near, t_far, face_near, face_far (faces are always 0, t is inf where the ray misses)
+    """
+    offset = origin - centre
+    a = np.einsum('ij,ij->i', direction, direction)
+    b = 2. * np.einsum('ij,ij->i', direction, offset)
+    c = np.einsum('ij,ij->i', offset, offset) - radius ** 2
+    discriminant = b ** 2 - 4. * a * c
+    # Tangent rays have a single solution, as in Sphere.hits()
+    root = np.where(cmp_floats_array(discriminant, 0.), 0., np.sqrt(np.maximum(discriminant, 0.)))
+    t_near = (-b - root) / (2. * a)
+    t_far = (-b + root) / (2. * a)
+    miss = discriminant < 0
+    t_near[miss] = np.inf
+    t_far[miss] = np.inf
+    faces = np.zeros(len(origin), dtype=int)
+    return t_near, t_far, faces, faces
+
+
+def transform_version(shape):
+    """
+    Returns the transform_version() of a shape, None for the shapes without transform (e.g. Sphere, Polygon)
+    """
+    version = getattr(shape, 'transform_version', None)
+    return None if version is None else version()
+
+
+def single_interval(t_near, t_far, face_near, face_far):
+    """
+    Returns the interval of a convex shape (box_intervals(), cylinder_intervals(), ...) as ray_intervals() (n, 1)
+    arrays, faces are -1 where the ray misses the shape
+    """
+    miss = np.isinf(t_near)
+    return (t_near[:, None], t_far[:, None], np.where(miss, -1, face_near)[:, None],
+            np.where(miss, -1, face_far)[:, None])
+
+
+def first_interval(intervals):
+    """
+    Returns the first of the ray_intervals() of each ray that is not behind its origin (t_exit >= 0), as
+    t_near, t_far, face_near, face_far (n,) arrays. t_near is negative if the origin is inside the shape, t is inf
+    and face -1 where there are no intervals ahead.
+
+    :param intervals: ray_intervals() of a shape
+    """
+    t_entry, t_exit, face_entry, face_exit = intervals
+    rows = np.arange(len(t_entry))
+    ahead = (t_exit >= 0.) & np.isfinite(t_exit)
+    index = np.argmax(ahead, axis=1)
+    found = ahead[rows, index]
+    return (np.where(found, t_entry[rows, index], np.inf), np.where(found, t_exit[rows, index], np.inf),
+            np.where(found, face_entry[rows, index], -1), np.where(found, face_exit[rows, index], -1))
+
+
+class Transformable(object):
+    """
+    Base class of the shapes moved into the global frame by a 4x4 transformation matrix (self.transform).
+
+    The rotation (3x3) and translation parts of the transform and of its inverse are cached, so that points and
+    directions are moved between the local and the global frame with plain matrix products. The cache is reset every
+    time the transform is set (e.g. by append_transform()), in-place changes of the matrix elements are not detected.
+    Points can be 3D coordinates or (n, 3) arrays of coordinates.
+    """
+
+    # Number of times the transform has been set (see transform_version())
+    __version = 0
+
+    def getTransform(self):
+        return self.__transform
+
+    def setTransform(self, transform):
+        self.__transform = np.array(transform, dtype=float)
+        # Transposed, so that the same product works for single points and (n, 3) arrays
+        self.__rotation = np.ascontiguousarray(self.__transform[:3, :3].T)
+        self.__translation = self.__transform[:3, 3].copy()
+        self.__inverse = None
+        self.__version += 1
+
+    transform = property(getTransform, setTransform)
+
+    def transform_version(self):
+        """
+        Returns a value that changes every time the transform of the shape is set (e.g. by append_transform()), used
+        by Scene to rebuild its bounding volume hierarchy when the shapes are moved
+        """
+        return self.__version
+
+    def inverse_transform(self):
+        """Returns the (cached) inverse of the transformation matrix"""
+        if self.__inverse is None:
+            self.__inverse = tf.inverse_matrix(self.__transform)
+            self.__inverse_rotation = np.ascontiguousarray(self.__inverse[:3, :3].T)
+            self.__inverse_translation = self.__inverse[:3, 3].copy()
+        return self.__inverse
+
+    def to_local(self, point):
+        """Moves point(s) from the global frame to the local frame of the shape"""
+        if self.__inverse is None:
+            self.inverse_transform()
+        return np.dot(point, self.__inverse_rotation) + self.__inverse_translation
+
+    def to_local_direction(self, direction):
+        """Rotates direction(s) from the global frame to the local frame of the shape"""
+        if self.__inverse is None:
+            self.inverse_transform()
+        return np.dot(direction, self.__inverse_rotation)
+
+    def to_global(self, point):
+        """Moves point(s) from the local frame of the shape to the global frame"""
+        return np.dot(point, self.__rotation) + self.__translation
+
+    def to_global_direction(self, direction):
+        """Rotates direction(s) from the local frame of the shape to the global frame"""
+        return np.dot(direction, self.__rotation)
+
+
+class Plane(Transformable):
     """
     An infinite plane going though the origin point along the positive z axis.
     A 4x4 transformation matrix can be applied to generate other planes.
@@ -343,13 +713,18 @@ class Plane(object):
         """
         super(Plane, self).__init__()
 
+        if transform is None:
+            transform = tf.identity_matrix()
         self.transform = transform
-        if self.transform is None:
-            self.transform = tf.identity_matrix()
 
     def append_transform(self, new_transform):
         self.transform = np.dot(self.transform, new_transform)
 
+    @staticmethod
+    def bounding_box():
+        """Planes are not bounded (see BoundingVolumeHierarchy)"""
+        return None
+
     @staticmethod
     def contains(point):
         return False
@@ -361,8 +736,7 @@ class Plane(object):
         :param point: 3D coordinates of the point to be checked for position on surface
         :return: boolean
         """
-        inv_transform = tf.inverse_matrix(self.transform)
-        rpos = transform_point(point, inv_transform)
+        rpos = self.to_local(point)
         if cmp_floats(rpos, 0.):
             return True
         return False
@@ -372,7 +746,7 @@ class Plane(object):
         raise Exception('planar_surface')
 
     def surface_normal(self, ray, acute=True):
-        normal = transform_direction((0, 0, 1), self.transform)
+        normal = self.to_global_direction((0, 0, 1))
         rdir = ray.direction
         if acute:
             if angle(normal, rdir) > np.pi / 2:
@@ -405,11 +779,19 @@ class Plane(object):
         >>> plane.intersection(ray)
         [array([ 0.5,  0.5,  1. ])]
         
+        """
+        return hit_points(self.hits(ray))
+
+    def hits(self, ray):
+        """
+        Returns the hit record of the ray with the plane (face None, normal along the local +z). None if no hit.
+
+        :param ray: The ray to be evaluated for intersection
+        :return: list of Hit / None
         """
         # We need apply the anti-transform of the plane to the ray. This gets the ray in the local frame of the plane.
-        inv_transform = tf.inverse_matrix(self.transform)
-        ray_pos = transform_point(ray.position, inv_transform)
-        ray_dir = transform_direction(ray.direction, inv_transform)
+        ray_pos = self.to_local(ray.position)
+        ray_dir = self.to_local_direction(ray.direction)
 
         # Ray is in parallel to the plane -- there is no intersection
         if ray_dir[2] == 0.0:
@@ -422,7 +804,7 @@ class Plane(object):
 
         # Convert local frame to world frame
         point = ray_pos + t * ray_dir
-        return [transform_point(point, self.transform)]
+        return [Hit(t, self.to_global(point), None, self.to_global_direction((0, 0, 1)))]
 
 
 class FinitePlane(Plane):
@@ -446,6 +828,9 @@ class FinitePlane(Plane):
     >>> fp.intersection(Ray(position=(0, 0, 1), direction=(0, 0, -1)))
     """
 
+    # Faces of the array methods (planes have no surface identifier)
+    face_names = (None,)
+
     def __init__(self, length=1, width=1):
         super(FinitePlane, self).__init__()
         self.length = length
@@ -461,8 +846,7 @@ class FinitePlane(Plane):
         :param point: 3D coordinates of the point to be evaluated
         :return: boolean
         """
-        inv_transform = tf.inverse_matrix(self.transform)
-        position = transform_point(point, inv_transform)
+        position = self.to_local(point)
         if cmp_floats(position[2], 0.) and (0. < position[0] <= self.length) and (0. < position[1] <= self.width):
             return True
         return False
@@ -474,17 +858,67 @@ class FinitePlane(Plane):
         :param ray: Ray to intersect the plane with
         :return: point / None
         """
-                
-        points = super(FinitePlane, self).intersection(ray)
-        if points is None:
+        return hit_points(self.hits(ray))
+
+    def hits(self, ray):
+        """
+        Returns the hit record of the ray with the finite plane, None if no hit.
+
+        :param ray: Ray to intersect the plane with
+        :return: list of Hit / None
+        """
+        hits = super(FinitePlane, self).hits(ray)
+        if hits is None:
             return None
-        print(points)
         # Is point in the finite plane bounds
-        local_point = transform_point(points[0], self.transform)
+        local_point = self.to_local(hits[0].point)
         if (0. <= local_point[0] <= self.length) and (0. <= local_point[1] <= self.width):
-            return points
+            return hits
         return None
 
+    def hit_intervals(self, ray):
+        """
+        Returns the zero-length interval [(hit, hit)] where the ray line crosses the finite plane (t can be negative),
+        [] if it misses the plane
+        """
+        ray_pos = self.to_local(ray.position)
+        ray_dir = self.to_local_direction(ray.direction)
+        if ray_dir[2] == 0.0:
+            return []
+        t = -ray_pos[2] / ray_dir[2]
+        point = ray_pos + t * ray_dir
+        if (0. <= point[0] <= self.length) and (0. <= point[1] <= self.width):
+            hit = Hit(t, self.to_global(point), None, self.to_global_direction((0, 0, 1)))
+            return [(hit, hit)]
+        return []
+
+    def contains_points(self, points):
+        """Array version of contains() (planes contain no points)"""
+        return np.zeros(len(points), dtype=bool)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        local = self.to_local(points)
+        return cmp_floats_array(local[:, 2], 0.) & (0. < local[:, 0]) & (local[:, 0] <= self.length) & \
+            (0. < local[:, 1]) & (local[:, 1] <= self.width)
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits(), a zero-length interval [t, t] where the ray lines cross the finite plane"""
+        origin = self.to_local(origins)
+        direction = self.to_local_direction(directions)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = -origin[:, 2] / direction[:, 2]
+            point = origin + t[:, None] * direction
+        hit = (direction[:, 2] != 0.) & (0. <= point[:, 0]) & (point[:, 0] <= self.length) & \
+            (0. <= point[:, 1]) & (point[:, 1] <= self.width)
+        t = np.where(hit, t, np.inf)
+        faces = np.zeros(len(t), dtype=int)
+        return single_interval(t, t.copy(), faces, faces)
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
+
 
 class Polygon(object):
     """
@@ -492,6 +926,8 @@ class Polygon(object):
     Only convex polygons are allowed! Order of points is of course important!
     """
 
+    face_names = ('polygon',)
+
     def __init__(self, points):
         super(Polygon, self).__init__()
         self.pts = points
@@ -541,6 +977,11 @@ class Polygon(object):
     def surface_identifier(surface_point, assert_on_surface=True):
         return "polygon"
 
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box enclosing the polygon"""
+        points = np.array(self.pts, dtype=float)
+        return points.min(axis=0), points.max(axis=0)
+
     def surface_normal(self, ray, acute=False):
         vec1 = np.array(self.pts[0]) - np.array(self.pts[1])
         vec2 = np.array(self.pts[0]) - np.array(self.pts[2])
@@ -549,32 +990,84 @@ class Polygon(object):
 
     def intersection(self, ray):
         """Returns a intersection point with a ray and the polygon."""
+        return hit_points(self.hits(ray))
+
+    def hits(self, ray):
+        """Returns the hit record of a ray with the polygon (None if no hit)."""
+        return forward_hits(self.hit_intervals(ray))
+
+    def hit_intervals(self, ray):
+        """
+        Returns the zero-length interval [(hit, hit)] where the ray line crosses the polygon (t can be negative), []
+        if it misses the polygon
+        """
         n = self.surface_normal(ray)
 
         # Ray is parallel to the polygon
         if cmp_floats(np.dot(np.array(ray.direction), n), 0.):
-            return None
+            return []
 
         t = 1 / (np.dot(np.array(ray.direction), n)) * (
             np.dot(n, np.array(self.pts[0])) - np.dot(n, np.array(ray.position)))
 
-        # Intersection point is behind the ray
-        if t < 0.0:
-            return None
-
         # Calculate intersection point
         point = np.array(ray.position) + t * np.array(ray.direction)
 
         # Check if intersection point is really in the polygon or only on the (infinite) plane
         if self.on_surface(point):
-            return [list(point)]
-
-        return None
-
-
-class Box(object):
+            hit = Hit(t, list(point), "polygon", n)
+            return [(hit, hit)]
+
+        return []
+
+    def contains_points(self, points):
+        """Array version of contains() (polygons contain no points)"""
+        return np.zeros(len(points), dtype=bool)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface() (sum of the angles subtended by the sides)"""
+        points = np.asarray(points, dtype=float)
+        count = len(self.pts)
+        angle_sum = np.zeros(len(points))
+        node = np.zeros(len(points), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(count):
+                v1 = np.array(self.pts[i], dtype=float) - points
+                v2 = np.array(self.pts[(i + 1) % count], dtype=float) - points
+                m1 = np.sqrt(np.einsum('ij,ij->i', v1, v1))
+                m2 = np.sqrt(np.einsum('ij,ij->i', v2, v2))
+                # The point is one of the nodes
+                node |= cmp_floats_array(m1 * m2, 0.)
+                angle_sum += np.arccos(np.einsum('ij,ij->i', v1, v2) / (m1 * m2))
+        return node | cmp_floats_array(angle_sum, 2 * np.pi)
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits(), a zero-length interval [t, t] where the ray lines cross the polygon"""
+        origins = np.asarray(origins, dtype=float)
+        directions = np.asarray(directions, dtype=float)
+        n = self.surface_normal(None)
+        denominator = np.dot(directions, n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = 1 / denominator * (np.dot(n, np.array(self.pts[0])) - np.dot(origins, n))
+            # Rays parallel to the polygon miss it
+            t = np.where(cmp_floats_array(denominator, 0.), np.inf, t)
+            hit = self.on_surface_points(origins + t[:, None] * directions)
+        t = np.where(hit, t, np.inf)
+        faces = np.zeros(len(t), dtype=int)
+        return single_interval(t, t.copy(), faces, faces)
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
+
+
+class Box(Transformable):
     """An axis aligned box defined by an minimum and extend points (array/list like values)."""
 
+    # Surface identifiers of the faces on the origin (x, y, z) and on the extent (x, y, z) of the box
+    faces = (('left', 'near', 'bottom'), ('right', 'far', 'top'))
+    face_names = faces[0] + faces[1]
+
     def __init__(self, origin=(0, 0, 0), extent=(1, 1, 1)):
         super(Box, self).__init__()
         self.origin = np.array(origin)
@@ -585,6 +1078,10 @@ class Box(object):
     def append_transform(self, new_transform):
         self.transform = tf.concatenate_matrices(new_transform, self.transform)
 
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box (global frame) enclosing the box"""
+        return transform_bounds(self.origin, self.extent, self.transform)
+
     def contains(self, point):
         """
         Returns True is the point is inside the box or False if it is not or is on the surface.
@@ -609,7 +1106,7 @@ class Box(object):
         #    if not pair[0] < pair[1] < pair[2]:
         #        return False
         # return True
-        local_point = transform_point(point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(point)
         for i in range(0, 3):
             # if not (self.origin[i] < local_point[i] < self.extent[i]):
             # Want to make this comparison: self.origin[i] < local_point[i] < self.extent[i]
@@ -633,7 +1130,7 @@ class Box(object):
                 return False
 
         """ Alternative implementation:
-        local_point = transform_point(point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(point)
         def_points = np.concatenate((np.array(self.origin), np.array(self.extent)))
 
         contain_bool = True
@@ -666,7 +1163,7 @@ class Box(object):
         """
 
         # Get an axis-aligned point... then this is really easy.
-        local_point = transform_point(surface_point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(surface_point)
         # the local point must have at least one common point with the surface definition points
         def_points = np.concatenate((np.array(self.origin), np.array(self.extent)))
 
@@ -750,7 +1247,7 @@ class Box(object):
             return False
 
         # Get an axis-aligned point... then this is really easy.
-        local_point = transform_point(point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(point)
         # the local point must have at least one common point with the surface definition points
         def_points = np.concatenate((np.array(self.origin), np.array(self.extent)))
 
@@ -799,9 +1296,8 @@ class Box(object):
         assert self.on_surface(ray.position), "The point is not on the surface of the box.\n" \
                                               "This can be caused by two object sharing a face" \
                                               "(Position: " + str(ray.position) + ")"
-        inv_trans = tf.inverse_matrix(self.transform)
-        ray_pos = transform_point(ray.position, inv_trans)
-        ray_dir = transform_direction(ray.direction, inv_trans)
+        ray_pos = self.to_local(ray.position)
+        ray_dir = self.to_local_direction(ray.direction)
 
         # To define a flat surface, 3 points are needed.
         common_index = None
@@ -852,7 +1348,7 @@ class Box(object):
         for i in range(0, 3):
             if normal[i] == 0.0:
                 normal[i] = 0.0
-        return transform_direction(normal, self.transform)
+        return self.to_global_direction(normal)
 
     def intersection(self, ray):
         """Returns an array intersection points with the ray and box. If no intersection occurs
@@ -888,80 +1384,97 @@ class Box(object):
         Here I am using the the work of Amy Williams, Steve Barrus, R. Keith Morley, and
         Peter Shirley, "An Efficient and Robust Ray-Box Intersection Algorithm" Journal of
         graphics tools, 10(1):49-54, 2005"""
-        inv_trans = tf.inverse_matrix(self.transform)
-        ray_pos = transform_point(ray.position, inv_trans)
-        ray_dir = transform_direction(ray.direction, inv_trans)
-        # pts = [transform_point(self.points[0], self.transform), transform_point(self.points[1], self.transform)]
-        pts = [np.array(self.points[0]), np.array(self.points[1])]
-
-        # When ray direction components are 0 (e.g. [0,0,1]) then the inverse (1/ray_dir[x/y])
-        # might result in division by zero.
-        # This results into infinity and it's apparently handled correctly, so just ignore the error HERE
-        np.seterr(divide='ignore')
-
-        ray_inv_dir = [1.0 / ray_dir[0], 1.0 / ray_dir[1], 1.0 / ray_dir[2]]
-        ray_sign = [1.0 / ray_inv_dir[0] < 0.0, 1.0 / ray_inv_dir[1] < 0.0, 1.0 / ray_inv_dir[2] < 0.0]
-        tmin = (pts[ray_sign[0]][0] - ray_pos[0]) * ray_inv_dir[0]
-        tmax = (pts[1 - ray_sign[0]][0] - ray_pos[0]) * ray_inv_dir[0]
-        tymin = (pts[ray_sign[1]][1] - ray_pos[1]) * ray_inv_dir[1]
-        tymax = (pts[1 - ray_sign[1]][1] - ray_pos[1]) * ray_inv_dir[1]
-
-        np.seterr(divide='warn')
-
-        # Bug here: this is the exit point with bug1.py
-        if (tmin > tymax) or (tymin > tmax):
-            return None
-
-        if tymin > tmin:
-            tmin = tymin
-
-        if tymax < tmax:
-            tmax = tymax
-
-        tzmin = (pts[ray_sign[2]][2] - ray_pos[2]) * ray_inv_dir[2]
-        tzmax = (pts[1 - ray_sign[2]][2] - ray_pos[2]) * ray_inv_dir[2]
-
-        if (tmin > tzmax) or (tzmin > tmax):
-            return None
-
-        if tzmin > tmin:
-            tmin = tzmin
-
-        if tzmax < tmax:
-            tmax = tzmax
-
-        # Calculate the hit coordinates then if the solution is in the forward direction append to the hit list.
-        hit_coordinates = []
-        pt1 = ray_pos + tmin * ray_dir
-        pt2 = ray_pos + tmax * ray_dir
+        return hit_points(self.hits(ray))
 
-        # pt1_sign = np.dot(pt1, ray_dir)
-        # pt2_sign = np.dot(pt2, ray_dir)
-        # print "tmin", tmin, "tmax", tmax
-        if tmin >= 0.0:
-            hit_coordinates.append(pt1)
-
-        if tmax >= 0.0:
-            hit_coordinates.append(pt2)
+    def hits(self, ray):
+        """
+        Returns the hit records of the ray with the box (see intersection()), the face hit is the one of the slab
+        that bounds the ray interval. If no intersection occurs this function returns None.
+        """
+        return forward_hits(self.hit_intervals(ray))
 
-        # print hit_coordinates
-        if len(hit_coordinates) == 0:
-            return None
+    def hit_intervals(self, ray):
+        """
+        Returns [(entry Hit, exit Hit)] of the ray line inside the box (t can be negative), [] if it misses the box.
+        The interval is the one of box_intervals(), so that hits() agrees with intersect() on grazing rays.
 
-        # Convert hit coordinate back to the world frame
-        hit_coords_world = []
-        for point in hit_coordinates:
-            hit_coords_world.append(transform_point(point, self.transform))
-        return hit_coords_world
+        >>> box = Box(origin=(0, 0, 0), extent=(1, 2, 3))
+        >>> [(float(entry.t), float(exit.t)) for entry, exit in box.hit_intervals(Ray((1, 1, 0.5), (0, 0, 1)))]
+        [(-0.5, 2.5)]
+        >>> [float(hit.t) for hit in box.hits(Ray((0, -1.5, 2), (0, 1, 0)))]
+        [1.5, 3.5]
+        """
+        ray_pos = self.to_local(ray.position)
+        ray_dir = self.to_local_direction(ray.direction)
+        interval = box_interval(ray_pos.tolist(), ray_dir.tolist(), self.origin, self.extent)
+        if interval is None:
+            return []
+        t_near, t_far, face_near, face_far = interval
+        return [(self.face_hit(t_near, ray_pos + t_near * ray_dir, face_near),
+                 self.face_hit(t_far, ray_pos + t_far * ray_dir, face_far))]
 
+    def face_hit(self, t, local_point, face):
+        """
+        Returns the Hit of a point on a face of the box
 
-class Cylinder(object):
+        :param t: parametric distance along the ray
+        :param local_point: intersection point in the local frame
+        :param face: index of the face in Box.face_names
+        """
+        normal = np.zeros(3)
+        normal[face % 3] = 1. if face >= 3 else -1.
+        return Hit(t, self.to_global(local_point), Box.face_names[face], self.to_global_direction(normal))
+
+    def contains_points(self, points):
+        """Array version of contains()"""
+        local = self.to_local(points)
+        return np.all(smaller_array(self.origin, local) & smaller_array(local, self.extent), axis=1)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        local = self.to_local(points)
+        on_face = np.any(cmp_floats_array(self.origin, local) | cmp_floats_array(self.extent, local), axis=1)
+        within = np.all(interval_check_array(self.origin, local, self.extent), axis=1)
+        return on_face & within & ~self.contains_points(points)
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits() (see box_intervals())"""
+        return single_interval(*box_intervals(self.to_local(origins), self.to_local_direction(directions),
+                                              self.origin, self.extent))
+
+    def intersect(self, origins, directions):
+        """
+        Array version of hits(), see first_interval()
+
+        Both use the slab arithmetic of box_intervals(), also for rays grazing the faces:
+
+        >>> box = Box(origin=(0, 0, 0), extent=(1, 2, 3))
+        >>> grid = [(x / 2., y / 2., z / 2.) for x in range(-1, 4) for y in range(-1, 6) for z in range(-1, 8)]
+        >>> directions = [sign * axis for axis in np.eye(3) for sign in (1, -1)]
+        >>> rays = [(position, direction) for position in grid for direction in directions]
+        >>> t_near, t_far, face_near, face_far = box.intersect(np.array([ray[0] for ray in rays]),
+        ...                                                    np.array([ray[1] for ray in rays]))
+        >>> mismatches = 0
+        >>> for i, (position, direction) in enumerate(rays):
+        ...     ends = ((t_near[i], face_near[i]), (t_far[i], face_far[i]))
+        ...     expected = [(t, box.face_names[face]) for t, face in ends if 0 <= t < np.inf]
+        ...     hits = box.hits(Ray(position, direction)) or []
+        ...     mismatches += [(hit.t, hit.face) for hit in hits] != expected
+        >>> len(rays), mismatches
+        (1890, 0)
+        """
+        return first_interval(self.ray_intervals(origins, directions))
+
+
+class Cylinder(Transformable):
     """
     Parametrised standard representation of a cylinder. The axis is aligned along z but the radius
     and the length of the cylinder can be specified. A transformation must be applied to use 
     centered at a different location of angle.
     """
 
+    face_names = ('hull', 'base', 'cap')
+
     def __init__(self, radius=1, length=1):
         super(Cylinder, self).__init__()
         self.radius = radius
@@ -971,6 +1484,11 @@ class Cylinder(object):
     def append_transform(self, new_transform):
         self.transform = tf.concatenate_matrices(new_transform, self.transform)
 
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box (global frame) enclosing the cylinder"""
+        return transform_bounds((-self.radius, -self.radius, 0.), (self.radius, self.radius, self.length),
+                                self.transform)
+
     def contains(self, point):
         """
         Returns true if point is within cylinder (if on surface then false)
@@ -996,7 +1514,7 @@ class Cylinder(object):
         if self.on_surface(point):
             return False
 
-        local_point = transform_point(point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(point)
 
         origin_z = 0.
         xy_distance = np.sqrt(local_point[0] ** 2 + local_point[1] ** 2)
@@ -1039,9 +1557,8 @@ class Cylinder(object):
         
         """
         assert self.on_surface(ray.position), "The ray is not on the surface."
-        invtrans = tf.inverse_matrix(self.transform)
-        rpos = transform_point(ray.position, invtrans)
-        rdir = transform_direction(ray.direction, invtrans)
+        rpos = self.to_local(ray.position)
+        rdir = self.to_local_direction(ray.direction)
 
         # point on radius surface
         pt_radius = np.sqrt(rpos[0] ** 2 + rpos[1] ** 2)
@@ -1065,7 +1582,7 @@ class Cylinder(object):
             if angle(normal, rdir) > np.pi * 0.5:
                 normal *= -1
 
-        return transform_direction(normal, self.transform)
+        return self.to_global_direction(normal)
 
     def on_surface(self, point):
         """
@@ -1081,7 +1598,7 @@ class Cylinder(object):
         """
 
         """ # !!! Old version !!!
-        local_point = transform_point(point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(point)
         
         # xy-component is equal to radius
         pt_radius = np.sqrt(local_point[0]**2 + local_point[1]**2)
@@ -1100,7 +1617,7 @@ class Cylinder(object):
             return False
         """
 
-        local_point = transform_point(point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(point)
 
         origin_z = 0.
         xy_distance = np.sqrt(local_point[0] ** 2 + local_point[1] ** 2)
@@ -1123,7 +1640,7 @@ class Cylinder(object):
         :param assert_on_surface: Assert point on surface (die if false)
         :return: name of surface
         """
-        local_point = transform_point(surface_point, tf.inverse_matrix(self.transform))
+        local_point = self.to_local(surface_point)
 
         origin_z = 0.
         xy_distance = np.sqrt(local_point[0] ** 2 + local_point[1] ** 2)
@@ -1184,64 +1701,30 @@ class Cylinder(object):
         >>> cld.intersection(Ray([-5,-.5,-0.25], [1,0,0]))
         [array([-0.84779125, -0.5       , -0.25      ]), array([ 0.84779125, -0.5       , -0.25      ])]
         """
+        return hit_points(self.hits(ray))
+
+    def hits(self, ray):
+        """
+        Returns the hit records of the ray with the capped cylinder (faces 'hull', 'base' and 'cap', see
+        intersection()). None if no intersection occurs.
+        """
         # Inverse transform the ray to get it into the cylinders local frame
-        inv_transform = tf.inverse_matrix(self.transform)
-        rpos = transform_point(ray.position, inv_transform)
-        rdir = transform_direction(ray.direction, inv_transform)
+        rpos = self.to_local(ray.position)
+        rdir = self.to_local_direction(ray.direction)
         direction = np.array([0, 0, 1])
 
         normal = np.cross(rdir, direction)
         normal_magnitude = magnitude(normal)
-        # print normal_magnitude, "Normal magnitude"
 
-        if cmp_floats(normal_magnitude, .0):
+        # Local hits, as (t, point, face, normal)
+        hits = []
+        if not cmp_floats(normal_magnitude, .0):
 
-            # Ray parallel to cylinder direction
+            # Not parallel to cylinder axis: quadratic surface
             normal = norm(normal)
-            # d = abs(np.dot(rpos, direction))
-            # D = rpos - d * np.array(direction)
-            # if magnitude(D) <= self.radius:
-
-            # Axis aligned ray inside the cylinder volume only hits caps
-            # print "Inside axis aligned ray only hits caps"
-            bottom = Plane()
-            top = Plane()
-            top.transform = tf.translation_matrix([0, 0, self.length])
-            p0 = top.intersection(Ray(rpos, rdir))
-            p1 = bottom.intersection(Ray(rpos, rdir))
-            cap_intersections = []
-            if p0 is not None:
-                cap_intersections.append(p0)
-            if p1 is not None:
-                cap_intersections.append(p1)
-            points = []
-            for point in cap_intersections:
-
-                if point[0] is not None:
-                    point = point[0]
-                    point_radius = np.sqrt(point[0] ** 2 + point[1] ** 2)
-                    if point_radius <= self.radius:
-                        # print "Hit cap at point:"
-                        # print point
-                        # print ""
-                        points.append(point)
-
-            if len(points) > 0:
-                world_points = []
-                for pt in points:
-                    world_points.append(transform_point(pt, self.transform))
-                # print "Local points", points
-                # print "World points", world_points
-                return world_points
-
-            return None
-        # finish axis parallel branch
-
-        # print "Not parallel to cylinder axis."
-        # print ""
-        normal = norm(normal)
-        d = abs(np.dot(rpos, normal))
-        if d <= self.radius:
+            d = abs(np.dot(rpos, normal))
+            if d > self.radius:
+                return None
 
             # Hit quadratic surface
             O = np.cross(rpos, direction)
@@ -1254,60 +1737,111 @@ class Cylinder(object):
             t1 = t + s
             p1 = rpos + t1 * rdir
 
-            points = []
+            # Check that hit quadratic surface in the length range
             if (t0 >= 0.0) and (.0 <= p0[2] <= self.length):
-                points.append(p0)
+                hits.append((t0, p0, 'hull', norm(p0 - np.array([0, 0, p0[2]]))))
 
             if (t1 >= 0.0) and (.0 <= p1[2] <= self.length):
-                points.append(p1)
+                hits.append((t1, p1, 'hull', norm(p1 - np.array([0, 0, p1[2]]))))
+
+        # Now compute intersection with end caps (the only ones hit by axis aligned rays)
+        bottom = Plane()
+        top = Plane()
+        top.transform = tf.translation_matrix([0, 0, self.length])
+        for cap, face, cap_normal in ((top, 'cap', np.array([0, 0, 1])), (bottom, 'base', np.array([0, 0, -1]))):
+            cap_hits = cap.hits(Ray(rpos, rdir))
+            if cap_hits is not None:
+                point = cap_hits[0].point
+                point_radius = np.sqrt(point[0] ** 2 + point[1] ** 2)
+                if point_radius <= self.radius:
+                    hits.append((cap_hits[0].t, point, face, cap_normal))
+
+        if len(hits) > 0:
+            return [Hit(t, self.to_global(point), face, self.to_global_direction(local_normal))
+                    for t, point, face, local_normal in hits]
+        return None
 
-            # print "Hits quadratic surface with t0 and t1, ", t0, t1
-            # print ""
-            # print "Intersection points:"
-            # p0 = rpos + t0 * rdir
-            # p1 = rpos + t1 * rdir
+    def hit_intervals(self, ray):
+        """
+        Returns [(entry Hit, exit Hit)] of the ray line inside the capped cylinder (t can be negative, the hull is
+        preferred to the caps on the rim), [] if it misses the cylinder
+        """
+        rpos = self.to_local(ray.position)
+        rdir = self.to_local_direction(ray.direction)
+        direction = np.array([0, 0, 1])
 
-            # Check that hit quadratic surface in the length range
-            # points = []
-            # if (.0 <= p0[2] <= self.length) and not Ray(rpos, rdir).behind(p0):
-            #    points.append(p0)
-            #
-            # if (.0 <= p1[2] <= self.length) and not Ray(rpos, rdir).behind(p1):
-            #    points.append(p1)
-
-            # print points
-            # Now compute intersection with end caps
-            # print "Now to calculate caps intersections"
-
-            bottom = Plane()
-            top = Plane()
-            top.transform = tf.translation_matrix([0, 0, self.length])
-            p2 = top.intersection(Ray(rpos, rdir))
-            p3 = bottom.intersection(Ray(rpos, rdir))
-            cap_intersections = []
-            if p2 is not None:
-                cap_intersections.append(p2)
-            if p3 is not None:
-                cap_intersections.append(p3)
-
-            for point in cap_intersections:
-
-                if point[0] is not None:
-                    point = point[0]
-                    point_radius = np.sqrt(point[0] ** 2 + point[1] ** 2)
-                    if point_radius <= self.radius:
-                        # print "Hit cap at point:"
-                        # print point
-                        # print ""
-                        points.append(point)
-
-            # print points
-            if len(points) > 0:
-                world_points = []
-                for pt in points:
-                    world_points.append(transform_point(pt, self.transform))
-                return world_points
-            return None
+        normal = np.cross(rdir, direction)
+        normal_magnitude = magnitude(normal)
+        if not cmp_floats(normal_magnitude, .0):
+            # Interval inside the infinite cylinder (same solution of hits())
+            normal = norm(normal)
+            d = abs(np.dot(rpos, normal))
+            if d > self.radius:
+                return []
+            t = - np.dot(np.cross(rpos, direction), normal) / normal_magnitude
+            s = abs(np.sqrt(self.radius ** 2 - d ** 2) / np.dot(rdir, norm(np.cross(normal, direction))))
+            entry, exit = (t - s, 'hull'), (t + s, 'hull')
+        elif rpos[0] ** 2 + rpos[1] ** 2 <= self.radius ** 2:
+            # Parallel to the axis, within the hull
+            entry, exit = (-np.inf, 'hull'), (np.inf, 'hull')
+        else:
+            return []
+
+        # Interval between the end caps
+        if rdir[2] != 0.:
+            caps = sorted(((-rpos[2] / rdir[2], 'base'), (-(rpos[2] - self.length) / rdir[2], 'cap')))
+            if caps[0][0] > entry[0]:
+                entry = caps[0]
+            if caps[1][0] < exit[0]:
+                exit = caps[1]
+        elif not 0. <= rpos[2] <= self.length:
+            return []
+
+        if entry[0] > exit[0]:
+            return []
+        return [(self.face_hit(entry[0], rpos + entry[0] * rdir, entry[1]),
+                 self.face_hit(exit[0], rpos + exit[0] * rdir, exit[1]))]
+
+    def face_hit(self, t, local_point, face):
+        """
+        Returns the Hit of a point on a face of the cylinder
+
+        :param t: parametric distance along the ray
+        :param local_point: intersection point in the local frame
+        :param face: 'hull', 'base' or 'cap'
+        """
+        if face == 'hull':
+            normal = norm(local_point - np.array([0, 0, local_point[2]]))
+        elif face == 'base':
+            normal = np.array([0, 0, -1])
+        else:
+            normal = np.array([0, 0, 1])
+        return Hit(t, self.to_global(local_point), face, self.to_global_direction(normal))
+
+    def contains_points(self, points):
+        """Array version of contains()"""
+        local = self.to_local(points)
+        xy_distance = np.sqrt(local[:, 0] ** 2 + local[:, 1] ** 2)
+        inside = interval_check_array(0., local[:, 2], self.length, strict=True) & (xy_distance < self.radius)
+        return inside & ~self.on_surface_points(points)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        local = self.to_local(points)
+        xy_distance = np.sqrt(local[:, 0] ** 2 + local[:, 1] ** 2)
+        on_hull = cmp_floats_array(xy_distance, self.radius)
+        on_ends = cmp_floats_array(local[:, 2], 0.) | cmp_floats_array(local[:, 2], self.length)
+        return (interval_check_array(0., local[:, 2], self.length) & on_hull) | \
+            ((on_hull | (xy_distance < self.radius)) & on_ends)
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits() (see cylinder_intervals())"""
+        return single_interval(*cylinder_intervals(self.to_local(origins), self.to_local_direction(directions),
+                                                   self.radius, self.length))
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
 
 
 class Sphere(object):
@@ -1315,11 +1849,17 @@ class Sphere(object):
     A sphere.
     """
 
+    face_names = ('SPHERE',)
+
     def __init__(self, centre=(0., 0., 0.), radius=1.):
         super(Sphere, self).__init__()
         self.centre = np.array(centre)
         self.radius = radius
 
+    def bounding_box(self):
+        """Returns the minimum and maximum corners of the axis-aligned box enclosing the sphere"""
+        return self.centre - self.radius, self.centre + self.radius
+
     def on_surface(self, point):
         """
         Returns True is point is on surface, False otherwise.
@@ -1408,7 +1948,35 @@ class Sphere(object):
         >>> s.intersection(r)
         [array([ 1.,  1.,  2.])]
         """
+        return hit_points(self.hits(ray))
+
+    def hits(self, ray):
+        """
+        Returns the hit records of the ray with the sphere (face "SPHERE"), see intersection()
+
+        :param ray: ray (position, direction) to be evaluated for intersection
+        """
+        hits = self.line_hits(ray)
+        if len(hits) == 0:
+            return None
+        return [hit for hit in hits if hit.t >= 0.]
+
+    def hit_intervals(self, ray):
+        """
+        Returns [(entry Hit, exit Hit)] of the ray line inside the sphere (t can be negative, the same Hit for tangent
+        rays), [] if it misses the sphere
+        """
+        hits = self.line_hits(ray)
+        if len(hits) == 0:
+            return []
+        return [(hits[0], hits[-1])]
 
+    def line_hits(self, ray):
+        """
+        Returns the hit records of the ray line with the sphere (t can be negative), sorted along the ray
+
+        :param ray: ray (position, direction) to be evaluated for intersection
+        """
         # inv_transform = tf.inverse_matrix(self.transform)
         # rpos = transform_point(ray.position, inv_transform)
         # rdir = transform_direction(ray.direction, inv_transform)
@@ -1425,7 +1993,7 @@ class Sphere(object):
 
         # if discriminant is negative there are no real roots
         if discriminant < 0:
-            return None
+            return []
 
         # if discriminant is zero then there is only one solution, if positive there are two
         if cmp_floats(discriminant, 0.):
@@ -1436,9 +2004,8 @@ class Sphere(object):
 
         hits = []
         for distance in t:
-            if distance >= 0.:
-                point = rpos + distance * rdir
-                hits.append(point)
+            point = rpos + distance * rdir
+            hits.append(Hit(distance, point, "SPHERE", norm(point - self.centre)))
         return hits
 
     def contains(self, point):
@@ -1471,6 +2038,157 @@ class Sphere(object):
             return True
         return False
 
+    def contains_points(self, points):
+        """Array version of contains()"""
+        offset = np.asarray(points, dtype=float) - self.centre
+        return smaller_array(np.einsum('ij,ij->i', offset, offset), self.radius ** 2)
+
+    def on_surface_points(self, points):
+        """Array version of on_surface()"""
+        offset = np.asarray(points, dtype=float) - self.centre
+        return cmp_floats_array(np.sqrt(np.einsum('ij,ij->i', offset, offset)), self.radius)
+
+    def ray_intervals(self, origins, directions):
+        """Array version of hits() (see sphere_intervals())"""
+        return single_interval(*sphere_intervals(np.asarray(origins, dtype=float),
+                                                 np.asarray(directions, dtype=float), self.centre, self.radius))
+
+    def intersect(self, origins, directions):
+        """Array version of hits(), see first_interval()"""
+        return first_interval(self.ray_intervals(origins, directions))
+
+
+class BoundingVolumeHierarchy(object):
+    """
+    Axis-aligned bounding volume hierarchy over the (global frame) bounding boxes of a list of shapes.
+
+    Used by Scene to test only the objects whose bounding box is touched by a ray or contains a point.
+    Queries return the indexes of the candidate shapes in increasing order (i.e. the order of the shape list).
+    Shapes without bounding_box() or returning None (e.g. infinite planes) are always candidates.
+    """
+    """
+    >>> bvh = BoundingVolumeHierarchy([Box((0, 0, 0), (1, 1, 1)), Box((2, 0, 0), (3, 1, 1)), Plane()], leaf_size=1)
+    >>> bvh.ray_candidates(Ray(position=(-1, 0.5, 0.5), direction=(1, 0, 0)))
+    [0, 1, 2]
+    >>> bvh.ray_candidates(Ray(position=(2.5, 0.5, 2), direction=(0, 0, -1)))
+    [1, 2]
+    >>> bvh.point_candidates((0.5, 0.5, 0.5))
+    [0, 2]
+    """
+
+    def __init__(self, shapes, leaf_size=4, padding=1e-9):
+        """
+        :param shapes: list of shapes
+        :param leaf_size: maximum number of shapes in a leaf node
+        :param padding: the bounding boxes are enlarged by padding (points on surfaces must be within the box)
+        """
+        super(BoundingVolumeHierarchy, self).__init__()
+        self.leaf_size = leaf_size
+        self.unbounded = []
+        bounded = []
+        lower = []
+        upper = []
+        for index, shape in enumerate(shapes):
+            bounds = shape.bounding_box() if hasattr(shape, 'bounding_box') else None
+            if bounds is None:
+                self.unbounded.append(index)
+            else:
+                bounded.append(index)
+                lower.append(np.asarray(bounds[0], dtype=float) - padding)
+                upper.append(np.asarray(bounds[1], dtype=float) + padding)
+
+        # Nodes are stored in flat lists, children is None for leaves (with items) and (left, right) otherwise
+        self.lower = []
+        self.upper = []
+        self.children = []
+        self.items = []
+        if len(bounded) > 0:
+            self._build(np.array(bounded), np.array(lower), np.array(upper))
+
+    def _build(self, indexes, lower, upper):
+        """Recursively adds the nodes for the shapes with the given indexes and bounds. Returns the node number."""
+        node = len(self.lower)
+        self.lower.append(tuple(lower.min(axis=0)))
+        self.upper.append(tuple(upper.max(axis=0)))
+        self.children.append(None)
+        self.items.append(None)
+
+        centres = 0.5 * (lower + upper)
+        spread = centres.max(axis=0) - centres.min(axis=0)
+        if len(indexes) <= self.leaf_size or spread.max() == 0:
+            self.items[node] = sorted(indexes.tolist())
+            return node
+
+        # Median split along the axis with the largest spread of centres
+        order = np.argsort(centres[:, spread.argmax()], kind='mergesort')
+        half = len(order) // 2
+        left = self._build(indexes[order[:half]], lower[order[:half]], upper[order[:half]])
+        right = self._build(indexes[order[half:]], lower[order[half:]], upper[order[half:]])
+        self.children[node] = (left, right)
+        return node
+
+    def ray_candidates(self, ray):
+        """
+        Returns the indexes of the shapes whose bounding box is hit by the ray (ahead of its position).
+
+        :param ray: Ray (position, direction)
+        :return: sorted list of indexes
+        """
+        position = [float(x) for x in ray.position]
+        direction = [float(x) for x in ray.direction]
+        candidates = list(self.unbounded)
+        stack = [0] if self.lower else []
+        while stack:
+            node = stack.pop()
+            lower = self.lower[node]
+            upper = self.upper[node]
+            t_min = 0.
+            t_max = float('inf')
+            missed = False
+            for axis in range(0, 3):
+                if direction[axis] == 0.:
+                    missed = not lower[axis] <= position[axis] <= upper[axis]
+                else:
+                    t1 = (lower[axis] - position[axis]) / direction[axis]
+                    t2 = (upper[axis] - position[axis]) / direction[axis]
+                    if t1 > t2:
+                        t1, t2 = t2, t1
+                    t_min = max(t_min, t1)
+                    t_max = min(t_max, t2)
+                    missed = t_min > t_max
+                if missed:
+                    break
+            if missed:
+                continue
+            if self.children[node] is None:
+                candidates.extend(self.items[node])
+            else:
+                stack.extend(self.children[node])
+        return sorted(candidates)
+
+    def point_candidates(self, point):
+        """
+        Returns the indexes of the shapes whose bounding box contains the point.
+
+        :param point: 3D coordinates of the point
+        :return: sorted list of indexes
+        """
+        point = [float(x) for x in point]
+        candidates = list(self.unbounded)
+        stack = [0] if self.lower else []
+        while stack:
+            node = stack.pop()
+            lower = self.lower[node]
+            upper = self.upper[node]
+            if not (lower[0] <= point[0] <= upper[0] and lower[1] <= point[1] <= upper[1] and
+                    lower[2] <= point[2] <= upper[2]):
+                continue
+            if self.children[node] is None:
+                candidates.extend(self.items[node])
+            else:
+                stack.extend(self.children[node])
+        return sorted(candidates)
+
 
 if __name__ == "__main__":
     import doctest
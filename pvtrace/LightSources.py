@@ -39,7 +39,18 @@ def random_spherical_vector():
     y *= a
     return np.array([x, y, z])
 
+
+def sample_wavelengths(spectrum, wavelength, n):
+    """
+    Returns n wavelengths sampled from spectrum (or n times wavelength if spectrum is None)
+    """
+    if spectrum is not None:
+        return spectrum.sample(size=n)
+    return np.full(n, wavelength, dtype=float)
+
 # Every lightsource class MUST implement a photon method returning a photon
+# and a photons(n) method returning the arrays of n photons: pid, position, direction, wavelength and polarisation
+# (None if the source does not set the polarisation)
 
 
 class SimpleSource(object):
@@ -83,6 +94,25 @@ class SimpleSource(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        position = np.tile(np.asarray(self.position, dtype=float), (n, 1))
+        direction = np.tile(np.asarray(self.direction, dtype=float), (n, 1))
+        wavelength = np.full(n, self.wavelength, dtype=float)
+        polarisation = None
+        if self.use_random_polarisation:
+            # Random angle in the xy-plane, then the transform from +z to the direction of the photon
+            angle = np.random.uniform(0., 2 * np.pi, n)
+            vectors = np.column_stack((np.cos(angle), np.sin(angle), np.zeros(n)))
+            r = rotation_matrix_from_vector_alignment(self.direction, [0., 0., 1.])
+            polarisation = np.dot(vectors, np.asarray(r)[:3, :3].T)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, polarisation
+
 
 class Laser(object):
     """
@@ -113,6 +143,19 @@ class Laser(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        position = np.tile(np.asarray(self.position, dtype=float), (n, 1))
+        direction = np.tile(np.asarray(self.direction, dtype=float), (n, 1))
+        wavelength = np.full(n, self.wavelength, dtype=float)
+        polarisation = np.tile(np.asarray(self.polarisation, dtype=float), (n, 1))
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, polarisation
+
 
 class PlanarSource(object):
     """A box that emits photons from the top surface (normal), sampled from the spectrum."""
@@ -151,7 +194,7 @@ class PlanarSource(object):
         photon.direction = self.direction
         photon.active = True
         if self.spectrum is not None:
-            photon.wavelength = self.spectrum.wavelength_at_probability(np.random.uniform())
+            photon.wavelength = self.spectrum.sample()
         else:
             photon.wavelength = self.wavelength
 
@@ -160,6 +203,21 @@ class PlanarSource(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        # Points on the surface of the finite plane in its local frame
+        local_points = np.column_stack((np.random.uniform(0., self.length, n), np.random.uniform(0., self.width, n),
+                                        np.zeros(n)))
+        position = self.plane.to_global(local_points)
+        direction = np.tile(np.asarray(self.direction, dtype=float), (n, 1))
+        wavelength = sample_wavelengths(self.spectrum, self.wavelength, n)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, None
+
 
 class LensSource(object):
     """
@@ -203,7 +261,7 @@ class LensSource(object):
 
         # Wavelength
         if self.spectrum is not None:
-            photon.wavelength = self.spectrum.wavelength_at_probability(np.random.uniform())
+            photon.wavelength = self.spectrum.sample()
         else:
             photon.wavelength = self.wavelength
 
@@ -212,6 +270,24 @@ class LensSource(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        position = np.column_stack([np.random.uniform(self.plane_origin[i], self.plane_extent[i], n) for i in range(3)])
+
+        focus_point = np.column_stack((self.line_point[0] + np.random.uniform(-self.focus_size, self.focus_size, n),
+                                       self.line_point[1] + np.random.uniform(-self.focus_size, self.focus_size, n),
+                                       position[:, 2]))
+        direction = focus_point - position
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+
+        wavelength = sample_wavelengths(self.spectrum, self.wavelength, n)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, None
+
 
 class LensSourceAngle(object):
     """
@@ -257,7 +333,7 @@ class LensSourceAngle(object):
 
         # Wavelength
         if self.spectrum is not None:
-            photon.wavelength = self.spectrum.wavelength_at_probability(np.random.uniform())
+            photon.wavelength = self.spectrum.sample()
         else:
             photon.wavelength = self.wavelength
 
@@ -266,6 +342,28 @@ class LensSourceAngle(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        x = np.random.uniform(self.plane_origin[0], self.plane_extent[0], n)
+        y = np.random.uniform(self.plane_origin[1], self.plane_extent[1], n)
+        boost = y * np.tan(self.angle)
+        z = np.random.uniform(self.plane_origin[2], self.plane_extent[2], n) - boost
+        position = np.column_stack((x, y, z))
+
+        focus_point = np.column_stack((self.line_point[0] + np.random.uniform(-self.focus_size, self.focus_size, n),
+                                       self.line_point[1] + np.random.uniform(-self.focus_size, self.focus_size, n),
+                                       z + boost))
+        direction = focus_point - position
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+
+        wavelength = sample_wavelengths(self.spectrum, self.wavelength, n)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, None
+
 
 class CylindricalSource(object):
     """
@@ -317,7 +415,7 @@ class CylindricalSource(object):
 
         # Set wavelength of photon
         if self.spectrum is not None:
-            photon.wavelength = self.spectrum.wavelength_at_probability(np.random.uniform())
+            photon.wavelength = self.spectrum.sample()
         else:
             photon.wavelength = self.wavelength
 
@@ -329,6 +427,27 @@ class CylindricalSource(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        # Positions of emission
+        phi = np.random.uniform(0., 2 * np.pi, n)
+        r = np.random.uniform(0., self.radius, n)
+        local_points = np.column_stack((r * np.cos(phi), r * np.sin(phi), np.random.uniform(0., self.length, n)))
+        position = self.shape.to_global(local_points)
+
+        # Directions of emission (no need to transform if meant to be isotropic)
+        phi = np.random.uniform(0., 2 * np.pi, n)
+        theta = np.random.uniform(0., np.pi, n)
+        direction = np.column_stack((np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), np.cos(theta)))
+
+        wavelength = sample_wavelengths(self.spectrum, self.wavelength, n)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, None
+
 
 class PointSource(object):
     """
@@ -378,7 +497,7 @@ class PointSource(object):
         photon.position = point
 
         if self.spectrum is not None:
-            photon.wavelength = self.spectrum.wavelength_at_probability(np.random.uniform())
+            photon.wavelength = self.spectrum.sample()
         else:
             photon.wavelength = self.wavelength
 
@@ -389,6 +508,26 @@ class PointSource(object):
         self.throw += 1
         return photon
 
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        phi = np.random.uniform(self.phi_min, self.phi_max, n)
+        # Uniform on the sphere, values outside [theta_min, theta_max] are drawn again (as in photon())
+        theta = np.arccos(2 * np.random.uniform(0, 1, n) - 1)
+        rejected = np.flatnonzero((theta > self.theta_max) | (theta < self.theta_min))
+        while len(rejected) > 0:
+            theta[rejected] = np.arccos(2 * np.random.uniform(0, 1, len(rejected)) - 1)
+            rejected = rejected[(theta[rejected] > self.theta_max) | (theta[rejected] < self.theta_min)]
+        direction = np.column_stack((np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), np.cos(theta)))
+        position = np.tile(np.asarray(self.center, dtype=float), (n, 1))
+
+        wavelength = sample_wavelengths(self.spectrum, self.wavelength, n)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, None
+
 
 class RadialSource(object):
     """
@@ -436,7 +575,7 @@ class RadialSource(object):
         photon.position = point
 
         if self.spectrum is not None:
-            photon.wavelength = self.spectrum.wavelength_at_probability(np.random.uniform())
+            photon.wavelength = self.spectrum.sample()
         else:
             photon.wavelength = self.wavelength
 
@@ -446,3 +585,24 @@ class RadialSource(object):
         self.log.debug('Emitted photon (pid: ' + str(self.throw)+')')
         self.throw += 1
         return photon
+
+    def photons(self, n):
+        """
+        Returns n photons as arrays: pid, position, direction, wavelength and polarisation (see photon())
+        """
+        int_phi = np.random.randint(1, self.spacing + 1, n)
+        int_theta = np.random.randint(1, self.spacing + 1, n)
+
+        phi = int_phi * (self.phi_max - self.phi_min) / self.spacing
+        if self.theta_min == self.theta_max:
+            theta = np.full(n, self.theta_min, dtype=float)
+        else:
+            theta = int_theta * (self.theta_max - self.theta_min) / self.spacing
+        direction = np.column_stack((np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), np.cos(theta)))
+        position = np.tile(np.asarray(self.center, dtype=float), (n, 1))
+
+        wavelength = sample_wavelengths(self.spectrum, self.wavelength, n)
+        pid = np.arange(self.throw, self.throw + n)
+        self.log.debug('Emitted photons (pid: ' + str(self.throw) + ' to ' + str(self.throw + n - 1) + ')')
+        self.throw += n
+        return pid, position, direction, wavelength, None
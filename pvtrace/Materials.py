@@ -183,6 +183,77 @@ def fresnel_refraction(normal, vector, n1, n2):
     return norm(refraction)
 
 
+class LookupTable(object):
+    """
+    A piecewise linear function (e.g. a cumulative distribution or its inverse) tabulated on a uniform grid.
+
+    Values are found in O(1) by linear interpolation between the two table entries around the argument, which is
+    exact in the cells without breakpoints of the function. The few arguments falling in a cell containing a
+    breakpoint are evaluated with np.interp. Outside the range of xp the first/last values of fp are returned.
+    Several functions with the same breakpoints can be tabulated together (one column of fp each).
+    """
+
+    def __init__(self, xp, fp, size):
+        """
+        :param xp: x of the breakpoints (non decreasing, duplicates give steps)
+        :param fp: function values at the breakpoints, (len(xp),) or (len(xp), columns) array
+        :param size: number of points of the table
+        """
+        super(LookupTable, self).__init__()
+        self.xp = np.asarray(xp, dtype=np.float64)
+        self.fp = np.asarray(fp, dtype=np.float64)
+        self.size = size
+        self.start = self.xp[0]
+        self.step = (self.xp[-1] - self.xp[0]) / (size - 1)
+        if self.step == 0:
+            self.step = 1.
+        grid = self.start + self.step * np.arange(size)
+        self.table = self.interpolate(grid)
+        self.slope = np.diff(self.table, axis=0)
+        self.slope = np.concatenate((self.slope, np.zeros_like(self.slope[:1])))
+        # Cells containing a breakpoint are not linear
+        self.exact = np.ones(size, dtype=bool)
+        position = (self.xp - self.start) / self.step
+        cells = np.floor(position).astype(np.intp)
+        self.exact[np.clip(cells[position != cells], 0, size - 1)] = False
+        # Breakpoints on the grid lines: the step (if any) is in the cells at both sides
+        self.exact[np.clip(cells[position == cells] - 1, 0, size - 1)] = False
+        self.exact[np.clip(cells[position == cells], 0, size - 1)] = False
+
+    def interpolate(self, x):
+        """ Evaluates the function at x with np.interp (exact, O(log(len(xp)))) """
+        if self.fp.ndim == 1:
+            return np.interp(x, self.xp, self.fp)
+        return np.stack([np.interp(x, self.xp, column) for column in self.fp.T], axis=-1)
+
+    def __call__(self, x):
+        """
+        Returns the function value(s) at x (a number or an array)
+        """
+        if isinstance(x, (float, int)):
+            position = (x - self.start) / self.step
+            if not 0 <= position < self.size - 1 or not self.exact[int(position)]:
+                value = self.interpolate(x)
+            else:
+                index = int(position)
+                value = self.table[index] + (position - index) * self.slope[index]
+            return float(value) if self.fp.ndim == 1 else value
+
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim == 0:
+            return self(float(x))
+        position = np.clip((x - self.start) / self.step, 0., self.size - 1)
+        index = position.astype(np.intp)
+        if self.fp.ndim == 1:
+            values = self.table[index] + (position - index) * self.slope[index]
+        else:
+            values = self.table[index] + (position - index)[:, None] * self.slope[index]
+        inexact = ~self.exact[index]
+        if np.any(inexact):
+            values[inexact] = self.interpolate(x[inexact])
+        return values
+
+
 class Spectrum(object):
     """
     A class that represents a spectral quantity
@@ -190,6 +261,9 @@ class Spectrum(object):
     e.g. absorption, emission or refractive index spectrum as a function of wavelength in nanometers.
     """
 
+    # Number of points of the uniformly spaced lookup tables used to sample the spectrum (see build_lookup_tables())
+    lookup_size = 16384
+
     def __init__(self, x=None, y=None, filename=None, base10=True):
         """
         Initialised with x and y which are array-like data of the same length. x must have units of wavelength
@@ -243,6 +317,7 @@ class Spectrum(object):
             self.y *= 1/np.log10(math.e)
         # Make the 'spectrum'
         self.spectrum = Interp1d(self.x, self.y, bounds_error=False, fill_value=0.0)
+        self.x_max = float(self.x.max())
 
         # Make the pdf for wavelength lookups
         try:
@@ -257,6 +332,28 @@ class Spectrum(object):
             pdf = np.hstack([0, pdf[:]])
             self.pdf_lookup = Interp1d(bins, pdf, bounds_error=False, fill_value=0.0)
             self.pdfinv_lookup = Interp1d(pdf, bins, bounds_error=False, fill_value=0.0)
+            self.build_lookup_tables(bins, pdf)
+
+    def build_lookup_tables(self, bins, cdf):
+        """
+        Tabulates the cumulative distribution function (on a uniform wavelength grid) and its inverse (on a uniform
+        probability grid) with lookup_size points each, so that both are evaluated in O(1) by linear interpolation
+        between the two neighbouring table entries (see probability_at_wavelength() and wavelength_at_probability()).
+        Both functions are piecewise linear: table cells containing a breakpoint are flagged and evaluated exactly.
+
+        :param bins: wavelengths of the cdf points (increasing)
+        :param cdf: cumulative probability at bins (non decreasing, from 0 to 1)
+        """
+        bins = np.asarray(bins, dtype=np.float64)
+        cdf = np.asarray(cdf, dtype=np.float64)
+
+        # Forward cdf, used as lower bound for red-shifted emission
+        self.cdf_lookup = LookupTable(bins, cdf, self.lookup_size)
+        # Inverse cdf through the rising segments only: flat parts of the cdf (zero y) have no probability
+        rising = np.diff(cdf) > 0
+        self.inverse_cdf_lookup = LookupTable(np.column_stack((cdf[:-1][rising], cdf[1:][rising])).ravel(),
+                                              np.column_stack((bins[:-1][rising], bins[1:][rising])).ravel(),
+                                              self.lookup_size)
 
     def __call__(self, nanometers):
         """
@@ -290,11 +387,16 @@ class Spectrum(object):
         This is found by computing the cumulative probability function of the spectrum which is unique for each value
         for non-zero y values.
         If the wavelength is below the data range zero is returned, and if above one is returned.
+        Accepts a single wavelength or an array of wavelengths.
         """
-        if nanometers > self.x.max():
-            return 1.0
-        else:
-            return self.pdf_lookup(nanometers)
+        if not isinstance(nanometers, (float, int)) and np.ndim(nanometers) == 0:
+            nanometers = float(nanometers)
+        if isinstance(nanometers, (float, int)):
+            if nanometers > self.x_max:
+                return 1.0
+            return self.cdf_lookup(nanometers)
+        nanometers = np.asarray(nanometers, dtype=np.float64)
+        return np.where(nanometers > self.x_max, 1.0, self.cdf_lookup(nanometers))
 
     def wavelength_at_probability(self, probability):
         """
@@ -302,11 +404,29 @@ class Spectrum(object):
 
         This is found by computing the inverse cumulative probability function (see probability_at_wavelength).
         The probability must be between zero and one (inclusive) otherwise a value error exception is raised.
+        Accepts a single probability or an array of probabilities.
         """
-        if 0 <= probability <= 1:
-            return self.pdfinv_lookup(probability)
+        if not isinstance(probability, (float, int)) and np.ndim(probability) == 0:
+            probability = float(probability)
+        if isinstance(probability, (float, int)):
+            if not 0 <= probability <= 1:
+                raise ValueError('A probability must be between 0 and 1 inclusive')
         else:
-            raise ValueError('A probability must be between 0 and 1 inclusive')
+            probability = np.asarray(probability, dtype=np.float64)
+            if np.any(probability < 0) or np.any(probability > 1):
+                raise ValueError('A probability must be between 0 and 1 inclusive')
+        return self.inverse_cdf_lookup(probability)
+
+    def sample(self, size=None, above=None):
+        """
+        Draws random wavelengths from the spectrum (one uniform random number per wavelength).
+
+        :param size: number of wavelengths (None for a single wavelength, or the size of above)
+        :param above: if not None, wavelength(s) the samples must be red-shifted from (e.g. absorbed wavelengths)
+        :return: wavelength (float) or np.array of wavelengths
+        """
+        lower_bound = 0. if above is None else self.probability_at_wavelength(above)
+        return self.wavelength_at_probability(np.random.uniform(lower_bound, 1., size=size))
 
     def write(self, filename=None):
         if file is not None:
@@ -497,8 +617,7 @@ class Material(object):
     def emission_wavelength(self, photon):
         """Returns a new emission wavelength for the photon."""
         # The emitted photon must be red-shifted to conservation of energy
-        lower_bound = self.emission_data.probability_at_wavelength(photon.wavelength)
-        return self.emission_data.wavelength_at_probability(np.random.uniform(lower_bound, 1.))
+        return self.emission_data.sample(above=photon.wavelength)
 
     def emission(self, photon):
         """Updates the photon with a new wavelength and direction, assuming it has been absorbed and emitted."""
@@ -542,7 +661,7 @@ class Material(object):
 
             # Move photon to the absorption location
             photon.material = self
-            photon.position += sampled_pathlength * photon.direction
+            photon.position = photon.position + sampled_pathlength * photon.direction
             photon.absorption_counter += 1
 
             # Photon emitted.
@@ -587,16 +706,58 @@ class CompositeMaterial(Material):
         self.emission = None
         self.absorption = None
         self.quantum_efficiency = None
+        # Cumulative absorption coefficients of the materials (see absorption_table()), built at the first use
+        self.absorption_lookup = None
+
+    def absorption_table(self):
+        """
+        Returns a LookupTable of the cumulative sums of the materials absorption coefficients vs. wavelength: column i
+        is the sum of the coefficients of materials 0..i, so the last column is the total absorption coefficient.
+        The table breakpoints are all the wavelengths of the absorption spectra, so lookups are exact.
+        It is built at the first call: set absorption_lookup to None if the materials are changed afterwards.
+        """
+        if self.absorption_lookup is None:
+            spectra = [material.absorption_data for material in self.materials]
+            # Spectra are zero outside their data range (see Spectrum.value())
+            wavelengths = [np.asarray(spectrum.x, dtype=np.float64) for spectrum in spectra]
+            wavelengths += [np.nextafter([w.min(), w.max()], [-np.inf, np.inf]) for w in wavelengths]
+            wavelengths = np.unique(np.concatenate(wavelengths))
+            coefficients = np.column_stack([np.asarray(spectrum.value(wavelengths), dtype=np.float64)
+                                            for spectrum in spectra])
+            self.absorption_lookup = LookupTable(wavelengths, np.cumsum(coefficients, axis=1), Spectrum.lookup_size)
+        return self.absorption_lookup
 
     def all_absorption_coefficients(self, nanometers):
-        """Returns and array of all the the materials absorption coefficients at the specified wavelength."""
-        count = len(self.materials)
-        # Defaults 0 for each material (fill in unexpected missing values)
-        absorptions = np.zeros(count)
-        # Foreach material get its absorption
-        for i in range(0, count):
-            absorptions[i] = self.materials[i].absorption_data.value(nanometers)
-        return absorptions
+        """
+        Returns and array of all the the materials absorption coefficients at the specified wavelength (or a
+        (n, materials) array for n wavelengths).
+        """
+        cumulative = self.absorption_table()(nanometers)
+        return np.diff(cumulative, axis=-1, prepend=0.)
+
+    def select_absorber(self, cumulative):
+        """
+        Returns the index of the absorbing material, chosen at random with probability proportional to its absorption
+        coefficient.
+
+        :param cumulative: cumulative absorption coefficients at the photon wavelength (see absorption_table())
+        """
+        return int(self.select_absorbers(np.asarray(cumulative)[None], np.array([np.random.uniform()]))[0])
+
+    @staticmethod
+    def select_absorbers(cumulative, uniform):
+        """
+        Array version of select_absorber() (used by BatchTracer as well): the index of each row is
+        np.searchsorted(row, uniform * row[-1], side='right'), counted with one comparison per material.
+
+        :param cumulative: (n, materials) cumulative absorption coefficients (rows of absorption_table())
+        :param uniform: (n,) random numbers in [0, 1)
+        :return: (n,) array of material indices
+        """
+        draw = uniform * cumulative[:, -1]
+        absorber = np.count_nonzero(cumulative <= draw[:, None], axis=1)
+        # uniform * total can be rounded up to total
+        return np.minimum(absorber, cumulative.shape[1] - 1)
 
     def trace(self, photon, free_pathlength):
         """
@@ -617,9 +778,8 @@ class CompositeMaterial(Material):
         photon.emitter_material = None
 
         # print "Tracing photon into CompositeMaterial. free_pathlength:",free_pathlength*100,' cm'
-        absorptions = self.all_absorption_coefficients(photon.wavelength)
-        # print 'At ',photon.wavelength,' nm the absorption of the materials are:',absorptions
-        absorption_coefficient = absorptions.sum()
+        cumulative = self.absorption_table()(photon.wavelength)
+        absorption_coefficient = cumulative[-1]
         # See WolframAlpha "-ln(1-x)/y from x=0 to 1 from y=0 to 2"
         sampled_pathlength = -np.log(1 - np.random.uniform()) / absorption_coefficient
         # print "sampled is: ",sampled_pathlength
@@ -632,14 +792,7 @@ class CompositeMaterial(Material):
             photon.position = photon.position + sampled_pathlength * photon.direction
 
             # Find the absorption material
-            count = len(self.materials)
-            bins = range(0, count + 1)
-            cdf = np.cumsum(absorptions)
-            pdf = cdf / max(cdf)
-            pdf = np.hstack([0, pdf[:]])
-            pdfinv_lookup = Interp1d(pdf, bins, bounds_error=False, fill_value=0.0)
-            absorber_index = int(np.floor(pdfinv_lookup(np.random.uniform())))
-            material = self.materials[absorber_index]
+            material = self.materials[self.select_absorber(cumulative)]
             # print 'the absorber was ',absorber_index
             photon.material = material
             photon.absorber_material = material
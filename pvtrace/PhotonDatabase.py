@@ -30,23 +30,55 @@ def itemise(array):
     return list(chain.from_iterable(array))
 
 
+def photon_fate(absorption_counter, killed, reaction, surface_id, ray_direction_bound):
+    """
+    Classifies a photon from the state of its last step (the same criteria of Analysis.db_stats()).
+
+    :return: 'killed', 'reaction' (absorbed in the reactor channels), 'loss' (non radiative loss), 'escape' (left a
+    surface on an out bound direction) or 'other'
+    """
+    if killed:
+        return 'killed'
+    elif reaction:
+        return 'reaction'
+    elif surface_id == 'None' and absorption_counter > 0:
+        return 'loss'
+    elif ray_direction_bound == 'Out':
+        return 'escape'
+    return 'other'
+
+
 class PhotonDatabase(object):
     """
     An object the wraps a mysql database.
     """
 
-    def __init__(self, dbfile=None, readonly=False):
+    def __init__(self, dbfile=None, readonly=False, buffer_size=None):
         """
         Create the database and loads the schema into it.
 
         :param dbfile: Filename for the database. If None then a RAM DB will be used (way faster!)
+        :param readonly: open an existing DB file without loading the schema
+        :param buffer_size: if not None, log() collects up to buffer_size rows in memory and writes them all together
+        with executemany() in a single transaction (call flush() before querying the DB)
         """
         super(PhotonDatabase, self).__init__()
 
         self.uid = 0
         self.split_size = 20000
         self.logger = logging.getLogger('pvtrace.PhotonDatabase')
+        # Optional PhotonTally fed with the same steps and photon ends (e.g. for the convergence checks of Tracer)
+        self.tally = None
         self.readonly = readonly
+        self.buffer_size = buffer_size
+        self.buffered = 0
+        if self.buffer_size is not None:
+            assert self.buffer_size > 0, "buffer_size must be positive"
+            self.allocate_buffer()
+        # Photons being traced, pid: (original wavelength, last uid, last wavelength, last state), and the endpoint
+        # rows of the terminated ones (see end_photon()) waiting for flush()
+        self.open_photons = {}
+        self.endpoint_buffer = []
 
         if dbfile is not None:
             self.file = dbfile
@@ -96,10 +128,36 @@ class PhotonDatabase(object):
                 print("Could not load DB schema file. (", DB_SCHEMA, ")")
                 exit(1)
 
+        # DB files saved before the endpoint table was introduced get it rebuilt (as TEMP table) on first query
+        self.endpoint_stale = not self.has_table('endpoint')
+
     def load(self, dbfile):
         """ Loads an existing photon database into memory from a dbfile path. """
         self.connection = sql.connect(dbfile)
         self.cursor = self.connection.cursor()
+        self.endpoint_stale = not self.has_table('endpoint')
+
+    def has_table(self, table, schema='main'):
+        """ Returns True if the DB (or the attached DB schema) has the given table """
+        master = 'sqlite_master' if schema == 'main' else schema + '.sqlite_master'
+        return self.cursor.execute("SELECT COUNT(*) FROM " + master + " WHERE type = 'table' AND name = ?",
+                                   (table,)).fetchone()[0] > 0
+
+    def allocate_buffer(self):
+        """
+        Preallocates the column arrays used by the buffered log() (one row per uid)
+        """
+        size = self.buffer_size
+        self.buffer_pid = np.empty(size, dtype=object)
+        self.buffer_wavelength = np.empty(size)
+        self.buffer_position = np.empty((size, 3))
+        self.buffer_direction = np.empty((size, 3))
+        self.buffer_polarisation = np.empty((size, 3))
+        self.buffer_has_polarisation = np.zeros(size, dtype=bool)
+        self.buffer_surface_normal = np.empty((size, 3))
+        self.buffer_has_surface_normal = np.zeros(size, dtype=bool)
+        # State columns (absorption_counter, ..., reaction), uid excluded
+        self.buffer_state = np.empty((size, 12), dtype=object)
 
     def log(self, photon, surface_normal=None, surface_id=None, ray_direction_bound=None,
             emitter_material=None, absorber_material=None):
@@ -107,6 +165,12 @@ class PhotonDatabase(object):
         Adds a photon state (uid) in the database.
         Note: Every time this function is called the uid of the photon is incremented
         """
+        if self.tally is not None:
+            self.tally.log(photon, surface_normal, surface_id, ray_direction_bound, emitter_material, absorber_material)
+        if self.buffer_size is not None:
+            return self.log_buffered(photon, surface_normal, surface_id, ray_direction_bound, emitter_material,
+                                     absorber_material)
+
         values = (self.uid, photon.id, float(photon.wavelength))
         self.cursor.execute('INSERT INTO photon VALUES (?, ?, ?)', values)
         
@@ -142,7 +206,8 @@ class PhotonDatabase(object):
                   emitter_material, absorber_material, container_obj, str(on_surface_obj), str(surface_id),
                   str(ray_direction_bound), photon.reaction, self.uid)
         self.cursor.execute('INSERT INTO state VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', values)
-        
+        self.track(photon.id, self.uid, float(photon.wavelength), values)
+
         # Every 100 times write data to dbfile
         if self.uid % 100 == 0:
             self.connection.commit()
@@ -150,6 +215,221 @@ class PhotonDatabase(object):
         # The last line of this method update the unique photon ID (i.e. the row number)
         self.uid += 1
 
+    def log_buffered(self, photon, surface_normal=None, surface_id=None, ray_direction_bound=None,
+                     emitter_material=None, absorber_material=None):
+        """
+        Same as log(), but the row is stored in the buffer. The buffer is written to the DB when full.
+        """
+        row = self.buffered
+        self.buffer_pid[row] = photon.id
+        self.buffer_wavelength[row] = photon.wavelength
+        self.buffer_position[row] = photon.position
+        self.buffer_direction[row] = photon.direction
+
+        self.buffer_has_polarisation[row] = photon.polarisation is not None
+        if photon.polarisation is not None:
+            self.buffer_polarisation[row] = photon.polarisation
+
+        self.buffer_has_surface_normal[row] = surface_normal is not None
+        if surface_normal is not None:
+            self.buffer_surface_normal[row] = surface_normal
+
+        # Filter parameters that can be None
+        if photon.container is None:
+            container_obj = None
+        else:
+            container_obj = str(photon.container.name)
+
+        if photon.on_surface_object is None:
+            on_surface_obj = None
+        else:
+            on_surface_obj = photon.on_surface_object.name
+
+        state = (photon.absorption_counter, photon.intersection_counter, photon.active, photon.killed, photon.source,
+                 emitter_material, absorber_material, container_obj, str(on_surface_obj), str(surface_id),
+                 str(ray_direction_bound), photon.reaction)
+        self.buffer_state[row] = state
+        self.track(photon.id, self.uid, float(photon.wavelength), state)
+
+        self.buffered += 1
+        self.uid += 1
+        if self.buffered == self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows (if any) to the DB with one executemany() per table and commits.
+        """
+        count = self.buffered
+        if count > 0:
+            uids = list(range(self.uid - count, self.uid))
+
+            def with_uid(rows, mask=None):
+                if mask is None:
+                    return [tuple(row) + (uid,) for row, uid in zip(rows[:count].tolist(), uids)]
+                return [tuple(row) + (uid,) for row, uid, valid in zip(rows[:count].tolist(), uids,
+                                                                       mask[:count].tolist()) if valid]
+
+            # Photon rows are written first in the same transaction, the foreign key checks of the other tables are
+            # redundant (and about 10% of the insert time). The pragma has no effect within a transaction.
+            self.connection.commit()
+            self.cursor.execute("PRAGMA foreign_keys = OFF")
+            self.cursor.executemany('INSERT INTO photon VALUES (?, ?, ?)',
+                                    zip(uids, self.buffer_pid[:count].tolist(),
+                                        self.buffer_wavelength[:count].tolist()))
+            self.cursor.executemany('INSERT INTO position VALUES (?, ?, ?, ?)', with_uid(self.buffer_position))
+            self.cursor.executemany('INSERT INTO direction VALUES (?, ?, ?, ?)', with_uid(self.buffer_direction))
+            self.cursor.executemany('INSERT INTO polarisation VALUES (?, ?, ?, ?)',
+                                    with_uid(self.buffer_polarisation, self.buffer_has_polarisation))
+            self.cursor.executemany('INSERT INTO surface_normal VALUES (?, ?, ?, ?)',
+                                    with_uid(self.buffer_surface_normal, self.buffer_has_surface_normal))
+            self.cursor.executemany('INSERT INTO state VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                                    with_uid(self.buffer_state))
+            self.buffered = 0
+            self.connection.commit()
+            self.cursor.execute("PRAGMA foreign_keys = ON")
+        if self.endpoint_buffer:
+            self.cursor.executemany('INSERT INTO endpoint VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', self.endpoint_buffer)
+            self.endpoint_buffer = []
+        self.connection.commit()
+
+    def track(self, pid, uid, wavelength, state):
+        """
+        Keeps the last state logged for the photon pid (and its first wavelength), see end_photon()
+
+        :param state: state row (absorption_counter, intersection_counter, ..., reaction) as in the state table
+        """
+        tracked = self.open_photons.get(pid)
+        original_wavelength = wavelength if tracked is None else tracked[0]
+        self.open_photons[pid] = (original_wavelength, uid, wavelength, state)
+
+    def end_photon(self, pid):
+        """
+        Adds the photon pid to the endpoint table, with the state of its last logged step. Called by the tracer when
+        the photon terminates (the row is written with the next flush()).
+
+        :param pid: photon id
+        """
+        if self.tally is not None:
+            self.tally.end_photon(pid)
+        tracked = self.open_photons.pop(pid, None)
+        if tracked is None:
+            return
+        original_wavelength, uid, wavelength, state = tracked
+        fate = photon_fate(state[0], state[3], state[11], state[9], state[10])
+        self.endpoint_buffer.append((uid, pid, fate, state[7], state[8], state[9], state[10], state[0], state[1],
+                                    state[11], state[3], original_wavelength, wavelength))
+
+    def end_photons(self, pids):
+        """ Same as end_photon() for a sequence of photon ids """
+        for pid in pids:
+            self.end_photon(pid)
+
+    def ensure_endpoint(self):
+        """
+        Makes the endpoint table ready for queries: photons still open are terminated, buffered rows are written and
+        the table is rebuilt from the photon and state tables if needed (old DB files, merges without the table).
+        """
+        if self.open_photons:
+            self.end_photons(list(self.open_photons))
+        self.flush()
+        if not self.endpoint_stale:
+            return
+
+        if self.has_table('endpoint'):
+            self.cursor.execute("DELETE FROM endpoint")
+        else:
+            with open(os.path.abspath(DB_SCHEMA), "r") as schema:
+                for line in schema:
+                    if line.startswith("CREATE TABLE endpoint") or line.startswith("CREATE INDEX endpoint"):
+                        self.cursor.execute(line.replace("CREATE TABLE", "CREATE TEMP TABLE"))
+        original_wavelength = dict(self.cursor.execute(
+            "SELECT pid, wavelength FROM photon WHERE uid IN (SELECT MIN(uid) FROM photon GROUP BY pid)").fetchall())
+        rows = self.cursor.execute(
+            "SELECT photon.uid, pid, absorption_counter, intersection_counter, killed, reaction, container_obj, "
+            "on_surface_obj, surface_id, ray_direction_bound, wavelength FROM photon JOIN state "
+            "ON state.uid = photon.uid WHERE photon.uid IN (SELECT MAX(uid) FROM photon GROUP BY pid)").fetchall()
+        self.cursor.executemany('INSERT INTO endpoint VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                                [(uid, pid, photon_fate(absorptions, killed, reaction, surface_id, bound), container,
+                                  on_surface, surface_id, bound, absorptions, intersections, reaction, killed,
+                                  original_wavelength[pid], wavelength)
+                                 for uid, pid, absorptions, intersections, killed, reaction, container, on_surface,
+                                 surface_id, bound, wavelength in rows])
+        self.connection.commit()
+        self.endpoint_stale = False
+        self.logger.debug("Endpoint table rebuilt (" + str(len(rows)) + " photons)")
+
+    def log_batch(self, pid, wavelength, position, direction, absorption_counter, intersection_counter, active,
+                  killed, reaction, source=None, container_obj=None, on_surface_obj=None, surface_id=None,
+                  ray_direction_bound=None, surface_normal=None):
+        """
+        Adds a batch of photon states (one uid per photon) in the database, with one executemany() per table.
+        Used by BatchTracer, every argument is either a per-photon sequence (same length as pid) or a scalar.
+
+        :param pid: sequence of photon ids
+        :param wavelength: sequence of wavelengths
+        :param position: (n, 3) array of positions
+        :param direction: (n, 3) array of directions
+        :param absorption_counter: sequence of absorption counters
+        :param intersection_counter: sequence of intersection counters
+        :param active: sequence (or scalar) of active flags
+        :param killed: sequence (or scalar) of killed flags
+        :param reaction: sequence (or scalar) of reaction flags
+        :param source: name of the light source
+        :param container_obj: sequence of container names (None for no container)
+        :param on_surface_obj: sequence of names of the objects the photons are on (None if in volume)
+        :param surface_id: sequence of surface identifiers (None if the photon is not on its exit_device surface)
+        :param ray_direction_bound: sequence of 'In'/'Out' labels (None if the photon is not on a surface)
+        :param surface_normal: (n, 3) array of surface normals, rows are stored only where surface_id is not None
+        """
+        if self.tally is not None:
+            self.tally.log_batch(pid, wavelength, position, direction, absorption_counter, intersection_counter, active,
+                                 killed, reaction, source=source, container_obj=container_obj,
+                                 on_surface_obj=on_surface_obj, surface_id=surface_id,
+                                 ray_direction_bound=ray_direction_bound, surface_normal=surface_normal)
+        n = len(pid)
+        if n == 0:
+            return
+        # Keep uids in order with the rows still in the buffer
+        if self.buffered:
+            self.flush()
+        uids = list(range(self.uid, self.uid + n))
+
+        def column(value, cast=None):
+            if value is None or np.isscalar(value):
+                return [value if cast is None or value is None else cast(value)] * n
+            value = np.asarray(value).tolist()
+            return value if cast is None else [cast(v) for v in value]
+
+        pid = column(pid, int)
+        position = np.asarray(position, dtype=float).tolist()
+        direction = np.asarray(direction, dtype=float).tolist()
+        surface_id = column(surface_id)
+
+        wavelength = column(wavelength, float)
+        self.cursor.executemany('INSERT INTO photon VALUES (?, ?, ?)', zip(uids, pid, wavelength))
+        self.cursor.executemany('INSERT INTO position VALUES (?, ?, ?, ?)',
+                                [(p[0], p[1], p[2], uid) for p, uid in zip(position, uids)])
+        self.cursor.executemany('INSERT INTO direction VALUES (?, ?, ?, ?)',
+                                [(d[0], d[1], d[2], uid) for d, uid in zip(direction, uids)])
+
+        if surface_normal is not None:
+            surface_normal = np.asarray(surface_normal, dtype=float).tolist()
+            self.cursor.executemany('INSERT INTO surface_normal VALUES (?, ?, ?, ?)',
+                                    [(s[0], s[1], s[2], uid) for s, sid, uid in zip(surface_normal, surface_id, uids)
+                                     if sid is not None])
+
+        values = list(zip(column(absorption_counter, int), column(intersection_counter, int), column(active, bool),
+                          column(killed, bool), column(source), [None] * n, [None] * n, column(container_obj),
+                          [str(obj) for obj in column(on_surface_obj)], [str(sid) for sid in surface_id],
+                          [str(bound) for bound in column(ray_direction_bound)], column(reaction, bool), uids))
+        self.cursor.executemany('INSERT INTO state VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', values)
+        for row_pid, uid, row_wavelength, state in zip(pid, uids, wavelength, values):
+            self.track(row_pid, uid, row_wavelength, state)
+
+        self.connection.commit()
+        self.uid += n
+
     def dump_to_file(self, location=None):
         """
         Saves to file the current DB to a given location. Useful for in-memory DBs
@@ -161,6 +441,7 @@ class PhotonDatabase(object):
         :return:
         """
         import sqlitebck
+        self.flush()
         if location is None:
             filename = os.path.join(os.path.expanduser('~'), 'pvtracedb.sql')
         else:
@@ -175,35 +456,60 @@ class PhotonDatabase(object):
         sqlitebck.copy(self.connection, file_connection)
         self.logger.info("DB copy saved as "+str(filename))
 
-    def add_db_file(self, filename=None, tables=None):
+    def add_db_file(self, filename=None, tables=None, uid_offset=None):
         """
         Adds the data in the give filename db to the current DB (only the tables in tables)
 
-        Used by split_db option to re-merge dumped dbs at the end of simulation
+        Used by split_db option to re-merge dumped dbs at the end of simulation and by Tracer workers
 
         :param filename: Filename of the db to be added
-        :param tables: Tables to be added
+        :param tables: Tables to be added (all by default)
+        :param uid_offset: if not None, it is added to the uids of the merged rows and self.uid is moved after them
         """
+        self.flush()
+        self.cursor.execute("ATTACH DATABASE ? AS  toMerge", [filename])
         if tables is None:
             tables = ("photon", "state", "direction", "position", "surface_normal", "polarisation")
-        self.cursor.execute("ATTACH DATABASE ? AS  toMerge", [filename])
+            if self.has_table("endpoint", schema="toMerge"):
+                tables += ("endpoint",)
+        # Without the endpoint rows of the merged photons the table is rebuilt before the next query
+        if "endpoint" not in tables:
+            self.endpoint_stale = True
 
         # self.cursor.execute("BEGIN TRANSACTION")
         for table in tables:
-            self.cursor.execute("INSERT INTO "+table+" SELECT * FROM toMerge."+table)
-        # self.connection.commit()
+            if uid_offset is None:
+                self.cursor.execute("INSERT INTO "+table+" SELECT * FROM toMerge."+table)
+            else:
+                columns = [row[1] for row in self.cursor.execute("PRAGMA table_info("+table+")").fetchall()]
+                selection = ", ".join("uid + ?" if column == "uid" else column for column in columns)
+                self.cursor.execute("INSERT INTO "+table+" SELECT "+selection+" FROM toMerge."+table,
+                                    (int(uid_offset),))
+        # The attached DB cannot be detached within a transaction
+        self.connection.commit()
         self.cursor.execute("DETACH DATABASE toMerge")
 
+        if uid_offset is not None:
+            last_uid = self.cursor.execute("SELECT MAX(uid) FROM photon").fetchone()[0]
+            if last_uid is not None:
+                self.uid = last_uid + 1
+
     def empty(self):
         """
         Empties the DB
         """
+        self.buffered = 0
+        self.open_photons = {}
+        self.endpoint_buffer = []
+        self.cursor.execute("DELETE FROM endpoint")
         self.cursor.execute("DELETE FROM state")
         self.cursor.execute("DELETE FROM direction")
         self.cursor.execute("DELETE FROM polarisation")
         self.cursor.execute("DELETE FROM position")
         self.cursor.execute("DELETE FROM surface_normal")
         self.cursor.execute("DELETE FROM photon")
+        # VACUUM cannot run within the transaction of the deletes
+        self.connection.commit()
         self.cursor.execute("VACUUM")
         self.connection.commit()
 
@@ -216,20 +522,23 @@ class PhotonDatabase(object):
 
         :rtype: list
         """
-        return itemise(self.cursor.execute('SELECT MAX(uid) FROM photon GROUP BY pid;').fetchall())
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute('SELECT uid FROM endpoint ORDER BY pid;').fetchall())
     
     def endpoint_uids_for_object(self, obj):
-        return itemise(self.cursor.execute("SELECT MAX(uid) FROM photon GROUP BY pid INTERSECT SELECT uid FROM state"
-                                           "WHERE on_surface_obj=? OR container_obj=?", (obj, obj)).fetchall())
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute("SELECT uid FROM endpoint WHERE on_surface_obj=? OR container_obj=? "
+                                           "ORDER BY uid", (obj, obj)).fetchall())
     
     def endpoint_uids_for_surface(self, surface):
-        return itemise(self.cursor.execute("SELECT MAX(uid) FROM photon GROUP BY pid INTERSECT SELECT uid"
-                                           "FROM state WHERE surface_id=?;", (surface,)).fetchall())
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute("SELECT uid FROM endpoint WHERE surface_id=? ORDER BY uid;",
+                                           (surface,)).fetchall())
     
     def endpoint_uids_for_object_and_surface(self, obj, surface):
+        self.ensure_endpoint()
         return itemise(self.cursor.execute(
-            "SELECT MAX(uid) FROM photon GROUP BY pid INTERSECT"
-            "SELECT uid FROM state WHERE on_surface_obj=? AND surface_id=?;", (obj, surface)).fetchall())
+            "SELECT uid FROM endpoint WHERE on_surface_obj=? AND surface_id=? ORDER BY uid;", (obj, surface)).fetchall())
     
     def endpoint_uids_outbound_for_object_and_surface(self, obj, surface, luminescent=None, solar=None):
         """
@@ -239,42 +548,42 @@ class PhotonDatabase(object):
         If both are True then both types are returned i.e. the default behaviour.
         Setting the keywords to any other value is ignored.
         """
+        self.ensure_endpoint()
         if luminescent == solar and luminescent is None:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN'
-                '(SELECT uid FROM state WHERE ray_direction_bound = "Out" AND on_surface_obj=? AND surface_id=?'
-                'GROUP BY uid);', (obj, surface)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'Out' AND on_surface_obj=? "
+                "ORDER BY pid;", (surface, obj)).fetchall())
         elif luminescent:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN'
-                '(SELECT uid FROM state WHERE'
-                'ray_direction_bound = "Out" AND on_surface_obj=? AND surface_id=? AND absorption_counter > 0'
-                'GROUP BY uid);', (obj, surface)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'Out' AND on_surface_obj=? "
+                "AND absorption_counter > 0 ORDER BY pid;", (surface, obj)).fetchall())
         elif solar:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN'
-                '(SELECT uid FROM state WHERE'
-                'ray_direction_bound = "Out" AND on_surface_obj=? AND surface_id=? AND absorption_counter = 0'
-                'GROUP BY uid);', (obj, surface)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'Out' AND on_surface_obj=? "
+                "AND absorption_counter = 0 ORDER BY pid;", (surface, obj)).fetchall())
         else:
             print("Cannot return any uids for this question."
                   "Are you using the function uids_out_bound_on_surface correctly?")
             return []
 
     def endpoint_uids_for_nonradiative_loss(self):
+        self.ensure_endpoint()
         return itemise(self.cursor.execute(
-            "SELECT uid FROM state WHERE surface_id = 'None' AND absorption_counter > 0 AND killed = 0"
-            "GROUP BY uid HAVING uid IN (SELECT MAX(uid) FROM photon group BY pid)").fetchall())
+            "SELECT uid FROM endpoint WHERE surface_id = 'None' AND absorption_counter > 0 AND killed = 0 "
+            "ORDER BY uid").fetchall())
     
     def endpoint_uids_for_nonradiative_loss_in_object(self, obj):
+        self.ensure_endpoint()
         return itemise(self.cursor.execute(
-            "SELECT uid FROM state WHERE"
-            "container_obj=? AND surface_id = 'None' AND absorption_counter > 0 AND killed = 0"
-            "GROUP BY uid HAVING uid IN (SELECT MAX(uid) FROM photon group BY pid)", (obj,)).fetchall())
+            "SELECT uid FROM endpoint WHERE "
+            "container_obj=? AND surface_id = 'None' AND absorption_counter > 0 AND killed = 0 "
+            "ORDER BY uid", (obj,)).fetchall())
     
     def killed(self):
         """ Returns the uid of killed photons (one that took too many steps to complete). """
-        return itemise(self.cursor.execute('SELECT uid FROM state WHERE killed = 1').fetchall())
+        # Killed photons are logged as such only in their last step
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute("SELECT uid FROM endpoint WHERE fate = 'killed' ORDER BY uid").fetchall())
 
     def objects_with_records(self):
         """ Returns a list of which scene object have been hit by rays. """
@@ -291,9 +600,10 @@ class PhotonDatabase(object):
 
     def surfaces_with_records(self):
         """ Returns surfaces that have been hit by a ray for all exiting objects. """
+        # Endpoints have a surface normal only if they are on a surface
+        self.ensure_endpoint()
         keys = self.cursor.execute(
-            'SELECT DISTINCT surface_id FROM state WHERE uid IN (SELECT uid FROM surface_normal'
-            'WHERE uid IN (SELECT MAX(uid) FROM photon GROUP BY pid));').fetchall()
+            "SELECT DISTINCT surface_id FROM endpoint WHERE surface_id != 'None' ORDER BY surface_id;").fetchall()
         keys = itemise(keys)
         filtered_keys = []
         # Surface record will often be None because event occur away from surface (i.e. absorption emission)
@@ -305,10 +615,10 @@ class PhotonDatabase(object):
     
     def surfaces_with_records_for_object(self, obj):
         """ Returns a list of surface to 'object' that have been hit by a ray. """
+        self.ensure_endpoint()
         keys = self.cursor.execute(
-            'SELECT DISTINCT surface_id FROM state WHERE uid IN (SELECT uid FROM surface_normal'
-            'WHERE uid IN (SELECT MAX(uid) FROM photon GROUP BY pid))'
-            'INTERSECT SELECT DISTINCT surface_id FROM state WHERE container_obj=?;', (obj,)).fetchall()
+            "SELECT DISTINCT surface_id FROM endpoint WHERE surface_id != 'None' "
+            "INTERSECT SELECT DISTINCT surface_id FROM state WHERE container_obj=?;", (obj,)).fetchall()
         keys = itemise(keys)
         filtered_keys = []
         for key in keys:
@@ -333,21 +643,19 @@ class PhotonDatabase(object):
         returned. If both are True then both types are returned i.e. the default behaviour.
         Setting the keywords to any other value is ignored.
         """
+        self.ensure_endpoint()
         if luminescent == solar:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN ('
-                'SELECT uid FROM state WHERE ray_direction_bound = "Out" AND surface_id=? GROUP BY uid);',
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'Out' ORDER BY pid;",
                 (surface_id,)).fetchall())
         elif luminescent:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN ('
-                'SELECT uid FROM state WHERE ray_direction_bound = "Out" '
-                'AND surface_id=? AND absorption_counter > 0 GROUP BY uid);', (surface_id,)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'Out' "
+                "AND absorption_counter > 0 ORDER BY pid;", (surface_id,)).fetchall())
         elif solar:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN ('
-                'SELECT uid FROM state WHERE ray_direction_bound = "Out"'
-                'AND surface_id=? AND absorption_counter = 0 GROUP BY uid);', (surface_id,)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'Out' "
+                "AND absorption_counter = 0 ORDER BY pid;", (surface_id,)).fetchall())
         else:
             self.logger.info("Cannot return any uids for this question."
                              "Are you using the function uids_out_bound_on_surface correctly?")
@@ -362,21 +670,19 @@ class PhotonDatabase(object):
         If both are True then both types are returned i.e. the default behaviour.
         Setting the keywords to any other value is ignored.
         """
+        self.ensure_endpoint()
         if luminescent == solar:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN ('
-                'SELECT uid FROM state WHERE ray_direction_bound = "In" AND surface_id=? GROUP BY uid);',
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'In' ORDER BY pid;",
                 (surface_id,)).fetchall())
         elif luminescent:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN ('
-                'SELECT uid FROM state WHERE ray_direction_bound = "In" AND'
-                'surface_id=? AND absorption_counter > 0 GROUP BY uid);', (surface_id,)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'In' "
+                "AND absorption_counter > 0 ORDER BY pid;", (surface_id,)).fetchall())
         elif solar:
             return itemise(self.cursor.execute(
-                'SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN ('
-                'SELECT uid FROM state WHERE ray_direction_bound = "In" AND surface_id=? AND absorption_counter = 0'
-                'GROUP BY uid);', (surface_id,)).fetchall())
+                "SELECT uid FROM endpoint WHERE surface_id=? AND ray_direction_bound = 'In' "
+                "AND absorption_counter = 0 ORDER BY pid;", (surface_id,)).fetchall())
         else:
             print("Cannot return any uids for this question."
                   "Are you using the function uids_in_bound_on_surface correctly?")
@@ -384,29 +690,42 @@ class PhotonDatabase(object):
     
     def uids_in_reactor(self):
         """ Returns the uids of all the photons in the reactor channels. """
-        return itemise(self.cursor.execute(
-            "SELECT MAX(uid) FROM photon GROUP BY pid INTERSECT SELECT uid FROM state WHERE reaction = 1"))
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute("SELECT uid FROM endpoint WHERE reaction = 1 ORDER BY uid"))
     
     def uids_in_reactor_and_luminescent(self):
         """ Returns photons in reactor and luminescent."""
         # One absorption is the reaction mixture itself, so > 1 to account for dye absorption (i.e. luminescent).
+        self.ensure_endpoint()
         return itemise(self.cursor.execute(
-            "SELECT MAX(uid) FROM photon GROUP BY pid INTERSECT "
-            "SELECT uid FROM state WHERE reaction = 1 AND absorption_counter > 1"))
+            "SELECT uid FROM endpoint WHERE reaction = 1 AND absorption_counter > 1 ORDER BY uid"))
     
     def uids_luminescent(self):
         """ Returns luminescent photons. """
-        return itemise(self.cursor.execute(
-            "SELECT MAX(uid) FROM photon GROUP BY pid INTERSECT SELECT uid FROM state WHERE absorption_counter > 1"))
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute("SELECT uid FROM endpoint WHERE absorption_counter > 1 ORDER BY uid"))
 
     def uids_first_intersection(self):
         """ Returns the unique identifier of the first intersection for all photons. """
         return self.cursor.execute('SELECT uid FROM state WHERE intersection_counter = 1;').fetchall()
     
+    def endpoint_records(self):
+        """
+        Iterates over the endpoint of each photon (ordered by pid), with one query on the endpoint table.
+
+        :return: iterator of (uid, pid, fate, surface_id, ray_direction_bound, absorption_counter, reaction, killed,
+        original_wavelength, wavelength, intersection_counter) tuples
+        """
+        self.ensure_endpoint()
+        # A separate cursor, so that the rows can be streamed while other queries are executed
+        return self.connection.cursor().execute(
+            "SELECT uid, pid, fate, surface_id, ray_direction_bound, absorption_counter, reaction, killed, "
+            "original_wavelength, wavelength, intersection_counter FROM endpoint ORDER BY pid")
+
     def uids_generated_photons(self, max=False):
         """ Returns the unique identifier of the first (or last) step of each generated photon. """
         if max:
-            return itemise(self.cursor.execute('SELECT MAX(uid) FROM photon GROUP BY pid;').fetchall())
+            return self.endpoint_uids()
         else:
             return itemise(self.cursor.execute('SELECT MIN(uid) FROM photon GROUP BY pid;').fetchall())
     
@@ -415,9 +734,9 @@ class PhotonDatabase(object):
         if isinstance(uid, int) or isinstance(uid, float):
             return itemise(self.cursor.execute("SELECT pid FROM photon WHERE uid=?", (uid,)).fetchall())[0]
         elif isinstance(uid, list) or isinstance(uid, tuple):
-            items = str(uid)[1:-1]
-            cmd = "SELECT pid FROM photon WHERE uid IN ({0})".format(items)
-            return itemise(self.cursor.execute(cmd).fetchall())
+            self.select(uid)
+            return itemise(self.cursor.execute(
+                "SELECT pid FROM photon WHERE uid IN (SELECT value FROM selection)").fetchall())
 
     def uids_for_pid(self, pid):
         """ Returns all the uids associated to a given photon ID. """
@@ -434,10 +753,10 @@ class PhotonDatabase(object):
         return itemise(self.cursor.execute('SELECT intersection_counter FROM state WHERE uid=?', (uid,)))
 
     def uids_top_reflections(self):
+        self.ensure_endpoint()
         return itemise(self.cursor.execute(
-            "SELECT MAX(uid) FROM photon GROUP BY pid HAVING uid IN"
-            "(SELECT uid FROM state WHERE ray_direction_bound = 'Out'"
-            "AND surface_id='top' AND intersection_counter = 1  GROUP BY uid);").fetchall())
+            "SELECT uid FROM endpoint WHERE surface_id='top' AND ray_direction_bound = 'Out' "
+            "AND intersection_counter = 1 ORDER BY pid;").fetchall())
 
     # This is about 2x faster than the implementation above, but slightly less safe (depending on obj in scene)
     def count_top_reflections(self):
@@ -446,10 +765,59 @@ class PhotonDatabase(object):
             "AND intersection_counter = 1  GROUP BY uid)").fetchall())
 
     def uids_nonradiative_losses(self):
-        return itemise(self.cursor.execute(
-            "SELECT uid FROM state WHERE reaction = 0 AND surface_id = 'None' AND absorption_counter > 0 AND killed = 0"
-            " GROUP BY uid HAVING uid IN (SELECT MAX(uid) FROM photon GROUP BY pid)").fetchall())
+        # reaction = 0 AND surface_id = 'None' AND absorption_counter > 0 AND killed = 0 (see photon_fate())
+        self.ensure_endpoint()
+        return itemise(self.cursor.execute("SELECT uid FROM endpoint WHERE fate = 'loss' ORDER BY uid").fetchall())
     
+    def select(self, values):
+        """
+        Loads a sequence of uids (or pids) in the temporary table selection(position, value), so that queries on
+        arrays of ids can join it instead of formatting the ids in the SQL (IN (...) lists).
+
+        :param values: sequence of ids, position is their index in the sequence
+        """
+        self.flush()
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS selection(position INTEGER PRIMARY KEY, value INTEGER)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS temp.selection_value ON selection(value)")
+        self.cursor.execute("DELETE FROM selection")
+        self.cursor.executemany("INSERT INTO selection VALUES (?, ?)",
+                                enumerate(np.asarray(values, dtype=np.int64).tolist()))
+
+    def values_for_uids(self, table, columns, uids, dtype=float, missing=np.nan):
+        """
+        Returns the values of the columns of table for an array of uids with a single query (bulk version of
+        value_for_table_column_uid()).
+
+        :param table: DB table (photon, state, position...)
+        :param columns: column name or sequence of column names
+        :param uids: sequence of uids
+        :param dtype: dtype of the returned array (object for text columns)
+        :param missing: value for the uids without a row in table (e.g. polarisation)
+        :return: array aligned with uids, with shape (len(uids),) for a column name, (len(uids), len(columns)) otherwise
+        """
+        single = isinstance(columns, str)
+        if single:
+            columns = [columns]
+        values = np.empty((len(uids), len(columns)), dtype=dtype)
+        values[:] = missing
+        if len(uids):
+            self.select(uids)
+            rows = self.cursor.execute(
+                "SELECT selection.position, " + ", ".join(table + "." + column for column in columns) +
+                " FROM selection JOIN " + table + " ON " + table + ".uid = selection.value").fetchall()
+            if rows:
+                positions = [row[0] for row in rows]
+                values[positions] = [row[1:] for row in rows]
+        return values[:, 0] if single else values
+
+    def bounces_for_uids(self, uids):
+        """ Returns the number of bounces for an array of uids (see bounces_for_uid()). """
+        return self.values_for_uids('state', 'intersection_counter', uids, dtype=int, missing=0)
+
+    def wavelengths_for_uids(self, uids):
+        """ Returns the wavelength for an array of uids, aligned with uids (see wavelength_for_uid()). """
+        return self.values_for_uids('photon', 'wavelength', uids)
+
     def value_for_table_column_uid(self, table, column, uid):
         """
         Returns values from the database index my table, column and row, where the row is uniquely defined using
@@ -479,28 +847,27 @@ class PhotonDatabase(object):
         if isinstance(uid, int) or isinstance(uid, float):
             return np.array(self.cursor.execute("SELECT x,y,z FROM direction WHERE uid = ?", (uid,)).fetchall()[0])
         elif isinstance(uid, list) or isinstance(uid, tuple):
-            # This has a variable number of items so ignoring the secure way to do this... me bad
-            items = str(uid)[1:-1]
-            cmd = "SELECT x,y,z FROM direction WHERE uid IN (%s)" % (items,)
-            return self.cursor.execute(cmd).fetchall()
+            self.select(uid)
+            return self.cursor.execute(
+                "SELECT x,y,z FROM direction WHERE uid IN (SELECT value FROM selection)").fetchall()
 
     # Returns the polarization of the selected uid or list of uids
     def polarisation_for_uid(self, uid):
         if isinstance(uid, int) or isinstance(uid, float):
             return np.array(self.cursor.execute("SELECT x,y,z FROM polarisation WHERE uid = ?", (uid,)).fetchall()[0])
         elif isinstance(uid, list) or isinstance(uid, tuple):
-            items = str(uid)[1:-1]
-            cmd = "SELECT x,y,z FROM polarisation WHERE uid IN (%s)" % (items,)
-            return self.cursor.execute(cmd).fetchall()
+            self.select(uid)
+            return self.cursor.execute(
+                "SELECT x,y,z FROM polarisation WHERE uid IN (SELECT value FROM selection)").fetchall()
 
     # Returns the position of the selected uid or list of uids
     def position_for_uid(self, uid):
         if isinstance(uid, int) or isinstance(uid, float):
             return np.array(self.cursor.execute("SELECT x,y,z FROM position WHERE uid = ?", (uid,)).fetchall()[0])
         elif isinstance(uid, list) or isinstance(uid, tuple):
-            items = str(uid)[1:-1]
-            cmd = "SELECT x,y,z FROM position WHERE uid IN (%s)" % items
-            return self.cursor.execute(cmd).fetchall()
+            self.select(uid)
+            return self.cursor.execute(
+                "SELECT x,y,z FROM position WHERE uid IN (SELECT value FROM selection)").fetchall()
 
     # Returns the wavelength of the selected uid or list of uids
     # SEE ALSO: original_wavelength_for_uid() for the lightsource-emitted photon wavelength (e.g. for photon balance)
@@ -508,10 +875,9 @@ class PhotonDatabase(object):
         if isinstance(uid, int) or isinstance(uid, float):
             return np.array(self.cursor.execute("SELECT wavelength FROM photon WHERE uid = ?", (uid,)).fetchall()[0])
         elif isinstance(uid, list) or isinstance(uid, tuple):
-            items = str(uid)[1:-1]
-            cmd = "SELECT wavelength FROM photon WHERE uid IN (%s)" % (items,)
-            values = itemise(self.cursor.execute(cmd).fetchall())
-            return values
+            self.select(uid)
+            return itemise(self.cursor.execute(
+                "SELECT wavelength FROM photon WHERE uid IN (SELECT value FROM selection)").fetchall())
 
     # Returns the wavelength of the selected pid or list of pids
     def wavelength_for_pid(self, pid):
@@ -519,10 +885,10 @@ class PhotonDatabase(object):
             return np.array(self.cursor.execute("SELECT min(wavelength) FROM photon WHERE pid = ? GROUP BY pid",
                                                 (pid,)).fetchall()[0])
         elif isinstance(pid, list) or isinstance(pid, tuple):
-            items = str(pid)[1:-1]
-            cmd = "SELECT min(wavelength) FROM photon WHERE pid IN (%s) GROUP BY pid" % (items,)
-            values = itemise(self.cursor.execute(cmd).fetchall())
-            return values
+            self.select(pid)
+            return itemise(self.cursor.execute(
+                "SELECT min(wavelength) FROM photon WHERE pid IN (SELECT value FROM selection) "
+                "GROUP BY pid").fetchall())
 
     # Returns the initial wavelength of the selected uid or list of uids
     def original_wavelength_for_uid(self, uid):
@@ -531,9 +897,9 @@ class PhotonDatabase(object):
                                                 "(SELECT pid FROM photon WHERE uid = ?)",
                                                 (uid,)).fetchall()[0])
         elif isinstance(uid, list) or isinstance(uid, tuple):
-            items = str(uid)[1:-1]
-            cmd = "SELECT min(wavelength) FROM photon GROUP BY pid HAVING pid IN" \
-                  "(SELECT pid FROM photon WHERE uid IN (%s))" % (items,)
-            values = itemise(self.cursor.execute(cmd).fetchall())
+            self.select(uid)
+            values = itemise(self.cursor.execute(
+                "SELECT min(wavelength) FROM photon GROUP BY pid HAVING pid IN"
+                "(SELECT pid FROM photon WHERE uid IN (SELECT value FROM selection))").fetchall())
             return values
 
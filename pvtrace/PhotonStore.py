@@ -0,0 +1,768 @@
+"""
+Columnar photon store: an alternative to the SQLite PhotonDatabase backend.
+
+Every step (uid) is a row of a set of column arrays (pid, wavelength, position, ..., surface_id) instead of six
+tables joined by uid, so that the analysis queries are evaluated with vectorised masks. Text columns (object names,
+surface ids...) are stored as integer codes plus a list of labels.
+The store is saved as a single file: HDF5 with gzip-compressed chunked datasets if h5py is available (.h5), otherwise
+a .npz archive whose (uncompressed) columns are memory-mapped when loaded. Columns are loaded only when first queried.
+"""
+
+from __future__ import division, print_function
+import json
+import logging
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from pvtrace.PhotonDatabase import photon_fate
+
+# Optional dependency, imported by _h5py() when a store is first saved or loaded (False: not imported yet)
+h5py = False
+
+# Numeric columns: name -> (dtype, width)
+NUMERIC_COLUMNS = (('uid', np.int64, 1), ('pid', np.int64, 1), ('wavelength', np.float64, 1),
+                   ('position', np.float64, 3), ('direction', np.float64, 3), ('polarisation', np.float64, 3),
+                   ('has_polarisation', np.bool_, 1), ('surface_normal', np.float64, 3),
+                   ('has_surface_normal', np.bool_, 1), ('absorption_counter', np.int32, 1),
+                   ('intersection_counter', np.int32, 1), ('active', np.bool_, 1), ('killed', np.bool_, 1),
+                   ('reaction', np.bool_, 1))
+TEXT_COLUMNS = ('source', 'emitter_material', 'absorber_material', 'container_obj', 'on_surface_obj', 'surface_id',
+                'ray_direction_bound')
+# The columns of the SQL schema (see dbschema.sql) as (column, component) of the store
+SQL_COLUMNS = {
+    'photon': {'uid': ('uid', None), 'pid': ('pid', None), 'wavelength': ('wavelength', None)},
+    'position': {'x': ('position', 0), 'y': ('position', 1), 'z': ('position', 2), 'uid': ('uid', None)},
+    'direction': {'x': ('direction', 0), 'y': ('direction', 1), 'z': ('direction', 2), 'uid': ('uid', None)},
+    'polarisation': {'x': ('polarisation', 0), 'y': ('polarisation', 1), 'z': ('polarisation', 2),
+                     'uid': ('uid', None)},
+    'surface_normal': {'x': ('surface_normal', 0), 'y': ('surface_normal', 1), 'z': ('surface_normal', 2),
+                       'uid': ('uid', None)},
+    'state': dict([(name, (name, None)) for name in ('absorption_counter', 'intersection_counter', 'active', 'killed',
+                                                     'reaction', 'uid') + TEXT_COLUMNS])}
+# Rows of the optional tables exist only where the mask column is True
+SQL_MASKS = {'polarisation': 'has_polarisation', 'surface_normal': 'has_surface_normal'}
+
+
+def _h5py():
+    """ Returns the h5py module, None if it is not installed """
+    global h5py
+    if h5py is False:
+        try:
+            import h5py
+        except ImportError:
+            h5py = None
+    return h5py
+
+
+def default_store_filename():
+    """ Returns the filename used to save stores in the working dir (HDF5 if h5py is available, npz otherwise). """
+    return 'db.h5' if _h5py() is not None else 'db.npz'
+
+
+def _memmap_npz(filename):
+    """
+    Returns a dict of column arrays from a npz file. Uncompressed members are memory-mapped, compressed ones are
+    decompressed when the dict value is created.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            with open(filename, 'rb') as archive_file:
+                # Skip the zip local header to the start of the .npy data
+                archive_file.seek(info.header_offset)
+                header = archive_file.read(30)
+                name_length, extra_length = struct.unpack('<HH', header[26:30])
+                archive_file.seek(info.header_offset + 30 + name_length + extra_length)
+                version = np.lib.format.read_magic(archive_file)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(archive_file)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(archive_file)
+                offset = archive_file.tell()
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+class PhotonStore(object):
+    """
+    Columnar photon store with the same logging and query interface of PhotonDatabase.
+    """
+
+    def __init__(self, dbfile=None, readonly=False, buffer_size=None):
+        """
+        Creates an empty store or loads an existing one.
+
+        :param dbfile: filename of the store. If the file exists (or readonly is True) it is loaded, otherwise it is
+        the default location of dump_to_file()
+        :param readonly: load an existing file
+        :param buffer_size: rows logged with log() are moved to column arrays every buffer_size steps (default 10000)
+        """
+        super(PhotonStore, self).__init__()
+        self.uid = 0
+        self.split_size = 20000
+        self.logger = logging.getLogger('pvtrace.PhotonStore')
+        # Optional PhotonTally fed with the same steps and photon ends (see PhotonDatabase)
+        self.tally = None
+        self.readonly = readonly
+        self.file = dbfile
+        self.buffer_size = buffer_size if buffer_size is not None else 10000
+        self.empty()
+
+        if dbfile is not None and (readonly or os.path.exists(dbfile)):
+            self.load(dbfile)
+
+    def empty(self):
+        """
+        Empties the store
+        """
+        # Chunks of column arrays, concatenated when queried
+        self.chunks = dict((name, []) for name, _, _ in NUMERIC_COLUMNS)
+        self.chunks.update((name, []) for name in TEXT_COLUMNS)
+        self.labels = dict((name, []) for name in TEXT_COLUMNS)
+        self.codes = dict((name, {}) for name in TEXT_COLUMNS)
+        self.pending = []
+        self.buffered = 0
+        self.source = None
+        self.cache = {}
+
+    def load(self, dbfile):
+        """ Loads (lazily) the columns of a store file. """
+        self.empty()
+        h5py = _h5py()
+        if h5py is not None and h5py.is_hdf5(dbfile):
+            self.source = h5py.File(dbfile, 'r')
+            labels = json.loads(self.source.attrs['labels'])
+        else:
+            self.source = _memmap_npz(dbfile)
+            labels = json.loads(bytes(np.asarray(self.source['labels'])).decode('utf-8'))
+        for name in TEXT_COLUMNS:
+            self.labels[name] = labels[name]
+            self.codes[name] = dict((label, code) for code, label in enumerate(labels[name]))
+        uids = self.column('uid')
+        self.uid = int(uids.max()) + 1 if len(uids) else 0
+        self.logger.debug('Loaded photon store ' + str(dbfile))
+
+    # --- Writing ---
+
+    def log(self, photon, surface_normal=None, surface_id=None, ray_direction_bound=None,
+            emitter_material=None, absorber_material=None):
+        """
+        Adds a photon state (uid) in the store (see PhotonDatabase.log).
+        """
+        if self.tally is not None:
+            self.tally.log(photon, surface_normal, surface_id, ray_direction_bound, emitter_material, absorber_material)
+        container_obj = None if photon.container is None else str(photon.container.name)
+        on_surface_obj = None if photon.on_surface_object is None else photon.on_surface_object.name
+        polarisation = photon.polarisation
+        self.pending.append((self.uid, photon.id, float(photon.wavelength), tuple(photon.position),
+                             tuple(photon.direction), polarisation, surface_normal, photon.absorption_counter,
+                             photon.intersection_counter, photon.active, photon.killed, photon.reaction,
+                             photon.source, emitter_material, absorber_material, container_obj, str(on_surface_obj),
+                             str(surface_id), str(ray_direction_bound)))
+        self.uid += 1
+        if len(self.pending) >= self.buffer_size:
+            self.flush()
+
+    def log_batch(self, pid, wavelength, position, direction, absorption_counter, intersection_counter, active,
+                  killed, reaction, source=None, container_obj=None, on_surface_obj=None, surface_id=None,
+                  ray_direction_bound=None, surface_normal=None):
+        """
+        Adds a batch of photon states (see PhotonDatabase.log_batch).
+        """
+        if self.tally is not None:
+            self.tally.log_batch(pid, wavelength, position, direction, absorption_counter, intersection_counter, active,
+                                 killed, reaction, source=source, container_obj=container_obj,
+                                 on_surface_obj=on_surface_obj, surface_id=surface_id,
+                                 ray_direction_bound=ray_direction_bound, surface_normal=surface_normal)
+        n = len(pid)
+        if n == 0:
+            return
+        self.flush()
+
+        def column(value):
+            if value is None or np.isscalar(value):
+                return [value] * n
+            return np.asarray(value).tolist()
+
+        surface_id = column(surface_id)
+        has_normal = np.array([sid is not None for sid in surface_id])
+        if surface_normal is None:
+            surface_normal = np.zeros((n, 3))
+            has_normal[:] = False
+        self.append({'uid': np.arange(self.uid, self.uid + n), 'pid': np.asarray(pid),
+                     'wavelength': np.asarray(wavelength, dtype=float), 'position': np.asarray(position, dtype=float),
+                     'direction': np.asarray(direction, dtype=float), 'polarisation': np.zeros((n, 3)),
+                     'has_polarisation': np.zeros(n, dtype=bool),
+                     'surface_normal': np.asarray(surface_normal, dtype=float), 'has_surface_normal': has_normal,
+                     'absorption_counter': np.broadcast_to(absorption_counter, (n,)),
+                     'intersection_counter': np.broadcast_to(intersection_counter, (n,)),
+                     'active': np.broadcast_to(active, (n,)), 'killed': np.broadcast_to(killed, (n,)),
+                     'reaction': np.broadcast_to(reaction, (n,))},
+                    {'source': column(source), 'emitter_material': [None] * n, 'absorber_material': [None] * n,
+                     'container_obj': column(container_obj),
+                     'on_surface_obj': [str(obj) for obj in column(on_surface_obj)],
+                     'surface_id': [str(sid) for sid in surface_id],
+                     'ray_direction_bound': [str(bound) for bound in column(ray_direction_bound)]})
+        self.uid += n
+
+    def end_photon(self, pid):
+        """ Endpoints are computed from the columns (see endpoint_rows()), only the tally (if any) is updated """
+        if self.tally is not None:
+            self.tally.end_photon(pid)
+
+    def end_photons(self, pids):
+        if self.tally is not None:
+            self.tally.end_photons(pids)
+
+    def flush(self):
+        """
+        Moves the rows logged with log() to the column arrays.
+        """
+        if not self.pending:
+            return
+        rows = self.pending
+        self.pending = []
+        n = len(rows)
+        fields = list(zip(*rows))
+        polarisation = np.array([p if p is not None else (0., 0., 0.) for p in fields[5]], dtype=float)
+        surface_normal = np.array([s if s is not None else (0., 0., 0.) for s in fields[6]], dtype=float)
+        self.append({'uid': np.array(fields[0]), 'pid': np.array([-1 if p is None else p for p in fields[1]]),
+                     'wavelength': np.array(fields[2]), 'position': np.array(fields[3]).reshape(n, 3),
+                     'direction': np.array(fields[4]).reshape(n, 3), 'polarisation': polarisation.reshape(n, 3),
+                     'has_polarisation': np.array([p is not None for p in fields[5]]),
+                     'surface_normal': surface_normal.reshape(n, 3),
+                     'has_surface_normal': np.array([s is not None for s in fields[6]]),
+                     'absorption_counter': np.array(fields[7]), 'intersection_counter': np.array(fields[8]),
+                     'active': np.array(fields[9]), 'killed': np.array(fields[10]), 'reaction': np.array(fields[11])},
+                    dict((name, list(fields[12 + i])) for i, name in enumerate(TEXT_COLUMNS)))
+
+    def append(self, numeric, text):
+        """
+        Appends a chunk of rows to the columns.
+
+        :param numeric: dict of arrays for the NUMERIC_COLUMNS
+        :param text: dict of lists of values (None or strings) for the TEXT_COLUMNS
+        """
+        self.materialise()
+        for name, dtype, _ in NUMERIC_COLUMNS:
+            self.chunks[name].append(np.array(numeric[name], dtype=dtype))
+        for name in TEXT_COLUMNS:
+            self.chunks[name].append(self.encode(name, text[name]))
+        self.cache = {}
+
+    def encode(self, name, values):
+        """ Returns the codes of the values of the text column name (adding new labels if needed) """
+        codes = self.codes[name]
+        labels = self.labels[name]
+        encoded = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            if value is not None and not isinstance(value, str):
+                value = str(value)
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(labels)
+                labels.append(value)
+            encoded[i] = code
+        return encoded
+
+    def materialise(self):
+        """ Copies in memory the columns of a loaded file (needed before appending new rows). """
+        if self.source is None:
+            return
+        for name, _, _ in NUMERIC_COLUMNS:
+            self.chunks[name] = [np.array(self.source[name])]
+        for name in TEXT_COLUMNS:
+            self.chunks[name] = [np.array(self.source[name])]
+        h5py = _h5py()
+        if h5py is not None and isinstance(self.source, h5py.File):
+            self.source.close()
+        self.source = None
+
+    def dump_to_file(self, location=None, compress=None):
+        """
+        Saves the store to a single file.
+
+        :param location: filename, '.h5' for HDF5 (needs h5py) otherwise npz. Defaults to the store dbfile.
+        :param compress: compress the columns (default True for HDF5, False for npz so that columns are memory-mapped)
+        """
+        self.flush()
+        if location is None:
+            location = self.file if self.file is not None else os.path.join(os.path.expanduser('~'),
+                                                                             default_store_filename())
+        columns = dict((name, self.column(name)) for name, _, _ in NUMERIC_COLUMNS)
+        columns.update((name, self.column(name, decode=False)) for name in TEXT_COLUMNS)
+        labels = json.dumps(self.labels)
+
+        if location.endswith('.h5'):
+            h5py = _h5py()
+            if h5py is None:
+                raise ImportError("h5py is needed to save the photon store as HDF5, use a .npz location instead.")
+            compression = 'gzip' if compress is None or compress else None
+            with h5py.File(location, 'w') as store_file:
+                for name, values in columns.items():
+                    chunks = (min(max(len(values), 1), 65536),) + values.shape[1:]
+                    store_file.create_dataset(name, data=values, chunks=chunks, compression=compression)
+                store_file.attrs['labels'] = labels
+        else:
+            columns['labels'] = np.frombuffer(labels.encode('utf-8'), dtype=np.uint8)
+            with open(location, 'wb') as store_file:
+                if compress:
+                    np.savez_compressed(store_file, **columns)
+                else:
+                    np.savez(store_file, **columns)
+        self.logger.info("Photon store saved as " + str(location))
+
+    def add_db_file(self, filename=None, tables=None, uid_offset=None):
+        """
+        Adds the rows of another store file (see PhotonDatabase.add_db_file). Tables are ignored, all columns are
+        merged.
+        """
+        other = PhotonStore(filename, readonly=True)
+        numeric = dict((name, other.column(name)) for name, _, _ in NUMERIC_COLUMNS)
+        if uid_offset is not None:
+            numeric['uid'] = numeric['uid'] + int(uid_offset)
+        text = dict((name, other.column(name)) for name in TEXT_COLUMNS)
+        if len(numeric['uid']):
+            self.flush()
+            self.append(numeric, dict((name, list(values)) for name, values in text.items()))
+            self.uid = max(self.uid, int(numeric['uid'].max()) + 1)
+        other.close()
+
+    def close(self):
+        h5py = _h5py()
+        if h5py is not None and isinstance(self.source, h5py.File):
+            self.source.close()
+        self.source = None
+
+    # --- Column access ---
+
+    def column(self, name, decode=True):
+        """
+        Returns a column as array (text columns are decoded to object arrays unless decode is False)
+        """
+        self.flush()
+        key = (name, decode)
+        if key in self.cache:
+            return self.cache[key]
+        if self.source is not None:
+            h5py = _h5py()
+            values = np.asarray(self.source[name]) if h5py is None or not isinstance(self.source, h5py.File) \
+                else self.source[name][...]
+        elif len(self.chunks[name]) == 0:
+            width = dict((n, w) for n, _, w in NUMERIC_COLUMNS).get(name, 1)
+            dtype = dict((n, d) for n, d, _ in NUMERIC_COLUMNS).get(name, np.int32)
+            values = np.zeros((0, width) if width > 1 else 0, dtype=dtype)
+        else:
+            if len(self.chunks[name]) > 1:
+                self.chunks[name] = [np.concatenate(self.chunks[name])]
+            values = self.chunks[name][0]
+        if decode and name in TEXT_COLUMNS:
+            values = np.array(self.labels[name] + [None], dtype=object)[:-1][values] if len(values) \
+                else np.zeros(0, dtype=object)
+        self.cache[key] = values
+        return values
+
+    def text_equals(self, name, value):
+        """ Returns the mask of rows whose text column name equals value """
+        code = self.codes[name].get(value)
+        if code is None:
+            return np.zeros(len(self.column('uid')), dtype=bool)
+        return self.column(name, decode=False) == code
+
+    def endpoint_rows(self):
+        """ Returns the rows of the last step (highest uid) of each photon, sorted by pid """
+        if 'endpoints' not in self.cache:
+            uid = self.column('uid')
+            pid = self.column('pid')
+            order = np.lexsort((uid, pid))
+            last = np.ones(len(order), dtype=bool)
+            last[:-1] = pid[order][1:] != pid[order][:-1]
+            self.cache['endpoints'] = order[last]
+        return self.cache['endpoints']
+
+    def first_rows(self):
+        """ Returns the rows of the first step (lowest uid) of each photon, sorted by pid """
+        if 'firsts' not in self.cache:
+            uid = self.column('uid')
+            pid = self.column('pid')
+            order = np.lexsort((uid, pid))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = pid[order][1:] != pid[order][:-1]
+            self.cache['firsts'] = order[first]
+        return self.cache['firsts']
+
+    def lookup_uids(self, uids):
+        """ Returns the row index of each uid and the mask of the uids found """
+        uid = self.column('uid')
+        uids = np.atleast_1d(np.asarray(uids, dtype=np.int64))
+        if len(uid) == 0:
+            return np.zeros(len(uids), dtype=int), np.zeros(len(uids), dtype=bool)
+        if 'uid_order' not in self.cache:
+            self.cache['uid_order'] = np.argsort(uid, kind='mergesort')
+        order = self.cache['uid_order']
+        positions = np.minimum(np.searchsorted(uid, uids, sorter=order), len(uid) - 1)
+        rows = order[positions]
+        return rows, uid[rows] == uids
+
+    def rows_for_uids(self, uids):
+        """ Returns the row indexes of the given uids """
+        rows, found = self.lookup_uids(uids)
+        return rows[found]
+
+    def endpoint_uids_where(self, mask):
+        """ Returns the uids of the photon endpoints where mask is True """
+        rows = self.endpoint_rows()
+        return self.column('uid')[rows[mask[rows]]].tolist()
+
+    def outbound_mask(self, bound, surface_id, luminescent=None, solar=None):
+        mask = self.text_equals('ray_direction_bound', bound) & self.text_equals('surface_id', surface_id)
+        if luminescent == solar:
+            return mask
+        elif luminescent:
+            return mask & (self.column('absorption_counter') > 0)
+        elif solar:
+            return mask & (self.column('absorption_counter') == 0)
+        return None
+
+    # --- Queries (same interface of PhotonDatabase) ---
+
+    def endpoint_uids(self):
+        """
+        Per each photon returns the highest uid, corresponding to its endpoint
+
+        :rtype: list
+        """
+        return self.column('uid')[self.endpoint_rows()].tolist()
+
+    def endpoint_uids_for_object(self, obj):
+        mask = self.text_equals('on_surface_obj', obj) | self.text_equals('container_obj', obj)
+        return sorted(self.endpoint_uids_where(mask))
+
+    def endpoint_uids_for_surface(self, surface):
+        return sorted(self.endpoint_uids_where(self.text_equals('surface_id', surface)))
+
+    def endpoint_uids_for_object_and_surface(self, obj, surface):
+        mask = self.text_equals('on_surface_obj', obj) & self.text_equals('surface_id', surface)
+        return sorted(self.endpoint_uids_where(mask))
+
+    def endpoint_uids_outbound_for_object_and_surface(self, obj, surface, luminescent=None, solar=None):
+        """
+        For a surface_id will return all endpoint uid on an out bound direction (see PhotonDatabase).
+        """
+        if luminescent == solar and luminescent is not None:
+            luminescent = solar = None
+        mask = self.outbound_mask('Out', surface, luminescent, solar)
+        if mask is None or (luminescent is not None and solar is not None):
+            print("Cannot return any uids for this question."
+                  "Are you using the function uids_out_bound_on_surface correctly?")
+            return []
+        return self.endpoint_uids_where(mask & self.text_equals('on_surface_obj', obj))
+
+    def endpoint_uids_for_nonradiative_loss(self):
+        mask = self.text_equals('surface_id', 'None') & (self.column('absorption_counter') > 0) & \
+            ~self.column('killed')
+        return sorted(self.endpoint_uids_where(mask))
+
+    def endpoint_uids_for_nonradiative_loss_in_object(self, obj):
+        mask = self.text_equals('container_obj', obj) & self.text_equals('surface_id', 'None') & \
+            (self.column('absorption_counter') > 0) & ~self.column('killed')
+        return sorted(self.endpoint_uids_where(mask))
+
+    def killed(self):
+        """ Returns the uid of killed photons (one that took too many steps to complete). """
+        return self.column('uid')[self.column('killed')].tolist()
+
+    def objects_with_records(self):
+        """ Returns a list of which scene object have been hit by rays. """
+        labels = [self.labels['container_obj'][code] for code in np.unique(self.column('container_obj', decode=False))]
+        # Same order of SQL (NULL first)
+        return [str(label) for label in sorted(labels, key=lambda label: (label is not None, label))]
+
+    def surfaces_with_records(self):
+        """ Returns surfaces that have been hit by a ray for all exiting objects. """
+        rows = self.endpoint_rows()
+        rows = rows[self.column('has_surface_normal')[rows]]
+        codes = np.unique(self.column('surface_id', decode=False)[rows])
+        return sorted(str(self.labels['surface_id'][code]) for code in codes)
+
+    def surfaces_with_records_for_object(self, obj):
+        """ Returns a list of surface to 'object' that have been hit by a ray. """
+        in_object = self.column('surface_id', decode=False)[self.text_equals('container_obj', obj)]
+        codes = np.intersect1d(np.unique(in_object), [self.codes['surface_id'][surface]
+                                                      for surface in self.surfaces_with_records()])
+        return sorted(str(self.labels['surface_id'][code]) for code in codes)
+
+    def surface_normal_for_surface(self, surface_id, position_on_surface=None):
+        """
+        Returns a surface normal (vector) for a specified surface_id (see PhotonDatabase).
+        """
+        rows = np.flatnonzero(self.text_equals('surface_id', surface_id))
+        row = rows[self.column('uid')[rows].argmin()]
+        # + 0.0 as SQLite does not store negative zeros
+        return tuple((self.column('surface_normal')[row] + 0.0).tolist())
+
+    def uids_out_bound_on_surface(self, surface_id, luminescent=None, solar=None):
+        """
+        For a surface_id will return all uid on an out bound direction (see PhotonDatabase).
+        """
+        mask = self.outbound_mask('Out', surface_id, luminescent, solar)
+        if mask is None:
+            self.logger.info("Cannot return any uids for this question."
+                             "Are you using the function uids_out_bound_on_surface correctly?")
+            return []
+        return self.endpoint_uids_where(mask)
+
+    def uids_in_bound_on_surface(self, surface_id, luminescent=None, solar=None):
+        """
+        For a surface_id will return all uid on an in bound direction (see PhotonDatabase).
+        """
+        mask = self.outbound_mask('In', surface_id, luminescent, solar)
+        if mask is None:
+            print("Cannot return any uids for this question."
+                  "Are you using the function uids_in_bound_on_surface correctly?")
+            return []
+        return self.endpoint_uids_where(mask)
+
+    def uids_in_reactor(self):
+        """ Returns the uids of all the photons in the reactor channels. """
+        return sorted(self.endpoint_uids_where(self.column('reaction')))
+
+    def uids_in_reactor_and_luminescent(self):
+        """ Returns photons in reactor and luminescent."""
+        # One absorption is the reaction mixture itself, so > 1 to account for dye absorption (i.e. luminescent).
+        return sorted(self.endpoint_uids_where(self.column('reaction') & (self.column('absorption_counter') > 1)))
+
+    def uids_luminescent(self):
+        """ Returns luminescent photons. """
+        return sorted(self.endpoint_uids_where(self.column('absorption_counter') > 1))
+
+    def uids_first_intersection(self):
+        """ Returns the unique identifier of the first intersection for all photons. """
+        return [(uid,) for uid in self.column('uid')[self.column('intersection_counter') == 1].tolist()]
+
+    def endpoint_records(self):
+        """
+        Returns the endpoint of each photon (ordered by pid), see PhotonDatabase.endpoint_records()
+        """
+        rows = self.endpoint_rows()
+        fates = [photon_fate(*state) for state in zip(
+            self.column('absorption_counter')[rows].tolist(), self.column('killed')[rows].tolist(),
+            self.column('reaction')[rows].tolist(), self.column('surface_id')[rows].tolist(),
+            self.column('ray_direction_bound')[rows].tolist())]
+        return list(zip(self.column('uid')[rows].tolist(), self.column('pid')[rows].tolist(), fates,
+                        self.column('surface_id')[rows].tolist(), self.column('ray_direction_bound')[rows].tolist(),
+                        self.column('absorption_counter')[rows].tolist(),
+                        self.column('reaction')[rows].astype(int).tolist(),
+                        self.column('killed')[rows].astype(int).tolist(),
+                        self.column('wavelength')[self.first_rows()].tolist(),
+                        self.column('wavelength')[rows].tolist(),
+                        self.column('intersection_counter')[rows].tolist()))
+
+    def uids_generated_photons(self, max=False):
+        """ Returns the unique identifier of the first (or last) step of each generated photon. """
+        rows = self.endpoint_rows() if max else self.first_rows()
+        return self.column('uid')[rows].tolist()
+
+    def pid_from_uid(self, uid):
+        """ Returns the photon ID of a given uid. """
+        if isinstance(uid, int) or isinstance(uid, float):
+            return int(self.column('pid')[self.rows_for_uids([uid])][0])
+        elif isinstance(uid, list) or isinstance(uid, tuple):
+            return self.column('pid')[np.sort(self.rows_for_uids(uid))].tolist()
+
+    def uids_for_pid(self, pid):
+        """ Returns all the uids associated to a given photon ID. """
+        return self.column('uid')[self.column('pid') == pid].tolist()
+
+    def bounces_for_pid(self, pid):
+        """ Returns the number of bounces for a given photon ID. """
+        last_uid_for_pid = max(self.uids_for_pid(pid))
+        return self.bounces_for_uid(last_uid_for_pid)
+
+    def bounces_for_uid(self, uid):
+        """ Returns the number of bounces for a given uid. """
+        return self.column('intersection_counter')[self.rows_for_uids([uid])].tolist()
+
+    def uids_top_reflections(self):
+        mask = self.outbound_mask('Out', 'top') & (self.column('intersection_counter') == 1)
+        return self.endpoint_uids_where(mask)
+
+    def count_top_reflections(self):
+        mask = self.outbound_mask('Out', 'top') & (self.column('intersection_counter') == 1)
+        return [int(mask.sum())]
+
+    def uids_nonradiative_losses(self):
+        mask = ~self.column('reaction') & self.text_equals('surface_id', 'None') & \
+            (self.column('absorption_counter') > 0) & ~self.column('killed')
+        return sorted(self.endpoint_uids_where(mask))
+
+    def value_for_table_column_uid(self, table, column, uid):
+        """
+        Returns values from the store index my table, column and row (see PhotonDatabase).
+        """
+        if isinstance(column, str):
+            column = [column]
+        elif not (isinstance(column, list) or isinstance(column, tuple)):
+            self.logger.info("Cannot return any uids for this question."
+                             "Are you using the function value_for_table_column_uid correctly?")
+            return []
+        rows = self.rows_for_uids([uid])
+        if table in SQL_MASKS:
+            rows = rows[self.column(SQL_MASKS[table])[rows]]
+        values = []
+        for row in rows:
+            for header in column:
+                name, component = SQL_COLUMNS[table][header]
+                value = self.column(name)[row]
+                value = value[component] if component is not None else value
+                # SQLite returns BOOL columns as integers
+                values.append(int(value) if isinstance(value, np.bool_) else
+                              value.item() if hasattr(value, 'item') else value)
+        return values
+
+    def values_for_uids(self, table, columns, uids, dtype=float, missing=np.nan):
+        """
+        Returns the values of the (SQL) columns of table for an array of uids (see PhotonDatabase.values_for_uids())
+        """
+        single = isinstance(columns, str)
+        if single:
+            columns = [columns]
+        values = np.empty((len(uids), len(columns)), dtype=dtype)
+        values[:] = missing
+        rows, found = self.lookup_uids(uids)
+        rows, positions = rows[found], np.flatnonzero(found)
+        if table in SQL_MASKS:
+            valid = self.column(SQL_MASKS[table])[rows]
+            rows, positions = rows[valid], positions[valid]
+        for index, header in enumerate(columns):
+            name, component = SQL_COLUMNS[table][header]
+            column = self.column(name)[rows]
+            column = column[:, component] if component is not None else column
+            if column.dtype == bool:
+                column = column.astype(int)
+            values[positions, index] = column
+        return values[:, 0] if single else values
+
+    def bounces_for_uids(self, uids):
+        """ Returns the number of bounces for an array of uids """
+        return self.values_for_uids('state', 'intersection_counter', uids, dtype=int, missing=0)
+
+    def wavelengths_for_uids(self, uids):
+        """ Returns the wavelength for an array of uids, aligned with uids """
+        return self.values_for_uids('photon', 'wavelength', uids)
+
+    def vectors_for_uid(self, name, uid):
+        """ Returns the 3D vectors of column name (direction, position...) for a uid or list of uids """
+        if isinstance(uid, int) or isinstance(uid, float):
+            rows = self.rows_for_uids([uid])
+            if name in SQL_MASKS:
+                rows = rows[self.column(SQL_MASKS[name])[rows]]
+            return np.array(self.column(name)[rows[0]])
+        elif isinstance(uid, list) or isinstance(uid, tuple):
+            rows = self.rows_for_uids(uid)
+            if name in SQL_MASKS:
+                rows = rows[self.column(SQL_MASKS[name])[rows]]
+            return [tuple(vector) for vector in self.column(name)[np.sort(rows)].tolist()]
+
+    def direction_for_uid(self, uid):
+        return self.vectors_for_uid('direction', uid)
+
+    def polarisation_for_uid(self, uid):
+        return self.vectors_for_uid('polarisation', uid)
+
+    def position_for_uid(self, uid):
+        return self.vectors_for_uid('position', uid)
+
+    def wavelength_for_uid(self, uid):
+        if isinstance(uid, int) or isinstance(uid, float):
+            return np.array([self.column('wavelength')[self.rows_for_uids([uid])][0]])
+        elif isinstance(uid, list) or isinstance(uid, tuple):
+            return self.column('wavelength')[np.sort(self.rows_for_uids(uid))].tolist()
+
+    def minimum_wavelengths(self):
+        """ Returns the pids (sorted) and the minimum wavelength of each photon """
+        if 'minimum_wavelengths' not in self.cache:
+            pid = self.column('pid')
+            order = np.argsort(pid, kind='mergesort')
+            starts = self.first_rows()
+            pids = pid[starts]
+            bounds = np.searchsorted(pid[order], pids)
+            minimum = np.minimum.reduceat(self.column('wavelength')[order], bounds) if len(order) else np.zeros(0)
+            self.cache['minimum_wavelengths'] = (pids, minimum)
+        return self.cache['minimum_wavelengths']
+
+    def wavelength_for_pid(self, pid):
+        pids, minimum = self.minimum_wavelengths()
+        if isinstance(pid, int) or isinstance(pid, float):
+            return np.array([minimum[np.searchsorted(pids, pid)]])
+        elif isinstance(pid, list) or isinstance(pid, tuple):
+            selected = np.unique(np.asarray(pid, dtype=np.int64))
+            selected = selected[np.isin(selected, pids)]
+            return minimum[np.searchsorted(pids, selected)].tolist()
+
+    def original_wavelength_for_uid(self, uid):
+        if isinstance(uid, int) or isinstance(uid, float):
+            return self.wavelength_for_pid(self.pid_from_uid(uid))
+        elif isinstance(uid, list) or isinstance(uid, tuple):
+            return self.wavelength_for_pid(list(self.pid_from_uid(list(uid))))
+
+    @staticmethod
+    def from_database(database, dbfile=None):
+        """
+        Returns a PhotonStore with the content of a PhotonDatabase (one query per table).
+
+        :param database: PhotonDatabase
+        :param dbfile: default location of the store
+        """
+        if hasattr(database, 'flush'):
+            database.flush()
+        cursor = database.cursor
+        store = PhotonStore(dbfile)
+        photon = cursor.execute('SELECT uid, pid, wavelength FROM photon ORDER BY uid').fetchall()
+        n = len(photon)
+        if n == 0:
+            return store
+        uid = np.array([row[0] for row in photon], dtype=np.int64)
+        rows = dict((value, index) for index, value in enumerate(uid.tolist()))
+
+        def vectors(table):
+            values = np.zeros((n, 3))
+            mask = np.zeros(n, dtype=bool)
+            for x, y, z, row_uid in cursor.execute('SELECT x, y, z, uid FROM ' + table).fetchall():
+                values[rows[row_uid]] = (x, y, z)
+                mask[rows[row_uid]] = True
+            return values, mask
+
+        position, _ = vectors('position')
+        direction, _ = vectors('direction')
+        polarisation, has_polarisation = vectors('polarisation')
+        surface_normal, has_surface_normal = vectors('surface_normal')
+        state = [None] * n
+        for row in cursor.execute('SELECT * FROM state').fetchall():
+            state[rows[row[12]]] = row
+        state = list(zip(*state))
+        store.append({'uid': uid, 'pid': [-1 if row[1] is None else row[1] for row in photon],
+                      'wavelength': [row[2] for row in photon], 'position': position, 'direction': direction,
+                      'polarisation': polarisation, 'has_polarisation': has_polarisation,
+                      'surface_normal': surface_normal, 'has_surface_normal': has_surface_normal,
+                      'absorption_counter': state[0], 'intersection_counter': state[1],
+                      'active': np.array(state[2], dtype=bool), 'killed': np.array(state[3], dtype=bool),
+                      'reaction': np.array(state[11], dtype=bool)},
+                     {'source': list(state[4]), 'emitter_material': list(state[5]),
+                      'absorber_material': list(state[6]), 'container_obj': list(state[7]),
+                      'on_surface_obj': list(state[8]), 'surface_id': list(state[9]),
+                      'ray_direction_bound': list(state[10])})
+        store.uid = int(uid.max()) + 1
+        return store
@@ -0,0 +1,298 @@
+"""
+Online tallies of the photon fates.
+
+PhotonTally bins every photon in the fate categories of Analysis (generated, killed, losses, luminescent/solar
+photons per surface, channels...) when it terminates, building along the way the histograms of the original wavelength
+and of the number of bounces of each category.
+Used as Tracer database (db_backend='tally') it replaces the per-step photon database: only the photons being traced
+are kept in memory, so memory usage does not depend on the number of throws. Analysis.classify_photons() uses it (with
+keep_uids=True) to classify the photons of a database.
+"""
+
+from __future__ import division, print_function
+import json
+import logging
+import math
+import os
+
+from pvtrace.PhotonDatabase import photon_fate
+
+EDGES = ('left', 'near', 'far', 'right')
+APERTURES = ('top', 'bottom')
+
+
+def normal_quantile(probability):
+    """
+    Quantile of the standard normal distribution (bisection on math.erf, e.g. 1.96 for 0.975)
+    """
+    assert 0 < probability < 1, "probability must be in (0, 1)"
+    low, high = -40., 40.
+    for _ in range(100):
+        middle = (low + high) / 2
+        if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+class PhotonTally(object):
+    """
+    Counters and histograms of the photon fates, with the logging interface of PhotonDatabase.
+    """
+
+    def __init__(self, dbfile=None, readonly=False, buffer_size=None, keep_uids=False, edges=EDGES,
+                 apertures=APERTURES, wavelength_range=(350, 700)):
+        """
+        :param dbfile: tally file (json) to be loaded if it exists, default location of dump_to_file() otherwise
+        :param readonly: load an existing tally file
+        :param buffer_size: ignored (compatibility with PhotonDatabase)
+        :param keep_uids: keep the endpoint uid of the photons of each category (memory grows with the photons!)
+        :param edges: surface ids of the edges of the LSC
+        :param apertures: surface ids of the apertures of the LSC
+        :param wavelength_range: range of the (1 nm bins) wavelength histograms
+        """
+        super(PhotonTally, self).__init__()
+        self.split_size = 20000
+        self.logger = logging.getLogger('pvtrace.PhotonTally')
+        # Optional PhotonTally fed with the same steps and photon ends (see PhotonDatabase)
+        self.tally = None
+        self.file = dbfile
+        self.keep_uids = keep_uids
+        self.edges = list(edges)
+        self.apertures = list(apertures)
+        self.wavelength_range = tuple(wavelength_range)
+        self.first_bin = int(math.floor(self.wavelength_range[0]))
+        self.bins = int(math.ceil(self.wavelength_range[1])) - self.first_bin
+
+        self.categories = ['generated', 'killed', 'tot', 'losses', 'luminescent_edges', 'luminescent_apertures',
+                           'solar_apertures', 'luminescent_channel', 'channels_tot', 'channels_direct']
+        self.categories += ['luminescent_' + surface for surface in self.edges + self.apertures]
+        self.categories += ['solar_' + surface for surface in self.apertures]
+        self.empty()
+
+        if dbfile is not None and (readonly or os.path.exists(dbfile)):
+            self.load(dbfile)
+
+    def empty(self):
+        """
+        Resets the tallies
+        """
+        # Steps logged in the tallies (the tallies of dumps are summed when merged, see add_tallies())
+        self.uid = 0
+        self.count = dict((category, 0) for category in self.categories)
+        self.wavelength_counts = dict((category, [0] * self.bins) for category in self.categories)
+        # Number of photons per number of bounces (intersection_counter of the endpoint)
+        self.bounce_counts = dict((category, []) for category in self.categories)
+        self.uids = dict((category, []) for category in self.categories)
+        # Photons being traced, pid: (original wavelength, last uid, last state)
+        self.open_photons = {}
+
+    # --- Logging (same interface of PhotonDatabase) ---
+
+    def log(self, photon, surface_normal=None, surface_id=None, ray_direction_bound=None,
+            emitter_material=None, absorber_material=None):
+        """
+        Keeps the state of the photon (only the last state of each photon being traced is kept)
+        """
+        if self.tally is not None:
+            self.tally.log(photon, surface_normal, surface_id, ray_direction_bound, emitter_material, absorber_material)
+        tracked = self.open_photons.get(photon.id)
+        original_wavelength = float(photon.wavelength) if tracked is None else tracked[0]
+        self.open_photons[photon.id] = (original_wavelength, self.uid,
+                                        (photon.absorption_counter, photon.intersection_counter, photon.killed,
+                                         photon.reaction, str(surface_id), str(ray_direction_bound)))
+        self.uid += 1
+
+    def log_batch(self, pid, wavelength, position, direction, absorption_counter, intersection_counter, active,
+                  killed, reaction, source=None, container_obj=None, on_surface_obj=None, surface_id=None,
+                  ray_direction_bound=None, surface_normal=None):
+        """
+        Same as log() for a batch of photon states (see PhotonDatabase.log_batch())
+        """
+        if self.tally is not None:
+            self.tally.log_batch(pid, wavelength, position, direction, absorption_counter, intersection_counter, active,
+                                 killed, reaction, source=source, container_obj=container_obj,
+                                 on_surface_obj=on_surface_obj, surface_id=surface_id,
+                                 ray_direction_bound=ray_direction_bound, surface_normal=surface_normal)
+        n = len(pid)
+
+        def column(value):
+            if value is None or not hasattr(value, '__len__') or isinstance(value, str):
+                return [value] * n
+            return list(value.tolist() if hasattr(value, 'tolist') else value)
+
+        for row_pid, row_wavelength, absorptions, intersections, row_killed, row_reaction, row_surface_id, bound in \
+                zip(column(pid), column(wavelength), column(absorption_counter), column(intersection_counter),
+                    column(killed), column(reaction), column(surface_id), column(ray_direction_bound)):
+            tracked = self.open_photons.get(row_pid)
+            original_wavelength = float(row_wavelength) if tracked is None else tracked[0]
+            self.open_photons[row_pid] = (original_wavelength, self.uid,
+                                          (absorptions, intersections, row_killed, row_reaction, str(row_surface_id),
+                                           str(bound)))
+            self.uid += 1
+
+    def flush(self):
+        pass
+
+    def end_photon(self, pid):
+        """
+        Adds the photon pid, with the state of its last logged step, to the tallies
+        """
+        if self.tally is not None:
+            self.tally.end_photon(pid)
+        tracked = self.open_photons.pop(pid, None)
+        if tracked is None:
+            return
+        original_wavelength, uid, (absorption_counter, intersection_counter, killed, reaction, surface_id,
+                                   bound) = tracked
+        fate = photon_fate(absorption_counter, killed, reaction, surface_id, bound)
+        self.add(uid, fate, surface_id, bound, absorption_counter, intersection_counter, reaction, killed,
+                 original_wavelength)
+
+    def end_photons(self, pids):
+        for pid in pids:
+            self.end_photon(pid)
+
+    # --- Tallies ---
+
+    def add(self, uid, fate, surface_id, ray_direction_bound, absorption_counter, intersection_counter, reaction,
+            killed, original_wavelength):
+        """
+        Adds a photon to the tallies of its fate categories, from the state of its endpoint (see
+        PhotonDatabase.endpoint_records())
+        """
+        # Same criteria of the PhotonDatabase queries (uids_out_bound_on_surface(), uids_in_reactor()...)
+        categories = ['generated', 'killed' if killed else 'tot']
+        if fate == 'loss':
+            categories.append('losses')
+        if ray_direction_bound == 'Out':
+            if surface_id in self.edges and absorption_counter > 0:
+                categories += ['luminescent_' + surface_id, 'luminescent_edges']
+            elif surface_id in self.apertures:
+                if absorption_counter > 0:
+                    categories += ['luminescent_' + surface_id, 'luminescent_apertures']
+                else:
+                    categories += ['solar_' + surface_id, 'solar_apertures']
+        if reaction:
+            categories.append('channels_tot')
+            categories.append('luminescent_channel' if absorption_counter > 1 else 'channels_direct')
+
+        # Histogram bin (the last bin includes its upper edge, as numpy.histogram)
+        wavelength_bin = int(math.floor(original_wavelength)) - self.first_bin
+        if wavelength_bin == self.bins and original_wavelength == self.wavelength_range[1]:
+            wavelength_bin -= 1
+        in_range = 0 <= wavelength_bin < self.bins
+        for category in categories:
+            self.count[category] += 1
+            if in_range:
+                self.wavelength_counts[category][wavelength_bin] += 1
+            bounces = self.bounce_counts[category]
+            if intersection_counter >= len(bounces):
+                bounces.extend([0] * (intersection_counter + 1 - len(bounces)))
+            bounces[intersection_counter] += 1
+            if self.keep_uids:
+                self.uids[category].append(uid)
+
+    def add_records(self, records):
+        """
+        Adds the photons of a photon database (rows of PhotonDatabase.endpoint_records())
+        """
+        for uid, pid, fate, surface_id, bound, absorption_counter, reaction, killed, original_wavelength, \
+                wavelength, intersection_counter in records:
+            self.add(uid, fate, surface_id, bound, absorption_counter, intersection_counter, reaction, killed,
+                     original_wavelength)
+
+    def confidence_interval(self, category, confidence=0.95):
+        """
+        Binomial (Wilson score) confidence interval of the fraction of photons in category, out of the photons not
+        killed (the denominator of Analysis.percent())
+
+        :param category: fate category (e.g. 'channels_tot', 'luminescent_edges')
+        :param confidence: confidence level of the interval
+        :return: (fraction, lower, upper) tuple
+        """
+        if category not in self.count:
+            raise ValueError("Unknown photon category " + str(category) + " (valid: " + ", ".join(self.categories) +
+                             ")")
+        n = self.count['tot']
+        if n == 0:
+            return 0., 0., 1.
+        fraction = self.count[category] / n
+        z = normal_quantile(0.5 + confidence / 2)
+        denominator = 1 + z ** 2 / n
+        center = (fraction + z ** 2 / (2 * n)) / denominator
+        half_width = z * math.sqrt(fraction * (1 - fraction) / n + z ** 2 / (4 * n ** 2)) / denominator
+        return fraction, max(0., center - half_width), min(1., center + half_width)
+
+    def relative_error(self, category, confidence=0.95):
+        """
+        Half width of the confidence interval of the fraction of photons in category over the fraction itself (inf if
+        no photon is in category yet)
+        """
+        fraction, lower, upper = self.confidence_interval(category, confidence)
+        if fraction == 0:
+            return float('inf')
+        return (upper - lower) / (2 * fraction)
+
+    def histograms(self):
+        """
+        Returns the wavelength histograms of each category as (wavelength, count) tuples (see
+        Analysis.histogram_raw_data())
+        """
+        wavelengths = tuple(float(self.first_bin + i) for i in range(self.bins))
+        return dict((category, (wavelengths, tuple(counts))) for category, counts in self.wavelength_counts.items())
+
+    def bounces(self, category):
+        """
+        Returns the distribution of the number of bounces of the photons in category (x, y as Analysis.get_bounces())
+        """
+        counts = self.bounce_counts[category]
+        return list(range(len(counts))), list(counts)
+
+    # --- Files ---
+
+    def dump_to_file(self, location=None):
+        """
+        Saves the tallies (json)
+        """
+        if location is None:
+            location = self.file if self.file is not None else os.path.join(os.path.expanduser('~'), 'tally.json')
+        with open(location, 'w') as tally_file:
+            json.dump(self.tallies(), tally_file)
+        self.logger.info("Photon tallies saved as " + str(location))
+
+    def tallies(self):
+        """ Returns the tallies as a dict (the content of the files of dump_to_file(), see add_tallies()) """
+        return {'uid': self.uid, 'edges': self.edges, 'apertures': self.apertures,
+                'wavelength_range': self.wavelength_range, 'count': self.count,
+                'wavelength_counts': self.wavelength_counts, 'bounce_counts': self.bounce_counts}
+
+    def load(self, dbfile):
+        """ Loads the tallies of a file saved with dump_to_file() """
+        with open(dbfile, 'r') as tally_file:
+            data = json.load(tally_file)
+        self.__init__(edges=data['edges'], apertures=data['apertures'], wavelength_range=data['wavelength_range'])
+        self.file = dbfile
+        self.add_tallies(data)
+
+    def add_db_file(self, filename=None, tables=None, uid_offset=None):
+        """
+        Adds the tallies of another file (e.g. of Tracer workers), tables and uid_offset are ignored
+        """
+        with open(filename, 'r') as tally_file:
+            self.add_tallies(json.load(tally_file))
+
+    def add_tallies(self, data):
+        """ Adds the tallies (as saved by dump_to_file()) to the current ones """
+        assert list(data['wavelength_range']) == list(self.wavelength_range), "Different histogram ranges"
+        self.uid += data['uid']
+        for category, count in data['count'].items():
+            self.count[category] += count
+            self.wavelength_counts[category] = [a + b for a, b in zip(self.wavelength_counts[category],
+                                                                      data['wavelength_counts'][category])]
+            bounces = self.bounce_counts[category]
+            for intersections, photons in enumerate(data['bounce_counts'][category]):
+                if intersections >= len(bounces):
+                    bounces.append(0)
+                bounces[intersections] += photons
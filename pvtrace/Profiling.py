@@ -0,0 +1,142 @@
+"""
+Per-stage profiling of the tracers (Tracer(profile=True)).
+
+A StageProfiler replaces the methods/functions of each stage (e.g. Scene.hits, Material.trace, PhotonDatabase.log)
+with timed wrappers for the duration of a run, accumulating number of calls and wall time per stage. Nothing is
+wrapped unless profiling is requested, so the tracing loop is untouched otherwise.
+Stage times are inclusive: a stage called by another one (e.g. Material.trace within Tracer.trace_photon) is counted
+in both.
+"""
+
+from __future__ import division, print_function
+import json
+import time
+
+# Best clock available (time.perf_counter is not available in Python 2)
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class StageProfiler(object):
+    """
+    Accumulates calls and wall time of the stages of a run, see instrument()
+    """
+
+    def __init__(self):
+        # Stage name: [calls, seconds]
+        self.stages = {}
+        # (owner, attribute, original value, whether the attribute was set on the owner itself) of the wrapped stages
+        self.wrapped = []
+        self.started = None
+        self.elapsed = 0.
+        self.photons = 0
+        self.steps = 0
+
+    def wrap(self, stage, function):
+        """
+        Returns function wrapped so that its calls and wall time are added to the stage
+
+        :param stage: stage name
+        :param function: callable to be timed
+        """
+        stats = self.stages.setdefault(stage, [0, 0.])
+
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += timer() - start
+        return timed
+
+    def instrument(self, stages):
+        """
+        Replaces the stage callables with timed wrappers (until restore() is called)
+
+        :param stages: sequence of (owner, attribute, stage name) tuples, e.g. (scene, 'hits', 'Scene.hits'). Owner
+        can be any object (the wrapper is set on the instance, not on its class) or module. The same callable is
+        wrapped only once.
+        """
+        for owner, attribute, stage in stages:
+            if any(owner is done and attribute == name for done, name, _, _ in self.wrapped):
+                continue
+            own = attribute in getattr(owner, '__dict__', {})
+            original = getattr(owner, attribute)
+            setattr(owner, attribute, self.wrap(stage, original))
+            self.wrapped.append((owner, attribute, original, own))
+
+    def restore(self):
+        """ Puts back the original callables replaced by instrument() """
+        for owner, attribute, original, own in reversed(self.wrapped):
+            if own:
+                setattr(owner, attribute, original)
+            else:
+                delattr(owner, attribute)
+        self.wrapped = []
+
+    def begin(self, photons=0, steps=0):
+        """
+        Starts the clock of the run
+
+        :param photons: photons already traced (e.g. when resuming from a checkpoint)
+        :param steps: steps already traced
+        """
+        self.started = timer()
+        self.photons = -photons
+        self.steps = -steps
+
+    def end(self, photons, steps):
+        """
+        Stops the clock of the run
+
+        :param photons: photons traced at the end of the run (same counter of begin())
+        :param steps: steps traced at the end of the run
+        """
+        self.elapsed = timer() - self.started
+        self.photons += photons
+        self.steps += steps
+
+    def merge(self, stages):
+        """
+        Adds the stages of another profiler (e.g. of a worker process)
+
+        :param stages: stages attribute of the other profiler
+        """
+        for stage, (calls, seconds) in stages.items():
+            stats = self.stages.setdefault(stage, [0, 0.])
+            stats[0] += calls
+            stats[1] += seconds
+
+    def report(self, **info):
+        """
+        Returns the profile of the run as a dict (json serialisable)
+
+        :param info: other items of the report (e.g. tracer name, workers)
+        """
+        report = dict(info)
+        report.update({'elapsed': self.elapsed, 'photons': self.photons, 'steps': self.steps,
+                       'photons_per_second': self.photons / self.elapsed if self.elapsed > 0 else None,
+                       'steps_per_photon': self.steps / self.photons if self.photons > 0 else None,
+                       'stages': {}})
+        for stage, (calls, seconds) in self.stages.items():
+            report['stages'][stage] = {'calls': calls, 'seconds': seconds,
+                                       'seconds_per_call': seconds / calls if calls else None,
+                                       'fraction': seconds / self.elapsed if self.elapsed > 0 else None}
+        return report
+
+    def summary(self):
+        """ Returns the stages as text lines (most expensive first) """
+        lines = [format(self.photons) + " photons in " + format(self.elapsed, '.2f') + " s"]
+        for stage, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append("  " + stage + ": " + str(calls) + " calls, " + format(seconds, '.3f') + " s")
+        return "\n".join(lines)
+
+    def save(self, location, **info):
+        """
+        Saves report() as json
+
+        :param location: file path
+        :param info: other items of the report
+        """
+        with open(location, 'w') as profile_file:
+            json.dump(self.report(**info), profile_file, indent=1, sort_keys=True)
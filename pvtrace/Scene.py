@@ -26,6 +26,10 @@ class Scene(object):
         super(Scene, self).__init__()
         self.bounds = Bounds()  # Create boundaries to world and apply to scene
         self.objects = [self.bounds]
+        # Bounding volume hierarchy over the objects, (re)built when needed (see build_bvh)
+        self.bvh = None
+        # Transform versions of the object shapes when the bvh was built (see shape_versions)
+        self.bvh_versions = None
         self.uuid = ''
         self.working_dir = self.get_new_working_dir(uuid=uuid, use_existing=force)
         print("Working directory: ", self.working_dir)
@@ -98,6 +102,7 @@ class Scene(object):
                              "must have unique name. You can change the name easily by doing:"
                              "my_device.name='my unique name'." % object_to_add.name)
         self.objects.append(object_to_add)
+        self.bvh = None
 
     def add_objects(self, objects_to_add):
         """
@@ -114,157 +119,146 @@ class Scene(object):
         for obj in objects_to_add:
             self.add_object(obj)
 
+    def build_bvh(self):
+        """
+        Builds the bounding volume hierarchy over the objects of the scene, used by intersection() and container().
+
+        Called automatically on the first query after objects are added or their shapes are transformed (see
+        current_bvh). Shapes changed otherwise (e.g. Sphere.centre set) need build_bvh() to be called again.
+        """
+        self.bvh_versions = self.shape_versions()
+        self.bvh = BoundingVolumeHierarchy([obj.shape for obj in self.objects])
+        return self.bvh
+
+    def shape_versions(self):
+        """ Returns the transform versions of the object shapes (see Geometry.transform_version) """
+        return [transform_version(obj.shape) for obj in self.objects]
+
+    def current_bvh(self):
+        """
+        Returns the bounding volume hierarchy of the objects, built again if objects were added or transformed since
+        the last build
+
+        >>> scene = Scene(uuid='doctest_bvh', level=logging.WARNING, force=True)  # doctest: +ELLIPSIS
+        Working directory: ...
+        >>> lsc = LSC(origin=(0, 0, 0), size=(0.5, 0.5, 0.5))
+        >>> scene.add_object(lsc)
+        >>> ray = Ray(position=(1.25, 0.25, -0.05), direction=(0, 0, 1))
+        >>> sorted(set(obj.name for obj in scene.hits(ray)[1]))
+        ['BOUNDS']
+        >>> bvh = scene.current_bvh()
+        >>> scene.current_bvh() is bvh
+        True
+        >>> lsc.shape.append_transform(tf.translation_matrix((1, 0, 0)))
+        >>> scene.current_bvh() is bvh
+        False
+        >>> sorted(set(obj.name for obj in scene.hits(ray)[1]))
+        ['BOUNDS', 'LSC']
+        """
+        if self.bvh is None or self.shape_versions() != self.bvh_versions:
+            self.build_bvh()
+        return self.bvh
+
     def intersection(self, ray):
         """
         Returns the intersection points and associated objects of a ray in no particular order.
 
+        Only the objects whose bounding box is hit by the ray are tested (see build_bvh)
+
         :param ray: Ray to be evaluated for intersections
         """
-        points = []
+        hits, intersection_objects = self.hits(ray)
+        if hits is None:
+            return None, None
+        return [hit.point for hit in hits], intersection_objects
+
+    def hits(self, ray):
+        """
+        Returns the hit records (see Geometry.Hit) and associated objects of a ray in no particular order.
+
+        :param ray: Ray to be evaluated for intersections
+        """
+        hits = []
         intersection_objects = []
-        for obj in self.objects:
-            intersection = obj.shape.intersection(ray)
-            if intersection is not None:
-                for pt in intersection:
-                    points.append(pt)
+        for index in self.current_bvh().ray_candidates(ray):
+            obj = self.objects[index]
+            shape_hits = obj.shape.hits(ray)
+            if shape_hits is not None:
+                for hit in shape_hits:
+                    hits.append(hit)
                     intersection_objects.append(obj)
-                    # else:
-                    # print obj.name
 
-        if len(points) == 0:
+        if len(hits) == 0:
             return None, None
-        return points, intersection_objects
+        return hits, intersection_objects
 
-    def sort(self, points, objects, ray, container=None, remove_ray_intersection=True):
+    def sort(self, hits, objects, ray, container=None, remove_ray_intersection=True):
         """
-        Returns points and objects sorted by separation from the ray position.
+        Returns hits and objects ahead of the ray, sorted by the parametric distance (hit.t) from the ray position.
 
-        :param points: a list of intersection points as returned by scene.intersection(ray)
-        :param objects: a list of objects as returned by scene.intersection(ray)
-        :param ray: a ray with global coordinate frame
+        Coincident hits (t within 1 pm) are ordered deterministically, see order_coincident()
+
+        :param hits: a list of hit records as returned by scene.hits(ray)
+        :param objects: a list of objects as returned by scene.hits(ray)
+        :param ray: a ray (or photon) with global coordinate frame, the one used for scene.hits()
         :param container: the container
         :param remove_ray_intersection: if the ray is on an intersection points remove this point from both lists
         """
+        t = np.fromiter((hit.t for hit in hits), dtype=float, count=len(hits))
 
         # Filter arrays for intersection points that are ahead of the ray's direction
-        # also if the ray is on an intersection already remove it (optional)
-        for i in range(0, len(points)):
-
-            if remove_ray_intersection:
-                try:
-                    if ray.ray.behind(points[i]) or cmp_points(ray.position, points[i]):
-                        points[i] = None
-                        objects[i] = None
-                except:
-                    ray.ray.behind(points[i])
-                    cmp_points(ray.position, points[i])
-                    exit(1)
-            else:
-                if ray.ray.behind(points[i]):
-                    points[i] = None
-                    objects[i] = None
-
-        objects = [item for item in objects if item]
-        points_copy = list(points)
-        points = []
-
-        for i in range(0, len(points_copy)):
-            if points_copy[i] is not None:
-                points.append(points_copy[i])
-
-        assert len(points) > 0, "No intersection points can be found with the scene."
-
-        # sort the intersection points arrays by separation from the ray's position
-        separations = []
-        for point in points:
-            separations.append(separation(ray.position, point))
-        sorted_indices = np.argsort(separations)
-        separations.sort()
-
-        # Sort according to sort_indices array
-        points_copy = list(points)
-        objects_copy = list(objects)
-        for i in range(0, len(points)):
-            points[i] = points_copy[sorted_indices[i]]
-            objects[i] = objects_copy[sorted_indices[i]]
-        del points_copy
-        del objects_copy
-
-        if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug("Obj: \t" + str(objects))
-            self.log.debug("Points: \t" + str(points))
-
-        objects, points, separations = Scene.order_duplicates(objects, points, separations)
-
-        # Now perform container check on ordered duplicates
-        if container is not None:
-            if objects[0] != container and len(objects) > 1:
-                # The first object in the array must be the container so there is an order problem
-                # assumes container object is an index 1!
-                obj = objects[1]
-                objects[1] = objects[0]
-                objects[0] = obj
-
-                obj = points[1]
-                points[1] = points[0]
-                points[0] = obj
-
-                obj = points[1]
-                separations[1] = separations[0]
-                separations[0] = obj
+        # also if the ray is on an intersection already remove it (optional, same tolerance of cmp_points)
+        if remove_ray_intersection:
+            ahead = np.flatnonzero(t * np.abs(ray.direction).max() >= 1e-12)
+        else:
+            ahead = np.flatnonzero(t >= 0.)
+        assert len(ahead) > 0, "No intersection points can be found with the scene."
 
-                trim_objs, trim_pts, trim_sep = Scene.order_duplicates(objects[1::], points[1::], separations[1::])
-                objects[1::] = trim_objs
-                points[1::] = trim_pts
-                separations[1::] = trim_sep
+        # sort the intersection points arrays by t (stable, i.e. in scene order if equal)
+        order = ahead[np.argsort(t[ahead], kind='mergesort')]
+        sorted_t = t[order]
+        if len(order) > 1 and (sorted_t[1:] - sorted_t[:-1]).min() < 1e-12:
+            order = Scene.order_coincident(order, t, objects, container)
 
-        return points, objects
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Obj: \t" + str([objects[i] for i in order]))
+            self.log.debug("t: \t" + str(t[order]))
 
-    def order_duplicates(objects, points, separations):
-        """
-        Subroutine which might be called recursively by the sort function when the first element
-        of the objects array is not the container objects after sorting.
+        return [hits[i] for i in order], [objects[i] for i in order]
 
-        :param objects: a list of objects as returned by scene.intersection(ray)
-        :param points: a list of intersection points as returned by scene.intersection(ray)
-        :param separations:
+    @staticmethod
+    def order_coincident(order, t, objects, container=None):
         """
+        Orders the groups of coincident hits (t within 1 pm, e.g. two touching objects) in a sorted hit order.
 
-        # If two intersections occur at the same points then the sort order won't always be correct.
-        # We need to sort by noticing the order of the points that could be sorted.
-        # (e.g.) a thin-film from air could give [a {b a} b], this pattern, we know the first point is correct.
-        # (e.g.) a thin-film from thin-film could give [{b a} b c], this pattern,  we know the middle is point correct.
-        # (e.g.) another possible example when using CGS objects [a b {c b} d].
-        # (e.g.) [a {b a} b c] --> [a a b b c]
-        # (e.g.) need to make the sort algorithm always return [a a b b] or [a b b c].
-        # Find indices of same-separation points
-
-        if (len(objects)) > 2:
-            common = []
-            for i in range(0, len(separations) - 1):
-                if cmp_floats(separations[i], separations[i + 1]):
-                    common.append(i)
+        In each group the container comes first, then the other objects the ray is leaving (i.e. with an even number of
+        hits after the group) and at last the objects the ray is entering, from the outer to the inner one (i.e. by
+        decreasing t of their next hit).
+        (e.g.) a thin-film from air gives [a {a b} b], from a channel touching the reactor face [{channel reactor} ...]
 
-            # If the order is incorrect then we swap two elements (as described above)
-            for index in common:
-
-                if not (objects[index + 1] == objects[index + 2]):
-                    # We have either [{b a} b c], or [{a b} b c]
-                    obj = objects[index + 1]
-                    objects[index + 1] = objects[index]
-                    objects[index] = obj
-
-                    obj = points[index + 1]
-                    points[index + 1] = points[index]
-                    points[index] = obj
-
-                    obj = separations[index + 1]
-                    separations[index + 1] = separations[index]
-                    separations[index] = obj
-
-        return objects, points, separations
-
-    order_duplicates = staticmethod(order_duplicates)
+        :param order: hit indexes sorted by t
+        :param t: parametric distances of the hits
+        :param objects: objects of the hits
+        :param container: the container
+        :return: list of hit indexes
+        """
+        order = list(order)
+        start = 0
+        while start < len(order) - 1:
+            end = start + 1
+            while end < len(order) and t[order[end]] - t[order[end - 1]] < 1e-12:
+                end += 1
+
+            if end - start > 1:
+                def key(index):
+                    obj = objects[index]
+                    following = [t[i] for i in order[end:] if objects[i] is obj]
+                    if len(following) % 2 == 0:
+                        return obj is not container, False, 0.
+                    return obj is not container, True, -following[0]
+                order[start:end] = sorted(order[start:end], key=key)
+            start = end
+        return order
 
     def container(self, photon):
         """
@@ -273,10 +267,11 @@ class Scene(object):
         :param photon: the contained photon
         """
 
-        # Ask each object if it contains the photon.
+        # Ask each object (whose bounding box contains the photon) if it contains the photon.
         # If multiple object return true we filter by separation to find the inner container.
         containers = []
-        for obj in self.objects:
+        for index in self.current_bvh().point_candidates(photon.position):
+            obj = self.objects[index]
             if obj.shape.contains(photon.position):
                 containers.append(obj)
 
@@ -15,6 +15,7 @@ from __future__ import division, print_function
 
 import subprocess
 import os
+import pickle
 import time
 import sys
 from copy import copy
@@ -24,8 +25,10 @@ import logging
 
 import pvtrace.Analysis
 import pvtrace.PhotonDatabase
+import pvtrace.PhotonStore
 import pvtrace.Scene
 from pvtrace.Devices import *
+from pvtrace.Profiling import StageProfiler
 
 
 try:
@@ -34,8 +37,8 @@ try:
 except Exception:
     pass
 
-# import multiprocessing
-# cpu_count = multiprocessing.cpu_count()
+import multiprocessing
+cpu_count = multiprocessing.cpu_count()
 
 
 def remove_duplicates(the_list):
@@ -63,8 +66,18 @@ def file_opener(file_path):
 class Photon(object):
     """
     A generic photon class.
+
+    Photons are created for every throw, so their attributes are slots (no instance dict). Position and direction
+    arrays are never modified in place, only replaced (see Ray), so copies share them and copying allocates no arrays.
     """
 
+    __slots__ = ('ray', 'wavelength', 'active', 'killed', 'container', 'exit_material', 'exit_device', 'scene',
+                 'propagate', 'visualiser', 'polarisation', 'absorber_material', 'emitter_material',
+                 'on_surface_object', 'surface_hits', 'reabs', 'id', 'source', 'material', 'absorption_counter',
+                 'intersection_counter', 'reaction', 'previous_container', 'visual_obj')
+
+    log = logging.getLogger("pvtrace.Photon")
+
     def __init__(self, wavelength=555, position=None, direction=None, active=True):
         """
         Initialize the photon.
@@ -94,10 +107,6 @@ class Photon(object):
         600nm [ 0.  0.  0.] [ 0.  0.  1.] <type 'NoneType'> active
         """
 
-        if position is not None:
-            position = np.array(position)
-        if direction is not None:
-            direction = np.array(direction)
         # Note that Ray can correctly handle None as arguments, but not NoneType (result of np.array(None))
         self.ray = Ray(position, direction)
 
@@ -107,8 +116,6 @@ class Photon(object):
         self.container = None
         self.exit_material = None
         self.exit_device = None
-        self.__direction = self.ray.direction
-        self.__position = self.ray.position
         self.scene = None
         self.propagate = False
         self.visualiser = None
@@ -116,39 +123,56 @@ class Photon(object):
         self.absorber_material = None
         self.emitter_material = None
         self.on_surface_object = None
+        # (object, Hit) of the surfaces the photon is on, set by trace() and cleared when the position changes
+        self.surface_hits = ()
         self.reabs = 0
         self.id = 0
         self.source = None
+        self.material = None
         self.absorption_counter = 0
         self.intersection_counter = 0
         self.reaction = False
         self.previous_container = None
         self.visual_obj = []
-        self.log = logging.getLogger("pvtrace.Photon")
 
     def __copy__(self):
-        photon_copy = Photon()
-        photon_copy.wavelength = self.wavelength
-        photon_copy.ray = Ray(direction=self.direction, position=self.position)
-        photon_copy.active = self.active
-        photon_copy.container = self.container
-        photon_copy.exit_material = self.exit_material
-        photon_copy.exit_device = self.exit_device
-        photon_copy.scene = self.scene
-        photon_copy.propagate = self.propagate
-        photon_copy.visualiser = self.visualiser
-        photon_copy.absorption_counter = self.absorption_counter
-        photon_copy.intersection_counter = self.intersection_counter
-        photon_copy.polarisation = self.polarisation
-        photon_copy.reabs = self.reabs
-        photon_copy.id = self.id
-        photon_copy.source = self.source
-        photon_copy.absorber_material = self.absorber_material
-        photon_copy.emitter_material = self.emitter_material
-        photon_copy.on_surface_object = self.on_surface_object
-        photon_copy.reaction = self.reaction
-        photon_copy.visual_obj = self.visual_obj
-        return photon_copy
+        return Photon.__new__(Photon).copy_from(self, ray=copy(self.ray))
+
+    def copy_from(self, photon, ray=None):
+        """
+        Sets this photon to a copy of photon, reusing its storage (e.g. a photon kept to be overwritten every throw)
+
+        :param photon: photon to be copied
+        :param ray: ray of the copy, by default the ray of this photon is set to the one of photon
+        :return: this photon
+        """
+        if ray is None:
+            ray = self.ray.copy_from(photon.ray)
+        self.ray = ray
+        self.wavelength = photon.wavelength
+        self.active = photon.active
+        self.killed = photon.killed
+        self.container = photon.container
+        self.exit_material = photon.exit_material
+        self.exit_device = photon.exit_device
+        self.scene = photon.scene
+        self.propagate = photon.propagate
+        self.visualiser = photon.visualiser
+        self.polarisation = photon.polarisation
+        self.absorber_material = photon.absorber_material
+        self.emitter_material = photon.emitter_material
+        self.on_surface_object = photon.on_surface_object
+        self.surface_hits = photon.surface_hits
+        self.reabs = photon.reabs
+        self.id = photon.id
+        self.source = photon.source
+        self.material = photon.material
+        self.absorption_counter = photon.absorption_counter
+        self.intersection_counter = photon.intersection_counter
+        self.reaction = photon.reaction
+        self.previous_container = photon.previous_container
+        self.visual_obj = photon.visual_obj
+        return self
 
     def __deepcopy__(self):
         return copy(self)
@@ -176,6 +200,7 @@ class Photon(object):
 
     def setPosition(self, position):
         self.ray.position = position
+        self.surface_hits = ()
         # Define setter and getters as properties
 
     position = property(getPosition, setPosition)
@@ -191,6 +216,18 @@ class Photon(object):
 
     direction = property(getDirection, setDirection)
 
+    def surface_hit(self, obj):
+        """
+        Returns the hit record (see Geometry.Hit) of the surface of obj where the photon is, None if the photon is
+        not on the surface of obj. Same as obj.shape.on_surface(photon.position), but without computing it again.
+
+        :param obj: scene object (e.g. photon.exit_device)
+        """
+        for hit_object, hit in self.surface_hits:
+            if hit_object is obj:
+                return hit
+        return None
+
     def trace(self):
         """
         The ray can trace itself through the scene.
@@ -198,26 +235,21 @@ class Photon(object):
 
         assert self.scene is not None, "The photon's scene variable is not set."
 
-        intersection_points, intersection_objects = self.scene.intersection(self.ray)
+        intersection_hits, intersection_objects = self.scene.hits(self.ray)
 
-        assert intersection_points is not None, "The ray must intersect with something in the scene to be traced."
+        assert intersection_hits is not None, "The ray must intersect with something in the scene to be traced."
 
         if self.container is None:
             self.container = self.scene.container(self)
         assert self.container is not None, "Container of ray cannot be found."
 
         # import pdb; pdb.set_trace()
-        intersection_points, intersection_objects = self.scene.sort(intersection_points, intersection_objects, self,
-                                                                    container=self.container)
-
-        # find current intersection point and object -- should be zero if the list is sorted!
-        intersection = closest_point(self.position, intersection_points)
-        for i in range(0, len(intersection_points)):
-            if list(intersection_points[i]) == list(intersection):
-                index = i
-                break
+        intersection_hits, intersection_objects = self.scene.sort(intersection_hits, intersection_objects, self,
+                                                                  container=self.container)
 
-        intersection_object = intersection_objects[index]
+        # current intersection point and object are the first ones of the sorted list
+        intersection = intersection_hits[0].point
+        intersection_object = intersection_objects[0]
         assert intersection_object is not None, "No intersection points can be found with the scene."
 
         # Reached scene boundaries?
@@ -266,7 +298,7 @@ class Photon(object):
         #    return self
 
         # Here we trace the ray through a Material
-        self.container.material.trace(self, separation(self.position, intersection))
+        self.container.material.trace(self, intersection_hits[0].t)
 
         # Lost in material?
         # Photon has been re-absorbed but NOT re-emitted, i.e. is inactive
@@ -283,13 +315,19 @@ class Photon(object):
 
         # Reaches interface
         # Photon has been re-absorbed AND re-emitted, i.e. is still active
-        ray_on_surface = intersection_object.shape.on_surface(self.position)
+        ray_on_surface = cmp_points(self.position, intersection)
         if not ray_on_surface and self.active:
             self.exit_device = self.container
             self.on_surface_object = None
             return self
 
         # Ray has reached a surface of some description, set some state variables
+        # Are there other intersections in the same point (i.e. touching objects)? They follow in the sorted list
+        same_pt_count = 1
+        while same_pt_count < len(intersection_hits) and \
+                cmp_floats(intersection_hits[same_pt_count].t, intersection_hits[0].t):
+            same_pt_count += 1
+        self.surface_hits = list(zip(intersection_objects[:same_pt_count], intersection_hits[:same_pt_count]))
         self.on_surface_object = intersection_object
         self.intersection_counter += 1
 
@@ -316,7 +354,7 @@ class Photon(object):
             random_number = np.random.random_sample()
             if random_number < intersection_object.reflectivity:
                 # Reflected
-                self.direction = reflect_vector(intersection_object.shape.surface_normal(self.ray), self.direction)
+                self.direction = reflect_vector(intersection_hits[0].normal, self.direction)
             elif random_number < intersection_object.reflectivity + intersection_object.transmittance:
                 # Transmitted
                 pass
@@ -326,14 +364,9 @@ class Photon(object):
             return self
 
         # material-air or material-material interface
-        # Are there duplicates intersection_points that are equal to the ray position?
-        same_pt_indices = []
-        for i in range(0, len(intersection_points)):
-            if cmp_points(self.position, intersection_points[i]):
-                same_pt_indices.append(i)
-        assert len(same_pt_indices) < 3, "An interface can only have 2 or 0 common intersection points."
-
-        if len(same_pt_indices) == 2:
+        assert same_pt_count < 3, "An interface can only have 2 or 0 common intersection points."
+
+        if same_pt_count == 2:
             intersection_object = self.container
 
         #
@@ -341,7 +374,9 @@ class Photon(object):
         #
 
         # Reflection and refraction require the surface normal
-        normal = intersection_object.shape.surface_normal(self.ray)
+        hit = self.surface_hit(intersection_object)
+        assert hit is not None, "The ray is not on the surface of " + str(intersection_object.name)
+        normal = hit.surface_normal(self.direction)
         rads = angle(normal, self.direction)
 
         # Hit order: from inside or outside?
@@ -350,11 +385,11 @@ class Photon(object):
             # hitting internal interface
             initialised_internally = True
 
-            if len(same_pt_indices) == 2:
+            if same_pt_count == 2:
                 # Internal interface for the case for 2 material-material interfaces which are touching
                 # (i.e. not travelling through air)
-                for obj in intersection_objects:
-                    if obj.shape.on_surface(intersection) and obj != self.container:
+                for obj, _ in self.surface_hits:
+                    if obj != self.container:
                         next_containing_object = obj
             else:
                 # hitting internal interface -- for the case where the boundary materials are NOT touching
@@ -390,9 +425,9 @@ class Photon(object):
             # hitting external interface
             initialised_internally = False
 
-            if len(same_pt_indices) == 2:
+            if same_pt_count == 2:
                 # External interface which are touching (i.e. not travelling through air)
-                for obj in intersection_objects:
+                for obj, _ in self.surface_hits:
                     if obj != self.container:
                         intersection_object = obj
                         next_containing_object = obj
@@ -429,7 +464,7 @@ class Photon(object):
             #
 
             # Cache old direction for later use by polarisation code
-            old_direction = copy(self.direction)
+            old_direction = self.direction
 
             # Handle PlanarReflector
             if isinstance(intersection_object, PlanarReflector):
@@ -500,7 +535,7 @@ class Photon(object):
             #     return self
 
             self.propagate = True
-            before = copy(self.direction)
+            before = self.direction
             ang = angle(before, self.direction)
 
             if initialised_internally:
@@ -558,13 +593,42 @@ class Photon(object):
             return self
 
 
+def _init_worker(tracer):
+    """Stores the tracer in the worker process (see Tracer.start_parallel)"""
+    global _worker_tracer
+    _worker_tracer = tracer
+
+
+def _trace_block(block):
+    """Traces a block of photons in the worker process (see Tracer.run_block)"""
+    return _worker_tracer.run_block(*block)
+
+
 class Tracer(object):
     """
     An object that will fire multiple photons through the scene.
+
+    With db_backend='tally' the memory used does not grow with the photons traced (Registers keep histograms only):
+
+    >>> def histogram_bins(throws):
+    ...     scene = pvtrace.Scene(uuid='doctest_tally', level=logging.WARNING, force=True)
+    ...     lsc = LSC(size=(0.05, 0.05, 0.005))
+    ...     lsc.material = pvtrace.SimpleMaterial(555)
+    ...     scene.add_object(lsc)
+    ...     source = pvtrace.PlanarSource(wavelength=500, length=0.05, width=0.05)
+    ...     source.translate((0, 0, -0.001))
+    ...     Tracer(scene=scene, source=source, throws=throws, seed=1, use_visualiser=False, db_backend='tally').start()
+    ...     return sum(len(counts) for log in lsc.store.values() for counts in
+    ...                log.wavelength_counts + log.absorption_counts)
+    >>> histogram_bins(1000) == histogram_bins(4000)
+    Working directory: ...
+    True
     """
     def __init__(self, scene=None, source=None, throws=1, steps=50, seed=None, use_visualiser=True,
                  background=(0.957, 0.957, 1), ambient=0.5, show_axis=True,
-                 show_counter=False, db_name=None, db_split=None, preserve_db_tables=False):
+                 show_counter=False, db_name=None, db_split=None, preserve_db_tables=False, workers=None,
+                 block_size=1000, db_buffer_size=1000, db_backend='sqlite', checkpoint_interval=None, resume=False,
+                 target_error=None, target_fractions=('channels_tot',), confidence=0.95, profile=False):
         # Tracer options
         super(Tracer, self).__init__()
         self.scene = scene
@@ -573,6 +637,8 @@ class Tracer(object):
         self.steps = steps
         self.total_steps = 0
         self.killed = 0
+        # State of the photon after its first step, overwritten at every throw (see trace_photon)
+        self.entering_photon = Photon()
 
         # From Scene, link db with analytics and get uuid
         self.uuid = self.scene.uuid
@@ -590,7 +656,13 @@ class Tracer(object):
         np.random.seed(self.seed)
 
         # DB SETTINGS
-        self.database = pvtrace.PhotonDatabase(db_name)
+        # Rows are written to the DB every db_buffer_size steps (None to write each step immediately)
+        self.db_buffer_size = db_buffer_size
+        # 'sqlite' for PhotonDatabase, 'columnar' for PhotonStore (same query interface, vectorised analysis), 'tally'
+        # for PhotonTally (no photon database, only the counters and histograms of Analysis, constant memory)
+        assert db_backend in ('sqlite', 'columnar', 'tally'), "db_backend must be 'sqlite', 'columnar' or 'tally'"
+        self.db_backend = db_backend
+        self.database = self.new_database(db_name, buffer_size=self.db_buffer_size)
         # DB splitting (performance tweak)
         # After 20k photons performance decrease is greater than 20% (compared vs. first photon simulated)
         self.split_num = self.database.split_size
@@ -601,9 +673,62 @@ class Tracer(object):
                 self.db_split = True
         else:
             self.db_split = bool(db_split)
+        if self.db_backend == 'tally':
+            # Tallies do not grow with the photons traced, neither do the Register stores (histograms only)
+            self.db_split = False
+            for obj in self.scene.objects:
+                if isinstance(obj, Register):
+                    obj.histograms_only = True
         self.dumped = []  # Keeps a list with filenames of dumped dbs (if db_split is True and throws>split_num
         self.db_save_all_tables = preserve_db_tables
 
+        # MULTIPROCESSING
+        # With workers (0 means cpu_count) throws are split in blocks of block_size photons, each one traced with its
+        # own random stream derived from seed. The same seed (and block_size) gives the same results with any number
+        # of workers. With workers=None a single process and a single random stream are used.
+        if workers is not None and workers < 1:
+            workers = cpu_count
+        self.workers = workers
+        assert block_size > 0, "block_size must be positive"
+        self.block_size = int(block_size)
+
+        # CHECKPOINTS
+        # Every checkpoint_interval photons the DB is dumped (as with db_split) and the state of the run (photon counter,
+        # random state, Register tallies and dumped DBs) is saved in the working_dir. With resume=True the run goes on
+        # from the last checkpoint in the working_dir (i.e. a Scene with the same uuid and force=True) and gives the
+        # same results of an uninterrupted run.
+        assert checkpoint_interval is None or checkpoint_interval > 0, "checkpoint_interval must be positive"
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+
+        # CONVERGENCE
+        # With target_error the run stops as soon as the relative errors of the fractions of photons in the categories
+        # target_fractions (e.g. 'channels_tot', 'luminescent_edges', see PhotonTally.relative_error()) are below
+        # target_error, checked every block_size photons. throws is then the photon budget of the run.
+        if isinstance(target_fractions, str):
+            target_fractions = (target_fractions,)
+        self.target_error = target_error
+        self.target_fractions = tuple(target_fractions)
+        self.confidence = confidence
+        self.convergence = None
+        self.converged = False
+        if self.target_error is not None:
+            assert self.target_error > 0, "target_error must be positive"
+            assert 0 < self.confidence < 1, "confidence must be in (0, 1)"
+            self.convergence = self.new_convergence_tally()
+            for fraction in self.target_fractions:
+                if fraction not in self.convergence.count:
+                    raise ValueError("Unknown target fraction " + str(fraction) + " (valid: " +
+                                     ", ".join(self.convergence.categories) + ")")
+            self.database.tally = self.convergence
+
+        # PROFILING
+        # With profile=True calls and wall time of each stage of the tracing (see profile_stages()), photons per second
+        # and steps per photon are saved as profile.json in the scene working_dir (next to output.log). The stages are
+        # wrapped only for the duration of a profiled run, so runs without profile are not slowed down.
+        self.profile = profile
+        self.profiler = None
+
         # Object-specific settings for visualiser
         if not use_visualiser:
             pvtrace.Visualiser.VISUALISER_ON = False
@@ -679,171 +804,513 @@ class Tracer(object):
                         self.visualiser.addObject(obj.shape, colour=colour, opacity=opacity, material=material)
 
     def start(self):
-        global a, b
-        logged = 0
-        db_num = 0
+        if self.profile and self.profiler is None:
+            return self.start_profiled()
+        if self.workers is not None:
+            return self.start_parallel()
+
+        first_throw = self.load_checkpoint() if self.resume else 0
+        if self.profiler is not None:
+            self.profiler.begin(first_throw, self.total_steps)
 
         # Main photon loop, throws photons to the scene
-        for throw in range(0, self.throws):
-            # Delete last ray from visualiser
-            # fixme: if channels are cylindrical in shape they will be removed from the view if this is active!
-            # if pvtrace.Visualiser.VISUALISER_ON:
-            #     for obj in self.visualiser.display.objects:
-            #         if obj.__class__ is visual.cylinder and obj.radius < 0.001:
-            #             obj.visible = False
-
-            # SHOW COUNTER (every 10 photons)
-            if throw % 10 == 0 and self.show_counter:
-                sys.stdout.write('\r Photon number: ' + str(throw))
-                sys.stdout.flush()
-
-            # Create random photon from lightsource and set relative variables
-            self.scene.log.debug("Emitting photon number: " + str(throw))
-            photon = self.source.photon()
-            photon.scene = self.scene
-            photon.material = self.source
-
-            # Sets bits for visualiser and, if show_start, shows the photon origin (with a small sphere)
-            if pvtrace.Visualiser.VISUALISER_ON:
-                photon.visualiser = self.visualiser
-                a = list(photon.position)
-                if self.show_start:
-                    self.visualiser.addSmallSphere(a)
-
-            # Photon tracing loop (up to self.steps) max iterations
-            step = 0
-            while photon.active and step < self.steps:
-                # Save to DB the previous step (either termination or simple step)
-                if photon.exit_device is not None:
-                    # Adds info about exit surface, if possible
-                    if photon.exit_device.shape.on_surface(photon.position):
-                        # Is the ray heading towards or out of a surface?
-                        normal = photon.exit_device.shape.surface_normal(photon.ray, acute=False)
-                        rads = angle(normal, photon.ray.direction)
-                        if rads < np.pi / 2:
-                            bound = "Out"
-                        else:
-                            bound = "In"
-                        # Saves photon to db
-                        self.database.log(photon, surface_normal=photon.exit_device.shape.surface_normal(photon),
-                                          surface_id=photon.exit_device.shape.surface_identifier(photon.position),
-                                          ray_direction_bound=bound, emitter_material=photon.emitter_material,
-                                          absorber_material=photon.absorber_material)
+        for throw in range(first_throw, self.throws):
+            self.trace_photon(throw)
+
+            # DB SPLIT
+            if self.db_split and throw % self.split_num == 0 and throw > 0:
+                self.split_database()
+
+            # CONVERGENCE
+            if self.target_error is not None and (throw + 1) % self.block_size == 0 and self.check_convergence():
+                break
+
+            # CHECKPOINT
+            if self.checkpoint_interval and (throw + 1) % self.checkpoint_interval == 0 and throw + 1 < self.throws:
+                self.save_checkpoint(throw + 1)
+
+        self.save_database()
+        if self.profiler is not None:
+            # The loop can stop before throws when converged
+            self.profiler.end(first_throw if first_throw >= self.throws else throw + 1, self.total_steps)
+
+    def start_profiled(self):
+        """
+        Runs start() with the stages of profile_stages() instrumented and saves the profile (see profile option)
+
+        :return: the profiler (see StageProfiler.report())
+        """
+        self.profiler = StageProfiler()
+        if self.workers is None:
+            self.profiler.instrument(self.profile_stages())
+        else:
+            # The other stages are profiled in the workers (see run_block)
+            self.profiler.instrument([(self, 'save_database', type(self).__name__ + '.save_database')])
+        try:
+            self.start()
+        finally:
+            self.profiler.restore()
+        profiler, self.profiler = self.profiler, None
+        location = os.path.join(self.scene.working_dir, 'profile.json')
+        profiler.save(location, tracer=type(self).__name__, throws=self.throws, workers=self.workers,
+                      db_backend=self.db_backend)
+        self.scene.log.info("Profile saved as " + location + "\n" + profiler.summary())
+        return profiler
+
+    def profile_stages(self):
+        """
+        Returns the stages timed by profile=True as (owner, attribute, stage name) tuples (see StageProfiler)
+        """
+        module = sys.modules[__name__]
+        stages = [(self, 'trace_photon', type(self).__name__ + '.trace_photon'),
+                  (self, 'save_database', type(self).__name__ + '.save_database'),
+                  (self.source, 'photon', type(self.source).__name__ + '.photon'),
+                  (self.scene, 'hits', 'Scene.hits'),
+                  (self.scene, 'sort', 'Scene.sort'),
+                  (self.scene, 'container', 'Scene.container'),
+                  (self.database, 'log', type(self.database).__name__ + '.log')]
+        stages += [(module, name, 'Fresnel/polarisation') for name in (
+            'fresnel_reflection', 'fresnel_reflection_with_polarisation', 'fresnel_refraction', 'reflect_vector',
+            'rotation_matrix_from_vector_alignment')]
+        for obj in self.scene.objects:
+            if hasattr(getattr(obj, 'material', None), 'trace'):
+                stages.append((obj.material, 'trace', 'Material.trace'))
+            if hasattr(obj, 'log'):
+                stages.append((obj, 'log', 'Register.log'))
+        return stages
+
+    def start_parallel(self):
+        """
+        Traces the photons with self.workers processes, in blocks of self.block_size photons.
+
+        Each block is traced with its own random stream (seeded from self.seed) into a private DB, then the DBs are
+        merged in block order renumbering the uids, so that the results do not depend on the number of workers.
+        Requires the 'fork' start method (i.e. Linux/Mac) as the scene is shared with the workers without pickling.
+        """
+        blocks_done = self.load_checkpoint() if self.resume else 0
+        if self.profiler is not None:
+            self.profiler.begin(min(blocks_done * self.block_size, self.throws), self.total_steps)
+        block_count = int(np.ceil(self.throws / self.block_size))
+        block_seeds = np.random.RandomState(self.seed).randint(0, 2 ** 31 - 1, size=block_count)
+        first_pid = getattr(self.source, 'throw', 0)
+        blocks = []
+        for index in range(blocks_done, block_count):
+            first = index * self.block_size
+            count = min(self.block_size, self.throws - first)
+            blocks.append((index, first_pid + first, count, int(block_seeds[index])))
+
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            # Python 2: always fork on posix
+            context = multiprocessing
+        except ValueError:
+            raise ValueError("Tracer workers need the 'fork' start method, not available on this platform. "
+                             "Use workers=None instead.")
+
+        self.scene.log.info("Tracing " + str(self.throws) + " photons in " + str(block_count) + " blocks with " +
+                            str(self.workers) + " workers")
+        pool = context.Pool(processes=min(self.workers, max(len(blocks), 1)), initializer=_init_worker,
+                            initargs=(self,))
+        checkpointed = blocks_done
+        try:
+            for filename, total_steps, killed, stores, tallies, profile in pool.imap(_trace_block, blocks):
+                blocks_done += 1
+                self.dumped.append(filename)
+                self.total_steps += total_steps
+                self.killed += killed
+                # Merge Register tallies of the block
+                for obj in self.scene.objects:
+                    if obj.name in stores:
+                        obj.merge_store(stores[obj.name])
+                if profile is not None:
+                    self.profiler.merge(profile)
+                if self.show_counter:
+                    sys.stdout.write('\r Photon number: ' + str(len(self.dumped) * self.block_size))
+                    sys.stdout.flush()
+                # Convergence (blocks are merged in order, so the same blocks are traced with any number of workers)
+                if tallies is not None:
+                    self.convergence.add_tallies(tallies)
+                    if self.check_convergence():
+                        break
+                # Checkpoint of the blocks completed so far
+                if self.checkpoint_interval and blocks_done < block_count and \
+                        (blocks_done - checkpointed) * self.block_size >= self.checkpoint_interval:
+                    checkpointed = blocks_done
+                    self.save_checkpoint(blocks_done)
+        finally:
+            if self.converged:
+                # The blocks left are not needed
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+        if self.converged:
+            for index in range(blocks_done, block_count):
+                if os.path.exists(self.block_location(index)):
+                    os.remove(self.block_location(index))
+        if hasattr(self.source, 'throw'):
+            self.source.throw = first_pid + min(blocks_done * self.block_size, self.throws)
+        self.save_database()
+        if self.profiler is not None:
+            self.profiler.end(min(blocks_done * self.block_size, self.throws), self.total_steps)
+
+    def run_block(self, index, first, count, seed):
+        """
+        Traces a block of photons in a private DB (in the worker process) and dumps it to file.
+
+        :param index: block number
+        :param first: pid of the first photon of the block
+        :param count: number of photons in the block
+        :param seed: seed of the random stream of the block
+        :return: tuple with DB filename, steps, killed photons, Register tallies (by object name), convergence tallies
+        (see PhotonTally.tallies(), None without target_error) and profiled stages (see StageProfiler, None without
+        profile) of the block
+        """
+        np.random.seed(seed)
+        self.database = self.new_database(buffer_size=self.db_buffer_size)
+        if self.convergence is not None:
+            self.database.tally = self.new_convergence_tally()
+        self.total_steps = 0
+        self.killed = 0
+        if hasattr(self.source, 'throw'):
+            self.source.throw = first
+        for obj in self.scene.objects:
+            if hasattr(obj, 'store'):
+                obj.store = dict()
+
+        profiler = None
+        if self.profile:
+            profiler = StageProfiler()
+            profiler.instrument(self.profile_stages())
+        try:
+            self.trace_block(first, count)
+        finally:
+            if profiler is not None:
+                profiler.restore()
+
+        self.database.flush()
+        db_file_dump = self.block_location(index)
+        self.database.dump_to_file(location=db_file_dump)
+        stores = dict((obj.name, obj.store) for obj in self.scene.objects if hasattr(obj, 'store'))
+        tallies = None if self.database.tally is None else self.database.tally.tallies()
+        profile = None if profiler is None else profiler.stages
+        return db_file_dump, self.total_steps, self.killed, stores, tallies, profile
+
+    def block_location(self, index):
+        """ Location of the DB dump of the block index (see run_block) """
+        return os.path.join(self.scene.working_dir, "~pvtrace_block" + str(index) + self.dump_extension())
+
+    def trace_block(self, first, count):
+        """
+        Traces count photons, numbered from first
+
+        :param first: number of the first photon
+        :param count: number of photons to be traced
+        """
+        for throw in range(first, first + count):
+            self.trace_photon(throw)
+
+    def trace_photon(self, throw):
+        """
+        Creates a photon from the light source and traces it through the scene, logging its steps to the DB
+
+        :param throw: photon number (used for logging and counter only)
+        """
+        global a, b
+
+        # Delete last ray from visualiser
+        # fixme: if channels are cylindrical in shape they will be removed from the view if this is active!
+        # if pvtrace.Visualiser.VISUALISER_ON:
+        #     for obj in self.visualiser.display.objects:
+        #         if obj.__class__ is visual.cylinder and obj.radius < 0.001:
+        #             obj.visible = False
+
+        # SHOW COUNTER (every 10 photons)
+        if throw % 10 == 0 and self.show_counter:
+            sys.stdout.write('\r Photon number: ' + str(throw))
+            sys.stdout.flush()
+
+        # Create random photon from lightsource and set relative variables
+        self.scene.log.debug("Emitting photon number: " + str(throw))
+        photon = self.source.photon()
+        photon.scene = self.scene
+        photon.material = self.source
+
+        # Sets bits for visualiser and, if show_start, shows the photon origin (with a small sphere)
+        if pvtrace.Visualiser.VISUALISER_ON:
+            photon.visualiser = self.visualiser
+            a = list(photon.position)
+            if self.show_start:
+                self.visualiser.addSmallSphere(a)
+
+        # Photon tracing loop (up to self.steps) max iterations
+        step = 0
+        while photon.active and step < self.steps:
+            # Save to DB the previous step (either termination or simple step)
+            if photon.exit_device is not None:
+                # Adds info about exit surface, if possible (from the hit record of the last step)
+                hit = photon.surface_hit(photon.exit_device)
+                if hit is not None:
+                    # Is the ray heading towards or out of a surface?
+                    if hit.outbound(photon.direction):
+                        bound = "Out"
                     else:
-                        self.database.log(photon)
+                        bound = "In"
+                    # Saves photon to db
+                    self.database.log(photon, surface_normal=hit.surface_normal(photon.direction), surface_id=hit.face,
+                                      ray_direction_bound=bound, emitter_material=photon.emitter_material,
+                                      absorber_material=photon.absorber_material)
                 else:
                     self.database.log(photon)
+            else:
+                self.database.log(photon)
 
-                wavelength = photon.wavelength
-                photon = photon.trace()
+            wavelength = photon.wavelength
+            photon = photon.trace()
 
-                self.scene.log.debug('Photon ' + str(throw) + ' step ' + str(step) + '...')
-                if step == 0:
-                    # The ray has hit the first object. 
-                    # Cache this for later use. If the ray is not killed then log data.
-                    entering_photon = copy(photon)
+            self.scene.log.debug('Photon ' + str(throw) + ' step ' + str(step) + '...')
+            if step == 0:
+                # The ray has hit the first object. 
+                # Cache this for later use. If the ray is not killed then log data.
+                entering_photon = self.entering_photon.copy_from(photon)
 
-                # Visualizer bits
-                if pvtrace.Visualiser.VISUALISER_ON:
-                    b = list(photon.position)
-                    # if self.show_lines and photon.active and step > 2:
-                    if self.show_lines and photon.active:
-                        self.visualiser.addLine(a, b, colour=wav2RGB(photon.wavelength))
-                    
-                    # if self.show_path and photon.active and step > 0:
-                    if self.show_path and photon.active:
-                        self.visualiser.addSmallSphere(b)
+            # Visualizer bits
+            if pvtrace.Visualiser.VISUALISER_ON:
+                b = list(photon.position)
+                # if self.show_lines and photon.active and step > 2:
+                if self.show_lines and photon.active:
+                    self.visualiser.addLine(a, b, colour=wav2RGB(photon.wavelength))
                 
-                # Reached Bound()
-                if not photon.active and photon.container == self.scene.bounds:
-                    if pvtrace.Visualiser.VISUALISER_ON:
-                        if self.show_exit:
-                            photon.visual_obj.append(self.visualiser.addSmallSphere(a, colour=[.33, .33, .33]))
-                            photon.visual_obj.append(self.visualiser.addLine(a, a + 0.01 * photon.direction,
-                                                     colour=wav2RGB(wavelength)))
-                    # Record photon that has made it to the bounds
-                    if step == 0:
-                        self.scene.log.warn("   * Photon hit scene bounds without previous intersections "
-                                            "(maybe reconsider light source position?) *")
-                    else:
-                        self.scene.log.debug("   * Photon reached Bounds! (died)")
-                        photon.exit_device.log(photon)
-                        # This is not really needed and pollutes statistics
-                        # self.database.log(photon)
-
-                    # entering_photon.exit_device.log(entering_photon)
-                    # assert logged == throw, "Logged (%s) and throw (%s) not equal" % (str(logged), str(throw))
-                    logged += 1
-
-                elif not photon.active:
-                    photon.exit_device = photon.container
-                    photon.container.log(photon)
-                    self.database.log(photon)
-                    if entering_photon.container == photon.scene.bounds:
-                        self.scene.log.debug("   * Photon hit scene bounds without previous intersections *")
-                    else:
-                        # try:
-                        entering_photon.container.log(entering_photon)
-                        # self.database.log(photon)
-                        # except:
-                        #    entering_photon.container.log_in_volume(entering_photon)
-                        # assert logged == throw, "Logged (%s) and thorw (%s) not equal" % (str(logged), str(throw))
-                    logged += 1
-
+                # if self.show_path and photon.active and step > 0:
+                if self.show_path and photon.active:
+                    self.visualiser.addSmallSphere(b)
+            
+            # Reached Bound()
+            if not photon.active and photon.container == self.scene.bounds:
                 if pvtrace.Visualiser.VISUALISER_ON:
-                    visual.rate(100000)  # Needed since VPyhton6
-                    a = b
-
-                step += 1
-                self.total_steps += 1
-                if step >= self.steps: # We need to kill the photon because it is bouncing around in a locked path
-                    self.killed += 1
-                    photon.killed = True
-                    self.database.log(photon)
-                    self.scene.log.debug("   * Reached Max Steps *")
+                    if self.show_exit:
+                        photon.visual_obj.append(self.visualiser.addSmallSphere(a, colour=[.33, .33, .33]))
+                        photon.visual_obj.append(self.visualiser.addLine(a, a + 0.01 * photon.direction,
+                                                 colour=wav2RGB(wavelength)))
+                # Record photon that has made it to the bounds
+                if step == 0:
+                    self.scene.log.warn("   * Photon hit scene bounds without previous intersections "
+                                        "(maybe reconsider light source position?) *")
+                else:
+                    self.scene.log.debug("   * Photon reached Bounds! (died)")
+                    photon.exit_device.log(photon)
+                    # This is not really needed and pollutes statistics
+                    # self.database.log(photon)
+
+                # entering_photon.exit_device.log(entering_photon)
+                # assert logged == throw, "Logged (%s) and throw (%s) not equal" % (str(logged), str(throw))
+
+            elif not photon.active:
+                photon.exit_device = photon.container
+                photon.container.log(photon)
+                self.database.log(photon)
+                if entering_photon.container == photon.scene.bounds:
+                    self.scene.log.debug("   * Photon hit scene bounds without previous intersections *")
+                else:
+                    # try:
+                    entering_photon.container.log(entering_photon)
+                    # self.database.log(photon)
+                    # except:
+                    #    entering_photon.container.log_in_volume(entering_photon)
+                    # assert logged == throw, "Logged (%s) and thorw (%s) not equal" % (str(logged), str(throw))
 
-            # DB SPLIT
-            if self.db_split and throw % self.split_num == 0 and throw > 0:
-                # Incremental number
-                db_num = int(throw / self.split_num)
-                # Commit all queries
-                self.database.connection.commit()
-                # Dump file location
-                db_file_dump = os.path.join(self.scene.working_dir, "~pvtrace_tmp" + str(db_num) + ".sql")
-                # Dump DB
-                self.database.dump_to_file(location=db_file_dump)
-                # Add DB dumped file to dumped list for later recovery
-                self.dumped.append(db_file_dump)
-                # Empty current DB
-                self.database.empty()
+            if pvtrace.Visualiser.VISUALISER_ON:
+                visual.rate(100000)  # Needed since VPyhton6
+                a = b
+
+            step += 1
+            self.total_steps += 1
+            if step >= self.steps: # We need to kill the photon because it is bouncing around in a locked path
+                self.killed += 1
+                photon.killed = True
+                self.database.log(photon)
+                self.scene.log.debug("   * Reached Max Steps *")
+
+        # The last logged step is the endpoint of the photon
+        self.database.end_photon(photon.id)
+
+    def split_database(self, db_num=None):
+        """
+        Dumps the current DB to a temporary file in the scene working_dir and empties it (DB splitting)
 
+        :param db_num: incremental number of the dump (defaults to the number of dumps done)
+        """
+        if db_num is None:
+            db_num = len(self.dumped)
+        # Commit all queries
+        self.database.flush()
+        # Dump file location
+        db_file_dump = os.path.join(self.scene.working_dir, "~pvtrace_tmp" + str(db_num) + self.dump_extension())
+        # Dump DB
+        self.database.dump_to_file(location=db_file_dump)
+        # Add DB dumped file to dumped list for later recovery
+        self.dumped.append(db_file_dump)
+        # Empty current DB
+        self.database.empty()
+
+    def save_database(self, db_num=None):
+        """
+        Merges the dumped DBs (if db_split is active), links the DB to scene.stats and saves it as db.sqlite
+
+        :param db_num: number of the last dump done by split_database (defaults to the number of dumps done - 1)
+        """
         # Commit DB
-        self.database.connection.commit()
-        # If DB split is active, split the remaining photons and then merge everything
-        if self.db_split:
-            db_num += 1
-            db_file_dump = os.path.join(self.scene.working_dir, "~pvtrace_tmp" + str(db_num) + ".sql")
+        self.database.flush()
+        # If DB split is active (or the DB was dumped by checkpoints), split the remaining photons and merge everything
+        if (self.db_split or self.dumped) and self.workers is None:
+            db_num = len(self.dumped) if db_num is None else db_num + 1
+            db_file_dump = os.path.join(self.scene.working_dir, "~pvtrace_tmp" + str(db_num) + self.dump_extension())
             self.database.dump_to_file(location=db_file_dump)
             self.dumped.append(db_file_dump)
 
+        if self.dumped:
             # MERGE DB before statistics
             # this will be done in memory only (RAM is cheap nowadays)
-            self.database = pvtrace.PhotonDatabase(dbfile=None)
+            self.database = self.new_database()
             # Check whether to save all the DB tables of just photon and state (faster and smaller but with data loss)
-            if self.db_save_all_tables:
+            if self.db_save_all_tables or not self.db_split:
                 tables_to_save = None
             else:
-                tables_to_save = ("photon", "state")
-            
+                tables_to_save = ("photon", "state", "endpoint")
+
             for db_file in self.dumped:
-                self.database.add_db_file(filename=db_file, tables=tables_to_save)
+                # Blocks traced by workers have uids starting from 0 each
+                uid_offset = self.database.uid if self.workers is not None else None
+                self.database.add_db_file(filename=db_file, tables=tables_to_save, uid_offset=uid_offset)
                 # Removes dumps
                 os.remove(db_file)
+            self.dumped = []
 
         # Save DB to Scene as db.sqlite file (merged DB if split is active, the only active DB otherwise)
         self.scene.stats.add_db(self.database)
-        db_final_location = os.path.join(self.scene.working_dir, 'db.sqlite')
-        self.database.dump_to_file(db_final_location)
+        self.database.dump_to_file(self.database_location())
+
+        # The run is complete, its checkpoint is not needed anymore
+        if os.path.exists(self.checkpoint_location()):
+            os.remove(self.checkpoint_location())
+
+    def database_location(self):
+        """ Location of the DB saved at the end of the run (in the scene working_dir, depends on db_backend) """
+        if self.db_backend == 'columnar':
+            return os.path.join(self.scene.working_dir, pvtrace.default_store_filename())
+        elif self.db_backend == 'tally':
+            return os.path.join(self.scene.working_dir, 'tally.json')
+        return os.path.join(self.scene.working_dir, 'db.sqlite')
+
+    def checkpoint_location(self):
+        """ Location of the checkpoint file of the run (in the scene working_dir) """
+        return os.path.join(self.scene.working_dir, '~pvtrace_checkpoint.pkl')
+
+    def save_checkpoint(self, position):
+        """
+        Dumps the DB (see split_database) and saves the state of the run, to be continued with resume=True
+
+        :param position: number of photons traced (of blocks completed with workers)
+        """
+        if self.workers is None:
+            self.split_database()
+        state = {'tracer': type(self).__name__, 'throws': self.throws, 'workers': self.workers is not None,
+                 'block_size': self.block_size, 'db_backend': self.db_backend, 'position': position,
+                 'dumped': list(self.dumped), 'db_uid': self.database.uid,
+                 'source_throw': getattr(self.source, 'throw', None), 'random_state': np.random.get_state(),
+                 'total_steps': self.total_steps, 'killed': self.killed,
+                 'stores': dict((obj.name, obj.store) for obj in self.scene.objects if hasattr(obj, 'store')),
+                 'convergence': None if self.convergence is None else self.convergence.tallies()}
+        location = self.checkpoint_location()
+        with open(location + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump(state, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        # The previous checkpoint is replaced only when the new one is complete
+        getattr(os, 'replace', os.rename)(location + '.tmp', location)
+        self.scene.log.info("Checkpoint saved (" + str(position) + (" blocks" if self.workers is not None else
+                                                                    " photons") + ")")
+
+    def load_checkpoint(self):
+        """
+        Restores the state of the run saved by the last checkpoint in the scene working_dir
+
+        :return: number of photons traced (of blocks completed with workers) at the checkpoint, 0 without checkpoint
+        """
+        location = self.checkpoint_location()
+        if not os.path.exists(location):
+            self.scene.log.info("No checkpoint found in " + str(self.scene.working_dir) + ", starting a new run")
+            return 0
+        with open(location, 'rb') as checkpoint_file:
+            state = pickle.load(checkpoint_file)
+
+        # The checkpoint must come from the same kind of run
+        for key, value in (('tracer', type(self).__name__), ('throws', self.throws),
+                           ('workers', self.workers is not None), ('block_size', self.block_size),
+                           ('db_backend', self.db_backend)):
+            if state[key] != value:
+                raise ValueError("Checkpoint " + location + " has " + key + "=" + str(state[key]) + " instead of " +
+                                 str(value))
+        for db_file in state['dumped']:
+            if not os.path.exists(db_file):
+                raise IOError("DB dump " + db_file + " of checkpoint " + location + " is missing")
+
+        self.dumped = list(state['dumped'])
+        self.database.uid = state['db_uid']
+        if state['source_throw'] is not None:
+            self.source.throw = state['source_throw']
+        np.random.set_state(state['random_state'])
+        self.total_steps = state['total_steps']
+        self.killed = state['killed']
+        for obj in self.scene.objects:
+            if obj.name in state['stores']:
+                # Checkpoints of former versions have lists of entries
+                obj.store = dict()
+                obj.merge_store(state['stores'][obj.name])
+        if self.convergence is not None and state['convergence'] is not None:
+            self.convergence.add_tallies(state['convergence'])
+        self.scene.log.info("Resuming from checkpoint (" + str(state['position']) + (
+            " blocks" if self.workers is not None else " photons") + ")")
+        return state['position']
+
+    def new_convergence_tally(self):
+        """ Returns a new PhotonTally for the convergence checks, with the faces of the scene analysis """
+        return pvtrace.PhotonTally(edges=self.scene.stats.edges, apertures=self.scene.stats.apertures)
+
+    def check_convergence(self):
+        """
+        Compares the relative errors of the target_fractions with target_error (see PhotonTally.relative_error())
+
+        :return: True if every target fraction is converged (self.converged is set as well)
+        """
+        errors = [self.convergence.relative_error(fraction, self.confidence) for fraction in self.target_fractions]
+        self.converged = max(errors) <= self.target_error
+        report = ", ".join(fraction + ": " + format(self.convergence.confidence_interval(fraction)[0] * 100, '.2f') +
+                           " % (relative error " + format(error, '.4f') + ")"
+                           for fraction, error in zip(self.target_fractions, errors))
+        photons = str(self.convergence.count['generated'])
+        if self.converged:
+            self.scene.log.info("Converged after " + photons + " photons. " + report)
+        else:
+            self.scene.log.debug("Not converged after " + photons + " photons. " + report)
+        return self.converged
+
+    def new_database(self, dbfile=None, buffer_size=None):
+        """
+        Returns a new (empty) DB of the selected db_backend
+
+        :param dbfile: DB filename (None for in-memory DB)
+        :param buffer_size: rows buffered before being written
+        """
+        if self.db_backend == 'columnar':
+            return pvtrace.PhotonStore(dbfile, buffer_size=buffer_size)
+        elif self.db_backend == 'tally':
+            return pvtrace.PhotonTally(dbfile, buffer_size=buffer_size)
+        return pvtrace.PhotonDatabase(dbfile, buffer_size=buffer_size)
+
+    def dump_extension(self):
+        """ Extension of the temporary DB dumps (uncompressed npz for the columnar backend, json for tallies) """
+        return {'columnar': '.npz', 'tally': '.json'}.get(self.db_backend, '.sql')
 
 if __name__ == "__main__":
     import doctest
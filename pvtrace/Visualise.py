@@ -266,37 +266,26 @@ class Visualiser (object):
         pex = voxelextent
 
         """
-        Scan space
+        Scan space (grid points as in x = x + step, tested all at once)
         """
-        
-        x = xmin
-        
+
         print('Visualisation of ', CSGobj.reference, ' started...')
-            
-        while x < xmax:
 
-            y = ymin
-            z = zmin
-                  
-            while y < ymax:            
-                
-                z = zmin
-                
-                while z < zmax:                
-                    
-                    pt = (x, y, z)                
-                    
-                    if CSGobj.contains(pt):
-                        origin = (pt[0]-pex[0]/2, pt[1]-pex[1]/2, pt[2]-pex[2]/2)
-                        extent = (pt[0]+pex[0]/2, pt[1]+pex[1]/2, pt[2]+pex[2]/2)
-                        voxel = Geo.Box(origin=origin, extent=extent)
-                        self.addCSGvoxel(voxel, colour=colour, opacity=1., material=material)                
-                    
-                    z = z + res*(zmax-zmin)
-
-                y = y + res*(ymax-ymin)
-
-            x = x + res*(xmax-xmin)     
+        axes = []
+        for minimum, maximum, step in ((xmin, xmax, pex[0]), (ymin, ymax, pex[1]), (zmin, zmax, pex[2])):
+            values = []
+            value = minimum
+            while value < maximum:
+                values.append(value)
+                value = value + step
+            axes.append(values)
+        grid = np.array([(x, y, z) for x in axes[0] for y in axes[1] for z in axes[2]], dtype=float).reshape(-1, 3)
+
+        for pt in grid[CSGobj.contains_points(grid)]:
+            origin = (pt[0]-pex[0]/2, pt[1]-pex[1]/2, pt[2]-pex[2]/2)
+            extent = (pt[0]+pex[0]/2, pt[1]+pex[1]/2, pt[2]+pex[2]/2)
+            voxel = Geo.Box(origin=origin, extent=extent)
+            self.addCSGvoxel(voxel, colour=colour, opacity=1., material=material)
 
         print('Complete.')
 
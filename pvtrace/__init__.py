@@ -11,49 +11,93 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import division
+import importlib
+import logging
+import os
+import sys
+
 import numpy as np
 from pvtrace.external import transformations
 from pvtrace.external import mathutils
 
+# Tracing core (geometry, materials, devices, scene, tracer, databases and analysis)
 from pvtrace.Analysis import *
 from pvtrace.ConstructiveGeometry import *
 from pvtrace.Devices import *
 from pvtrace.Geometry import *
 from pvtrace.Interpolation import *
-from pvtrace.LightSources import *
 from pvtrace.Materials import *
 from pvtrace.PhotonDatabase import *
+from pvtrace.PhotonStore import *
+from pvtrace.PhotonTally import *
+from pvtrace.Profiling import *
 from pvtrace.Scene import *
 from pvtrace.Trace import *
 from pvtrace.Trajectory import *
-from pvtrace.Visualise import *
 
-from pvtrace.lscpm import *
+logger = logging.getLogger('pvtrace')
 
-import os
-import sys
-import logging
-import sqlitebck
+# Modules imported at the first use of one of their names (e.g. pvtrace.BatchTracer, see __getattr__), so that e.g.
+# the tracing workers do not import the visualiser or the batch tracer. Searched in this order. The lscpm package is
+# imported at its first use as well.
+LAZY_MODULES = ('Visualise', 'LightSources', 'BatchTrace')
 
-pvtrace_containing_directory = False
 
-logger = logging.getLogger('pvtrace')
-logger.info('pvtrace pre-flight checks...')
-
-# Module constants -- location of the data folder
-logger.info('System Path: '+str(sys.path))
-for path in sys.path:
-    if path.find('pvtrace') != -1:
-        pvtrace_containing_directory = path
-        break
-
-if pvtrace_containing_directory is not False:
-    while os.path.dirname(pvtrace_containing_directory).find('pvtrace') != -1:
-        pvtrace_containing_directory = os.path.dirname(pvtrace_containing_directory)
-    pvtrace_containing_directory = os.path.abspath(os.path.join(pvtrace_containing_directory))
-else:
-    print("Cannot find PvTrace root directory! (Consider setting pvtrace_containing_directory explicitly")
-    sys.exit(1)
-
-PVTDATA = os.path.join(pvtrace_containing_directory, 'data')
-logger.info('PVTDATA set to '+PVTDATA)
+def data_directory():
+    """
+    Returns the pvtrace data folder (PVTDATA): the PVTDATA environment variable if set, otherwise the data folder of
+    the pvtrace checkout containing this package or of the first pvtrace folder in sys.path
+    """
+    if os.environ.get('PVTDATA'):
+        return os.environ['PVTDATA']
+    checkout = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if os.path.isdir(os.path.join(checkout, 'data')):
+        return os.path.join(checkout, 'data')
+
+    logger.info('System Path: ' + str(sys.path))
+    for path in sys.path:
+        if path.find('pvtrace') != -1:
+            while os.path.dirname(path).find('pvtrace') != -1:
+                path = os.path.dirname(path)
+            return os.path.join(os.path.abspath(path), 'data')
+    raise IOError("Cannot find PvTrace data directory! (Consider setting the PVTDATA environment variable)")
+
+
+def __getattr__(name):
+    """
+    Resolves the lazy names of the package at their first use (Python >= 3.7): PVTDATA, the modules of LAZY_MODULES
+    (and lscpm) and their names
+    """
+    if name in ('PVTDATA', 'pvtrace_containing_directory'):
+        globals()['PVTDATA'] = data_directory()
+        globals()['pvtrace_containing_directory'] = os.path.dirname(PVTDATA)
+        logger.info('PVTDATA set to ' + PVTDATA)
+        return globals()[name]
+    if name in LAZY_MODULES or name == 'lscpm':
+        return importlib.import_module(__name__ + '.' + name)
+    if name == '__all__':
+        # from pvtrace import * (everything is imported)
+        for module_name in LAZY_MODULES:
+            module = importlib.import_module(__name__ + '.' + module_name)
+            for key, value in vars(module).items():
+                if not key.startswith('_'):
+                    globals().setdefault(key, value)
+        names = set(key for key in globals() if not key.startswith('_'))
+        return sorted(names | set(['PVTDATA', 'pvtrace_containing_directory', 'lscpm']))
+    if not name.startswith('_'):
+        for module_name in LAZY_MODULES:
+            module = importlib.import_module(__name__ + '.' + module_name)
+            if name in vars(module):
+                globals()[name] = getattr(module, name)
+                return globals()[name]
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported (PEP 562): everything is imported now
+    from pvtrace.Visualise import *
+    from pvtrace.LightSources import *
+    from pvtrace.BatchTrace import *
+    from pvtrace.lscpm import *
+    PVTDATA = data_directory()
+    pvtrace_containing_directory = os.path.dirname(PVTDATA)
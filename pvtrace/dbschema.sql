@@ -13,6 +13,14 @@ CREATE TABLE polarisation(  x   DOUBLE,  y   DOUBLE,  z   DOUBLE,  uid  INTEGER,
 
 CREATE TABLE surface_normal(  x   DOUBLE,  y   DOUBLE,  z   DOUBLE,  uid  INTEGER,  FOREIGN KEY(uid) REFERENCES photon(uid));
 
+CREATE TABLE endpoint(  uid INTEGER PRIMARY KEY,  /* last uid of the photon */ pid INTEGER,  fate TEXT,  /* killed, reaction, loss, escape or other */ container_obj TEXT,  on_surface_obj TEXT,  surface_id TEXT,  ray_direction_bound TEXT,  absorption_counter INTEGER,  intersection_counter INTEGER,  reaction BOOL,  killed BOOL,  original_wavelength DOUBLE,  wavelength DOUBLE);
+
+CREATE INDEX endpoint_pid ON endpoint(pid);
+
+CREATE INDEX endpoint_fate ON endpoint(fate, absorption_counter);
+
+CREATE INDEX endpoint_surface ON endpoint(surface_id, ray_direction_bound, absorption_counter);
+
 --  DATA 
 -- INSERT INTO position VALUES (0,0,0,0);
 -- INSERT INTO position VALUES (1,1,1,1);
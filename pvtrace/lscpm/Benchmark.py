@@ -0,0 +1,215 @@
+"""
+Reproducible performance benchmark of the tracers on the reactors shipped in data/reactors.
+
+Every case is a standard scene (Red305 200 ppm in PDMS, MB in acetonitrile, solar simulator over the whole reactor,
+see BENCHMARK_CASES and Sweep.DEFAULT_PARAMETERS) traced with a fixed seed, each one in a new process so that the peak
+memory of a case does not depend on the previous ones. The results (photons/s, steps/s, DB bytes per photon, peak RSS
+and analysis time, with the times of import pvtrace and import pvtrace.lscpm.Sweep) are saved as json, to be compared
+among versions with compare_benchmarks().
+
+Example:
+    report = run_benchmark(throws=10000, location='benchmark.json')
+    print(compare_benchmarks(json.load(open('reference.json')), report))
+"""
+
+from __future__ import division, print_function
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import pvtrace
+from pvtrace.lscpm.Sweep import DEFAULT_PARAMETERS, point_scene
+
+# Cases of the benchmark: name and sweep point parameters (see Sweep.DEFAULT_PARAMETERS)
+BENCHMARK_CASES = (('5x5_6ch', {'reactor_name': '5x5_6ch', 'irradiated_area': (0.05, 0.05)}),
+                   ('5x5_fang_24ch', {'reactor_name': '5x5_fang_24ch', 'irradiated_area': (0.05, 0.05)}),
+                   ('1sqm_2dir_2.5cm', {'reactor_name': '1sqm_2dir_2.5cm', 'irradiated_area': (1.0, 1.0)}))
+
+# Figures of merit compared by compare_benchmarks()
+METRICS = ('photons_per_second', 'steps_per_second', 'db_bytes_per_photon', 'peak_rss', 'analysis_time')
+
+# Maximum time (s) of import pvtrace, and of import pvtrace.lscpm.Sweep (pvtrace.lscpm and the modules of the sweeps),
+# in a new interpreter (see import_time()), a warning is logged above it and scripts/LSC-PM/benchmark.py exits with
+# status 1
+IMPORT_TIME_BUDGET = 0.3
+
+# Module of lscpm_import_time in the report of run_benchmark()
+LSCPM_IMPORT_MODULE = 'pvtrace.lscpm.Sweep'
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size (bytes) of this process and of its terminated children (e.g. Tracer workers),
+    None where the resource module is not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kB on Linux, bytes on Mac
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def import_time(repeat=3, module='pvtrace'):
+    """
+    Returns the time (s) taken by the import of module in a new interpreter (best of repeat runs)
+
+    :param repeat: number of interpreters started
+    :param module: name of the module imported (e.g. pvtrace.lscpm.Sweep)
+    """
+    code = "import time; start = time.time(); import " + module + "; print(time.time() - start)"
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        times.append(float(output.decode('utf-8').split()[-1]))
+    return min(times)
+
+
+def run_case(name, parameters, throws, seed=1, tracer=None, tracer_options=None):
+    """
+    Traces a benchmark case and measures it
+
+    :param name: name of the case (the scene uuid is benchmark_<name>)
+    :param parameters: sweep point parameters of the case (see Sweep.DEFAULT_PARAMETERS)
+    :param throws: photons traced
+    :param seed: seed of the tracer
+    :param tracer: Tracer class (pvtrace.Tracer by default)
+    :param tracer_options: other keyword arguments of the tracer (e.g. db_backend, workers)
+    :return: dict of the results of the case
+    """
+    if tracer is None:
+        tracer = pvtrace.Tracer
+    options = dict(tracer_options) if tracer_options is not None else {}
+    if not issubclass(tracer, pvtrace.BatchTracer):
+        options.setdefault('use_visualiser', False)
+
+    scene, source = point_scene(parameters, 'benchmark_' + name)
+    trace = tracer(scene=scene, source=source, throws=throws, seed=seed, **options)
+    # The DB of a previous run in the same working dir would be merged with the new one
+    if os.path.exists(trace.database_location()):
+        os.remove(trace.database_location())
+
+    start = time.time()
+    trace.start()
+    elapsed = time.time() - start
+
+    start = time.time()
+    excel = scene.stats.print_excel()
+    analysis_time = time.time() - start
+
+    db_bytes = os.path.getsize(trace.database_location())
+    return {'name': name, 'parameters': dict(DEFAULT_PARAMETERS, **parameters), 'throws': throws, 'seed': seed,
+            'elapsed': elapsed, 'steps': trace.total_steps, 'killed': trace.killed,
+            'photons_per_second': throws / elapsed, 'steps_per_second': trace.total_steps / elapsed,
+            'db_bytes': db_bytes, 'db_bytes_per_photon': db_bytes / throws, 'peak_rss': peak_rss(),
+            'analysis_time': analysis_time, 'excel': excel}
+
+
+def _run_case_process(connection, args):
+    """Runs a case of run_benchmark() in its own process, sending back the results (or the failure)"""
+    try:
+        connection.send(('done', run_case(*args)))
+    except Exception as error:
+        connection.send(('failed', repr(error)))
+    connection.close()
+
+
+def version():
+    """ Returns the git description of the pvtrace checkout (None if not available) """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            label = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=devnull,
+                                            cwd=os.path.dirname(os.path.abspath(pvtrace.__file__)))
+        return label.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(cases=BENCHMARK_CASES, throws=10000, seed=1, tracer=None, tracer_options=None, isolate=True,
+                  location=None):
+    """
+    Runs the benchmark cases
+
+    :param cases: sequence of (name, parameters) of the cases (see BENCHMARK_CASES)
+    :param throws: photons traced per case
+    :param seed: seed of the tracer (the same for every case)
+    :param tracer: Tracer class (pvtrace.Tracer by default, e.g. pvtrace.BatchTracer)
+    :param tracer_options: other keyword arguments of the tracer (e.g. db_backend, workers)
+    :param isolate: run each case in a new process (the peak RSS of a case is then its own)
+    :param location: json file the report is saved to (not saved if None)
+    :return: report (dict), with the results of every case in 'cases'
+    """
+    logger = logging.getLogger('pvtrace.benchmark')
+    tracer_class = tracer if tracer is not None else pvtrace.Tracer
+    report = {'version': version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': multiprocessing.cpu_count(),
+              'tracer': tracer_class.__name__,
+              'tracer_options': dict(tracer_options) if tracer_options is not None else {},
+              'import_time': import_time(), 'lscpm_import_time': import_time(module=LSCPM_IMPORT_MODULE),
+              'import_time_budget': IMPORT_TIME_BUDGET, 'cases': []}
+    for key, module in (('import_time', 'pvtrace'), ('lscpm_import_time', LSCPM_IMPORT_MODULE)):
+        if report[key] > IMPORT_TIME_BUDGET:
+            logger.warning("import " + module + " took " + format(report[key], '.3f') + " s, over the budget of " +
+                           str(IMPORT_TIME_BUDGET) + " s")
+    for name, parameters in cases:
+        logger.info("Benchmark case " + name + ": " + str(throws) + " photons")
+        args = (name, parameters, throws, seed, tracer, tracer_options)
+        if isolate:
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_case_process, args=(sender, args))
+            process.start()
+            sender.close()
+            try:
+                state, result = receiver.recv()
+            except EOFError:
+                state, result = 'failed', "process terminated"
+            process.join()
+            if state != 'done':
+                raise RuntimeError("Benchmark case " + name + " failed: " + result)
+        else:
+            result = run_case(*args)
+        logger.info("Benchmark case " + name + ": " + format(result['photons_per_second'], '.1f') + " photons/s")
+        report['cases'].append(result)
+
+    if location is not None:
+        with open(location, 'w') as report_file:
+            json.dump(report, report_file, indent=1, sort_keys=True)
+        logger.info("Benchmark saved as " + str(location))
+    return report
+
+
+def compare_benchmarks(reference, report):
+    """
+    Compares two benchmark reports (e.g. of two versions) case by case
+
+    :param reference: report of run_benchmark() (or loaded from its json file) used as reference
+    :param report: report to be compared
+    :return: text table with the ratio report/reference of each metric (> 1 is an improvement for photons_per_second
+    and steps_per_second, a regression for the others)
+    """
+    cases = dict((case['name'], case) for case in reference['cases'])
+    lines = ["case, " + ", ".join(METRICS)]
+    for case in report['cases']:
+        old = cases.get(case['name'])
+        if old is None:
+            continue
+        ratios = []
+        for metric in METRICS:
+            if old.get(metric) and case.get(metric) is not None:
+                ratios.append(format(case[metric] / old[metric], '.3f'))
+            else:
+                ratios.append('-')
+        lines.append(case['name'] + ", " + ", ".join(ratios))
+    for key in ('import_time', 'lscpm_import_time'):
+        if reference.get(key) and report.get(key) is not None:
+            lines.append(key + ", " + format(report[key] / reference[key], '.3f'))
+    return "\n".join(lines)
@@ -1,6 +1,7 @@
 from __future__ import division
 import logging
-from pvtrace import *
+from pvtrace import PVTDATA
+from pvtrace.Materials import Material, Spectrum
 import numpy as np
 import os
 
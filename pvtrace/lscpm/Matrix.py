@@ -1,5 +1,5 @@
 import logging
-from pvtrace import *
+from pvtrace.Materials import Material, Spectrum
 import numpy as np
 import os
 
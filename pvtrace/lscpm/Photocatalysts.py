@@ -1,7 +1,8 @@
 import logging
 import numpy as np
 import os
-from pvtrace import *
+from pvtrace import PVTDATA
+from pvtrace.Materials import Spectrum
 
 class Photocatalyst(object):
     def __init__(self, compound, concentration):
@@ -1,11 +1,14 @@
 from __future__ import division, print_function
 
-from pvtrace import *
+import logging
 import numpy as np
 import os
 import ConfigParser
-from pvtrace.lscpm.Photocatalysts import *
-from pvtrace.lscpm.Solvents import *
+from pvtrace import PVTDATA
+from pvtrace.Devices import Channel, LSC
+from pvtrace.Materials import CompositeMaterial, Material, Spectrum
+from pvtrace.lscpm.Photocatalysts import Photocatalyst
+from pvtrace.lscpm.Solvents import Solvent
 import ast
 
 
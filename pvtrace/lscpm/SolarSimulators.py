@@ -1,5 +1,11 @@
-from pvtrace import *
-from pvtrace.Analysis import xyplot
+import logging
+import os
+
+import numpy as np
+from pvtrace import PVTDATA
+from pvtrace.Analysis import pyplot, xyplot
+from pvtrace.LightSources import PlanarSource
+from pvtrace.Materials import load_spectrum
 
 
 class LightSource(object):
@@ -64,6 +70,6 @@ class LightSource(object):
         normalization_factor = np.linalg.norm(self.source.spectrum.y, ord=1)
         y = self.source.spectrum.y/normalization_factor
 
-        plt.switch_backend('Qt4Agg')
+        pyplot().switch_backend('Qt4Agg')
         xyplot(x=self.source.spectrum.x, y=y,
                filename='lightsource_' + self.source.name + '_spectrum')
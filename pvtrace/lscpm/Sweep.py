@@ -0,0 +1,266 @@
+"""
+Parameter sweeps of LSC-PM reactors.
+
+Each point of a Sweep is a dict of parameters (see DEFAULT_PARAMETERS) and is simulated in its own Scene
+(~/pvtrace_data/<sweep name>_point<job id>), on a process pool if workers is not None. The state of every point is kept
+in a job table (sweep.sqlite in the sweep working dir), so that an interrupted sweep started again skips the points
+already done, and the print_excel() row of each point is saved in the result table.
+
+Example:
+    sweep = Sweep('MB_grad_200', sweep_grid(photocatalyst_concentration=[0.0001, 0.001, 0.01]), throws=100000,
+                  workers=4)
+    sweep.start()
+    sweep.write_results(os.path.join(sweep.working_dir, 'results.txt'))
+"""
+
+from __future__ import division, print_function
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+
+import pvtrace
+from pvtrace.lscpm.Dyes import LuminophoreMaterial
+from pvtrace.lscpm.Matrix import Matrix
+from pvtrace.lscpm.Reactor import Reactor
+from pvtrace.lscpm.SolarSimulators import LightSource
+
+# Parameters of a sweep point (and their defaults)
+DEFAULT_PARAMETERS = {'reactor_name': '5x5_6ch_squared', 'dye': 'Red305', 'dye_concentration': 200,
+                      'matrix': 'pdms', 'photocatalyst': 'MB', 'photocatalyst_concentration': 0.001,
+                      'solvent': 'acetonitrile', 'lamp_type': 'SolarSimulator', 'led_voltage': None,
+                      'irradiated_area': (0.05, 0.05), 'distance': 0.025}
+
+
+def sweep_grid(**parameters):
+    """
+    Returns the points of the cartesian product of the parameter values, e.g.
+    sweep_grid(dye_concentration=[100, 200], photocatalyst_concentration=[0.001, 0.01]) gives 4 points
+
+    :param parameters: list of values of each parameter (see DEFAULT_PARAMETERS)
+    :return: list of points (dicts)
+    """
+    names = sorted(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*[parameters[name] for name in names])]
+
+
+def point_scene(parameters, uuid):
+    """
+    Builds the scene of a sweep point: reactor (luminophore, matrix, photocatalyst, solvent) and light source
+
+    :param parameters: parameters of the point (the missing ones are taken from DEFAULT_PARAMETERS)
+    :param uuid: uuid of the scene (an existing working dir is reused)
+    :return: (scene, light source) tuple
+    """
+    point = dict(DEFAULT_PARAMETERS)
+    point.update(parameters)
+
+    scene = pvtrace.Scene(uuid=uuid, force=True)
+    scene.log.info('Sweep point: ' + json.dumps(point, sort_keys=True))
+
+    luminophore = LuminophoreMaterial(point['dye'], point['dye_concentration'])
+    reactor = Reactor(reactor_name=point['reactor_name'], luminophore=luminophore, matrix=Matrix(point['matrix']),
+                      photocatalyst=point['photocatalyst'],
+                      photocatalyst_concentration=point['photocatalyst_concentration'], solvent=point['solvent'])
+    scene.add_objects(reactor.scene_obj)
+
+    lamp = LightSource(lamp_type=point['lamp_type'])
+    if point['led_voltage'] is not None:
+        lamp.set_LED_voltage(voltage=point['led_voltage'])
+    lamp.set_lightsource(irradiated_area=tuple(point['irradiated_area']), distance=point['distance'])
+    return scene, lamp.source
+
+
+def run_point(parameters, uuid, throws, seed=None, tracer=None, tracer_options=None):
+    """
+    Simulates a sweep point in its own scene
+
+    :param parameters: parameters of the point (the missing ones are taken from DEFAULT_PARAMETERS)
+    :param uuid: uuid of the scene (an existing working dir is reused)
+    :param throws: photons traced
+    :param seed: seed of the tracer
+    :param tracer: Tracer class (pvtrace.Tracer by default)
+    :param tracer_options: other keyword arguments of the tracer
+    :return: (header, row) tuple of Analysis.print_excel_header() and Analysis.print_excel()
+
+    A point simulated again in the same scene gives the same results:
+
+    >>> first = run_point({}, 'doctest_sweep_point', 50, seed=1)  # doctest: +ELLIPSIS
+    Working directory: ...
+    >>> run_point({}, 'doctest_sweep_point', 50, seed=1) == first  # doctest: +ELLIPSIS
+    Working directory: ...
+    True
+    """
+    if tracer is None:
+        tracer = pvtrace.Tracer
+    options = dict(tracer_options) if tracer_options is not None else {}
+    if not issubclass(tracer, pvtrace.BatchTracer):
+        options.setdefault('use_visualiser', False)
+
+    scene, source = point_scene(parameters, uuid)
+    trace = tracer(scene=scene, source=source, throws=throws, seed=seed, **options)
+    # The DB of a previous (or interrupted) run of the point would be merged with the new one
+    if os.path.exists(trace.database_location()):
+        os.remove(trace.database_location())
+    trace.start()
+    return scene.stats.print_excel_header(), scene.stats.print_excel()
+
+
+def _run_job(job):
+    """Runs a job of Sweep.start() (in the worker process), failures are returned instead of raised"""
+    job_id, parameters, uuid, throws, seed, tracer, tracer_options = job
+    start = time.time()
+    try:
+        header, row = run_point(parameters, uuid, throws, seed=seed, tracer=tracer, tracer_options=tracer_options)
+        return job_id, uuid, 'done', header, row, None, time.time() - start
+    except Exception:
+        return job_id, uuid, 'failed', None, None, traceback.format_exc(), time.time() - start
+
+
+class Sweep(object):
+    """
+    Resumable parameter sweep over LSC-PM reactors, light sources, luminophores and photocatalysts.
+    """
+
+    def __init__(self, name, points, throws=100000, workers=None, seed=None, tracer=None, tracer_options=None):
+        """
+        :param name: name of the sweep (working dir ~/pvtrace_data/<name>, scenes ~/pvtrace_data/<name>_point<id>)
+        :param points: list of dicts of parameters (see DEFAULT_PARAMETERS and sweep_grid())
+        :param throws: photons traced per point
+        :param workers: number of processes (0 means cpu_count), None to simulate the points in this process
+        :param seed: seed of the tracers (point id is added), None for random seeds
+        :param tracer: Tracer class (pvtrace.Tracer by default, e.g. pvtrace.BatchTracer)
+        :param tracer_options: other keyword arguments of the tracer (e.g. db_backend, target_error, checkpoint_interval
+        and resume to continue the interrupted points from their checkpoints). Tracer workers can be used only when
+        the sweep has no workers.
+        """
+        super(Sweep, self).__init__()
+        self.logger = logging.getLogger('pvtrace.sweep')
+        self.name = name
+        self.points = [dict(point) for point in points]
+        for point in self.points:
+            unknown = set(point) - set(DEFAULT_PARAMETERS)
+            if unknown:
+                raise ValueError("Unknown sweep parameters: " + ", ".join(sorted(unknown)) + " (valid: " +
+                                 ", ".join(sorted(DEFAULT_PARAMETERS)) + ")")
+        self.throws = throws
+        if workers is not None and workers < 1:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.seed = seed
+        self.tracer = tracer if tracer is not None else pvtrace.Tracer
+        self.tracer_options = dict(tracer_options) if tracer_options is not None else {}
+        if self.workers is not None and self.tracer_options.get('workers') is not None:
+            raise ValueError("Sweep workers and Tracer workers cannot be used together")
+
+        self.working_dir = os.path.join(os.path.expanduser('~'), 'pvtrace_data', name)
+        if not os.path.exists(self.working_dir):
+            os.makedirs(self.working_dir)
+        self.db_file = os.path.join(self.working_dir, 'sweep.sqlite')
+        self.connection = sqlite3.connect(self.db_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS job (id INTEGER PRIMARY KEY, parameters TEXT UNIQUE, "
+                                "state TEXT, uuid TEXT, error TEXT, elapsed REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS result (job_id INTEGER PRIMARY KEY REFERENCES job(id), "
+                                "header TEXT, excel TEXT)")
+        # New points are added as pending jobs, the known ones keep their state
+        self.connection.executemany("INSERT OR IGNORE INTO job (parameters, state) VALUES (?, 'pending')",
+                                    [(self.key(point),) for point in self.points])
+        self.connection.commit()
+
+    @staticmethod
+    def key(point):
+        """ Returns the identifier of a point in the job table (its parameters as json) """
+        return json.dumps(point, sort_keys=True)
+
+    def jobs(self, states=None):
+        """
+        Returns the (id, parameters, state) of the jobs of the points of this sweep, in job order
+
+        :param states: states to be selected ('pending', 'done', 'failed'), all by default
+        """
+        keys = set(self.key(point) for point in self.points)
+        rows = self.connection.execute("SELECT id, parameters, state FROM job ORDER BY id").fetchall()
+        return [(job_id, json.loads(parameters), state) for job_id, parameters, state in rows
+                if parameters in keys and (states is None or state in states)]
+
+    def status(self):
+        """ Returns the number of points per job state """
+        status = {}
+        for _, _, state in self.jobs():
+            status[state] = status.get(state, 0) + 1
+        return status
+
+    def start(self, retry_failed=True):
+        """
+        Simulates the points not done yet (points already done by an interrupted sweep are skipped)
+
+        :param retry_failed: simulate again the points failed in previous runs
+        :return: number of points simulated (successfully) by this call
+        """
+        states = ('pending', 'failed') if retry_failed else ('pending',)
+        jobs = [(job_id, parameters, self.name + '_point' + str(job_id), self.throws,
+                 None if self.seed is None else self.seed + job_id, self.tracer, self.tracer_options)
+                for job_id, parameters, _ in self.jobs(states)]
+        self.logger.info("Sweep " + self.name + ": " + str(len(jobs)) + " points to be simulated, " +
+                         str(len(self.jobs(('done',)))) + " already done")
+        if not jobs:
+            return 0
+
+        done = 0
+        if self.workers is None:
+            results = (_run_job(job) for job in jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes=min(self.workers, len(jobs)))
+            results = pool.imap_unordered(_run_job, jobs)
+        try:
+            for job_id, uuid, state, header, row, error, elapsed in results:
+                self.connection.execute("UPDATE job SET state = ?, uuid = ?, error = ?, elapsed = ? WHERE id = ?",
+                                        (state, uuid, error, elapsed, job_id))
+                if state == 'done':
+                    done += 1
+                    self.connection.execute("INSERT OR REPLACE INTO result VALUES (?, ?, ?)", (job_id, header, row))
+                    self.logger.info("Sweep point " + str(job_id) + " done in " + format(elapsed, '.1f') + " s")
+                else:
+                    self.logger.error("Sweep point " + str(job_id) + " failed:\n" + str(error))
+                # Every point is saved as soon as it is done
+                self.connection.commit()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return done
+
+    def results(self):
+        """
+        Returns the results table as (parameters, print_excel() row) tuples of the points done, in job order
+        """
+        rows = self.connection.execute("SELECT job.parameters, result.excel FROM job JOIN result ON "
+                                       "job.id = result.job_id WHERE job.state = 'done' ORDER BY job.id").fetchall()
+        keys = set(self.key(point) for point in self.points)
+        return [(json.loads(parameters), excel) for parameters, excel in rows if parameters in keys]
+
+    def write_results(self, file_path, columns=None):
+        """
+        Writes the results as text: the parameters in columns followed by the print_excel() row of each point
+
+        :param file_path: output file
+        :param columns: parameters written (by default the ones that change among the points)
+        """
+        results = self.results()
+        header = self.connection.execute("SELECT header FROM result LIMIT 1").fetchone()
+        if columns is None:
+            points = [dict(DEFAULT_PARAMETERS, **parameters) for parameters, _ in results]
+            columns = [name for name in sorted(DEFAULT_PARAMETERS)
+                       if len(set(json.dumps(point[name]) for point in points)) > 1]
+        with open(file_path, 'w') as results_file:
+            if header is not None:
+                results_file.write(", ".join(list(columns) + [header[0]]) + "\n")
+            for parameters, excel in results:
+                point = dict(DEFAULT_PARAMETERS, **parameters)
+                results_file.write(", ".join([str(point[name]) for name in columns] + [excel]) + "\n")
+        self.logger.info("Sweep results saved as " + str(file_path))
@@ -1,4 +1,8 @@
 from __future__ import division
+import math
+import sys
+import time
+import pvtrace
 from pvtrace.lscpm.Reactor import *
 from pvtrace.lscpm.Dyes import *
 from pvtrace.lscpm.Matrix import *
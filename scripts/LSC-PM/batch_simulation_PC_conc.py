@@ -1,8 +1,7 @@
 from __future__ import division
-from pvtrace.lscpm.Reactor import *
-from pvtrace.lscpm.Dyes import *
-from pvtrace.lscpm.Matrix import *
-from pvtrace.lscpm.SolarSimulators import *
+import os
+import sys
+from pvtrace.lscpm.Sweep import *
 from math import pow
 
 photocatalyst = 'MB'
@@ -12,42 +11,15 @@ dye_conc = 200
 file_path = os.path.join(os.path.expanduser('~'), 'pvtrace_data',
                          'MB_grad_'+str(dye_conc)+'.txt')
 
-for mainloop_i in range(9, 11):
-    exp = (-50 + mainloop_i)/10
-    pc_conc = pow(10, exp)
+# Photocatalyst concentrations 10^((-50 + i) / 10)
+concentrations = [pow(10, (-50 + mainloop_i)/10) for mainloop_i in range(9, 11)]
+points = sweep_grid(photocatalyst_concentration=concentrations)
 
-    # This implicitly restart logging on the new location
-    scene = pvtrace.Scene(dye+'_'+str(dye_conc)+'_'+photocatalyst+'_10_' + str(exp))
-
-    logger = logging.getLogger('pvtrace')
-
-    luminophore = LuminophoreMaterial(dye, dye_conc)
-    pdms = Matrix('pdms')
-
-    reactor = Reactor(reactor_name="5x5_6ch_squared", luminophore=luminophore, matrix=pdms, photocatalyst=photocatalyst,
-                      photocatalyst_concentration=pc_conc, solvent="acetonitrile")
-    scene.add_objects(reactor.scene_obj)
-
-    lamp = LightSource(lamp_type='SolarSimulator')
-    lamp.set_lightsource(irradiated_area=(0.05, 0.05), distance=0.025)
-    trace = pvtrace.Tracer(scene=scene, source=lamp.source, throws=100000, use_visualiser=False,
-                           show_axis=True, show_counter=False, db_split=True, preserve_db_tables=True)
-
-    # Run simulation
-    tic = time.clock()
-    logger.info('Simulation Started (time: '+str(tic)+')')
-    trace.start()
-    toc = time.clock()
-    logger.info('Simulation Ended (time: '+str(toc)+', elapsed: '+str(toc-tic)+' s)')
-
-    scene.stats.print_detailed()
-    if mainloop_i == 0:
-        text = str(scene.stats.print_excel_header("Concentration")+"\n")
-    else:
-        text = ""
-    text += str(scene.stats.print_excel(pc_conc) + "\n")
-    write_me = open(file_path, 'a')
-    write_me.write(text)
-    write_me.close()
+# Points already simulated by an interrupted sweep are skipped
+sweep = Sweep(dye+'_'+str(dye_conc)+'_'+photocatalyst+'_sweep',
+              [dict(point, dye=dye, dye_concentration=dye_conc, photocatalyst=photocatalyst) for point in points],
+              throws=100000, workers=0, tracer_options={'db_split': True, 'preserve_db_tables': True})
+sweep.start()
+sweep.write_results(file_path, columns=['photocatalyst_concentration'])
 
 sys.exit(0)
@@ -0,0 +1,39 @@
+from __future__ import division, print_function
+import json
+import logging
+import os
+import sys
+import time
+import pvtrace
+from pvtrace.lscpm.Benchmark import LSCPM_IMPORT_MODULE, compare_benchmarks, run_benchmark
+
+# Usage: python benchmark.py [throws] [tracer: scalar|batch] [reference json to compare with]
+# Exit status is 1 if import pvtrace or import pvtrace.lscpm.Sweep takes longer than the budget
+# (Benchmark.IMPORT_TIME_BUDGET)
+throws = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+tracer = pvtrace.BatchTracer if len(sys.argv) > 2 and sys.argv[2] == 'batch' else pvtrace.Tracer
+
+logging.getLogger('pvtrace').setLevel(logging.INFO)
+file_path = os.path.join(os.path.expanduser('~'), 'pvtrace_data',
+                         'benchmark_' + tracer.__name__ + '_' + time.strftime('%Y%m%d_%H%M%S') + '.json')
+
+# Red305 200ppm in PDMS, MB 1 mM in acetonitrile, solar simulator, seed 1 (see BENCHMARK_CASES)
+report = run_benchmark(throws=throws, seed=1, tracer=tracer, location=file_path)
+for case in report['cases']:
+    print(case['name'] + ": " + format(case['photons_per_second'], '.1f') + " photons/s, " +
+          format(case['steps_per_second'], '.1f') + " steps/s, " + format(case['db_bytes_per_photon'], '.0f') +
+          " DB bytes/photon, peak RSS " + str(case['peak_rss']) + " bytes, analysis " +
+          format(case['analysis_time'], '.3f') + " s")
+
+if len(sys.argv) > 3:
+    with open(sys.argv[3]) as reference_file:
+        print(compare_benchmarks(json.load(reference_file), report))
+
+# The import times of pvtrace and of the lscpm package are kept under a fixed budget
+status = 0
+for key, module in (('import_time', 'pvtrace'), ('lscpm_import_time', LSCPM_IMPORT_MODULE)):
+    if report[key] > report['import_time_budget']:
+        print("import " + module + " took " + format(report[key], '.3f') + " s, over the budget of " +
+              str(report['import_time_budget']) + " s")
+        status = 1
+sys.exit(status)
@@ -1,3 +1,7 @@
+import subprocess
+import sys
+import time
+import pvtrace
 from pvtrace.lscpm.Reactor import *
 from pvtrace.lscpm.Dyes import *
 from pvtrace.lscpm.Matrix import *
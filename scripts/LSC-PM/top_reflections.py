@@ -1,4 +1,6 @@
 from __future__ import division
+import sys
+import pvtrace
 from pvtrace.lscpm.Reactor import *
 from pvtrace.lscpm.Dyes import *
 from pvtrace.lscpm.Matrix import *